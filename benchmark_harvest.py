@@ -0,0 +1,701 @@
+"""Benchmark harvest throughput against local stand-in services.
+
+Starts local fake servers for WMS/WFS capabilities, an ArcGIS REST service
+tree and a minimal CKAN action API with configurable latency, then times
+`get_layer_dict`, `upsert_datasets`, `harvest_arcgis_service` and
+`CatalogueMirror` end to end.
+Each benchmark runs in its own process and reports layers per second,
+requests issued to the fake servers and peak RSS.
+
+Usage:
+    python benchmark_harvest.py
+    python benchmark_harvest.py --sizes 10 100 1000 10000 --latency 0.02 --workers 8
+    python benchmark_harvest.py --only upsert_prefetch --json bench.json
+"""
+import argparse
+import copy
+import gc
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit
+    from Queue import Empty
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit
+    from queue import Empty
+
+import ckanapi
+
+import harvest_helpers as hh
+
+
+#-------------------------------------------------------------------------------------#
+# Synthetic source documents
+#-------------------------------------------------------------------------------------#
+
+THEMES = ["Cultural, Society and Demography", "Boundaries", "Transport",
+          "Water", "Environment", "Geodetic", "Imagery", "Land Use",
+          "Infrastructure", "Natural Resources"]
+
+
+def layer_code(i):
+    """Return a SLIP-style layer id, e.g. 'BENCH-001'."""
+    return "BENCH-{0:03d}".format(i)
+
+
+def layer_title(i):
+    """Return a SLIP-style layer title with layer id and last updated timestamp."""
+    return "Benchmark Layer {0} ({1}) (14-10-2015 21:40:58)".format(i, layer_code(i).title())
+
+
+def slip_titles(n):
+    """Return n SLIP-style layer titles in the mix seen on SLIP Classic."""
+    patterns = ["Hydrographic Catchments - Basins {0} ({1}) (03-11-2008 15:07:44)",
+                "Misc Transport {0} (Point) ({1}) (18-10-2012 16:54:00)",
+                "Overview {0} Rivers({1}) (14-05-2008 17:59:05)",
+                "Ramsar Sites {0} ({1})",
+                "Virtual Mosaic {0}"]
+    return [patterns[i % len(patterns)].format(i, layer_code(i).title()) for i in range(n)]
+
+
+def make_wms_capabilities(n):
+    """Return a WMS 1.1.1 capabilities document with n layers under 10 theme layers."""
+    themes = []
+    for t, theme in enumerate(THEMES):
+        layers = "".join(
+            '<Layer queryable="1"><Name>{0}</Name><Title>{1}</Title>'
+            '<Abstract>Synthetic layer {2}</Abstract>'
+            '<KeywordList><Keyword>bench</Keyword></KeywordList>'
+            '<LatLonBoundingBox minx="112.89" miny="-35.08" maxx="129.92" maxy="-13.74"/>'
+            '</Layer>'.format(layer_code(i), layer_title(i), i)
+            for i in range(t, n, len(THEMES)))
+        themes.append("<Layer><Title>{0}</Title>{1}</Layer>".format(
+                theme.replace("&", "&amp;"), layers))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<WMT_MS_Capabilities version="1.1.1">'
+            '<Service><Name>OGC:WMS</Name><Title>Benchmark WMS</Title></Service>'
+            '<Capability><Request><GetCapabilities><Format>application/vnd.ogc.wms_xml</Format>'
+            '<DCPType><HTTP><Get><OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" '
+            'xlink:href="http://localhost/wms?"/></Get></HTTP></DCPType></GetCapabilities>'
+            '<GetMap><Format>image/png</Format><DCPType><HTTP><Get>'
+            '<OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" '
+            'xlink:href="http://localhost/wms?"/></Get></HTTP></DCPType></GetMap></Request>'
+            '<Layer><Title>Benchmark</Title>{0}</Layer></Capability>'
+            '</WMT_MS_Capabilities>').format("".join(themes)).encode("utf-8")
+
+
+def make_wfs_capabilities(n):
+    """Return a WFS 1.0.0 capabilities document with n feature types."""
+    types = "".join(
+        '<FeatureType><Name>slip:{0}</Name><Title>{1}</Title>'
+        '<Abstract>Synthetic layer {2}</Abstract><Keywords>bench</Keywords>'
+        '<SRS>EPSG:4326</SRS>'
+        '<LatLongBoundingBox minx="112.89" miny="-35.08" maxx="129.92" maxy="-13.74"/>'
+        '</FeatureType>'.format(layer_code(i), layer_title(i).rsplit(" (", 1)[0], i)
+        for i in range(n))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<WFS_Capabilities version="1.0.0" xmlns="http://www.opengis.net/wfs">'
+            '<Service><Name>WFS</Name><Title>Benchmark WFS</Title>'
+            '<OnlineResource>http://localhost/wfs</OnlineResource></Service>'
+            '<Capability><Request><GetCapabilities><DCPType><HTTP>'
+            '<Get onlineResource="http://localhost/wfs?"/></HTTP></DCPType></GetCapabilities>'
+            '<GetFeature><ResultFormat><GML2/></ResultFormat><DCPType><HTTP>'
+            '<Get onlineResource="http://localhost/wfs?"/></HTTP></DCPType></GetFeature>'
+            '</Request></Capability>'
+            '<FeatureTypeList><Operations><Query/></Operations>{0}</FeatureTypeList>'
+            '</WFS_Capabilities>').format(types).encode("utf-8")
+
+
+def make_arcgis_layer(i):
+    """Return the JSON dict of an ArcGIS REST layer."""
+    return {
+        "id": i,
+        "name": "Benchmark_Layer_{0}".format(i),
+        "description": ("Abstract: Synthetic layer {0}\n\n"
+                        "Geographic Extent: WA\n\n"
+                        "Original Source: Benchmark\n\n"
+                        "Tags: benchmark, synthetic").format(i),
+        "extent": {"spatialReference": {"wkid": 102100, "latestWkid": 3857},
+                   "xmin": 12639641.896807905, "xmax": 14360400.777488748,
+                   "ymin": -4168751.2292041867, "ymax": -1741902.4945217525}}
+
+
+#-------------------------------------------------------------------------------------#
+# Fake servers
+#-------------------------------------------------------------------------------------#
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """Keep-alive request handler counting requests on its server."""
+    protocol_version = "HTTP/1.1"
+    # Avoid Nagle/delayed-ACK stalls on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for (k, v) in (headers or dict()).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count(self, key):
+        with self.server.lock:
+            self.server.counts[key] = self.server.counts.get(key, 0) + 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+
+class OWSHandler(FakeHandler):
+    """Serves /wms/<n> and /wfs/<n> GetCapabilities documents."""
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.strip("/").split("/")
+        self.count("capabilities")
+        if len(path) != 2 or path[0] not in ("wms", "wfs"):
+            return self.send_body(404, {"error": "not found"})
+        key = tuple(path)
+        with self.server.lock:
+            if key not in self.server.documents:
+                make = make_wms_capabilities if path[0] == "wms" else make_wfs_capabilities
+                self.server.documents[key] = make(int(path[1]))
+        self.send_body(200, self.server.documents[key], content_type="application/xml",
+                       headers={"ETag": '"{0}"'.format("-".join(key))})
+
+
+class ArcGISHandler(FakeHandler):
+    """Serves an ArcGIS REST tree of folder BENCH with one MapServer S<n> of n layers."""
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.strip("/").split("/")[3:]
+        self.count("arcgis")
+        if path == []:
+            return self.send_body(200, {"folders": ["BENCH"], "services": []})
+        if path == ["BENCH"]:
+            return self.send_body(200, {"folders": [], "services": [
+                {"name": "BENCH/S{0}".format(n), "type": "MapServer"}
+                for n in self.server.sizes]})
+        match = re.match(r"S(\d+)$", path[1]) if len(path) > 2 else None
+        if not match:
+            return self.send_body(404, {"error": {"code": 404}})
+        n = int(match.group(1))
+        if len(path) == 3:
+            return self.send_body(200, {"layers": [{"id": i} for i in range(n)],
+                                        "supportedExtensions": "WMSServer, WFSServer"})
+        if path[3] == "layers":
+            return self.send_body(200, {"layers": [make_arcgis_layer(i) for i in range(n)]})
+        return self.send_body(200, make_arcgis_layer(int(path[3])))
+
+
+class CKANHandler(FakeHandler):
+    """A minimal in-memory CKAN action API."""
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        action = self.path.split("?")[0].rstrip("/").split("/")[-1]
+        length = int(self.headers.get("Content-Length") or 0)
+        data = json.loads(self.rfile.read(length).decode("utf-8") or "{}") if length else {}
+        self.count(action)
+        try:
+            with self.server.lock:
+                result = getattr(self, "action_" + action)(self.server.store, data)
+        except AttributeError:
+            return self.send_body(400, {"success": False, "error": {
+                "__type": "Bad request", "message": "Unknown action " + action}})
+        except KeyError as e:
+            return self.send_body(404, {"success": False, "error": {
+                "__type": "Not Found Error", "message": "Not found: {0}".format(e)}})
+        except ValueError as e:
+            return self.send_body(409, {"success": False, "error": {
+                "__type": "Validation Error", "name": [str(e)]}})
+        self.send_body(200, {"success": True, "result": result})
+
+    @staticmethod
+    def _find(entities, key):
+        for e in entities.values():
+            if key in (e["name"], e["id"]):
+                return e
+        raise KeyError(key)
+
+    def _list(self, entities, data):
+        names = sorted(entities)
+        offset = int(data.get("offset", 0))
+        names = names[offset:offset + int(data.get("limit", 1000))]
+        if data.get("all_fields"):
+            return [copy.deepcopy(entities[n]) for n in names]
+        return names
+
+    def _save(self, entities, data, create):
+        entity = copy.deepcopy(data)
+        if create:
+            if entity["name"] in entities:
+                raise ValueError("That URL is already in use.")
+            entity["id"] = "{0}-{1}".format(entity["name"], len(entities))
+        else:
+            old = self._find(entities, entity.get("id") or entity["name"])
+            entities.pop(old["name"])
+            entity["id"] = old["id"]
+        entities[entity["name"]] = entity
+        return entity
+
+    def action_organization_show(self, store, data):
+        return copy.deepcopy(self._find(store["orgs"], data["id"]))
+
+    def action_organization_list(self, store, data):
+        return self._list(store["orgs"], data)
+
+    def action_organization_create(self, store, data):
+        return self._save(store["orgs"], data, True)
+
+    def action_organization_update(self, store, data):
+        return self._save(store["orgs"], data, False)
+
+    def action_group_list(self, store, data):
+        return self._list(store["groups"], data)
+
+    def action_group_create(self, store, data):
+        return self._save(store["groups"], data, True)
+
+    def action_group_update(self, store, data):
+        return self._save(store["groups"], data, False)
+
+    def action_package_show(self, store, data):
+        return copy.deepcopy(self._find(store["packages"], data["id"]))
+
+    def action_package_list(self, store, data):
+        return sorted(store["packages"])
+
+    def _package(self, data):
+        package = copy.deepcopy(data)
+        if "tag_string" in package:
+            tags = package.pop("tag_string")
+            if not isinstance(tags, list):
+                tags = tags.split(",")
+            package["tags"] = [{"name": t} for t in tags]
+        package["metadata_modified"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        return package
+
+    def action_package_create(self, store, data):
+        return copy.deepcopy(self._save(store["packages"], self._package(data), True))
+
+    def action_package_update(self, store, data):
+        return copy.deepcopy(self._save(store["packages"], self._package(data), False))
+
+    def action_package_delete(self, store, data):
+        store["packages"].pop(self._find(store["packages"], data["id"])["name"])
+
+    action_dataset_purge = action_package_delete
+
+    def action_package_search(self, store, data):
+        key = data.get("sort", "name asc").split()[0]
+        packages = sorted(store["packages"].values(), key=lambda p: (p[key], p["name"]))
+        for tag in re.findall(r'tags:"([^"]+)"', data.get("fq", "")):
+            packages = [p for p in packages if tag in [t["name"] for t in p["tags"]]]
+        for since in re.findall(r'metadata_modified:\[(\S+)Z TO \*\]', data.get("fq", "")):
+            packages = [p for p in packages if p["metadata_modified"] >= since]
+        start = int(data.get("start", 0))
+        rows = min(int(data.get("rows", 10)), 1000)
+        return {"count": len(packages),
+                "results": copy.deepcopy(packages[start:start + rows])}
+
+    def action_bench_reset(self, store, data):
+        store["packages"].clear()
+        store["groups"].clear()
+
+
+def start_server(handler, latency=0.0, **attrs):
+    """Start a fake server on a free local port in a daemon thread."""
+    server = FakeServer(("127.0.0.1", 0), handler)
+    server.lock = threading.Lock()
+    server.counts = dict()
+    server.latency = latency
+    for (k, v) in attrs.items():
+        setattr(server, k, v)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:{0}".format(server.server_address[1])
+
+
+class Environment(object):
+    """The fake servers shared by all benchmarks."""
+
+    def __init__(self, sizes, latency, workers):
+        self.sizes = sizes
+        self.workers = workers
+        orgs = {"lgate": {"name": "lgate", "id": "lgate-0", "title": "Landgate"}}
+        store = {"orgs": orgs, "groups": dict(), "packages": dict()}
+        self.ows, self.ows_url = start_server(OWSHandler, documents=dict())
+        self.arcgis, arcgis_url = start_server(ArcGISHandler, latency=latency, sizes=sizes)
+        self.arcgis_url = arcgis_url + "/arcgis/rest/services"
+        self.ckan, self.ckan_url = start_server(CKANHandler, latency=latency, store=store)
+
+    def close(self):
+        for server in (self.ows, self.arcgis, self.ckan):
+            server.shutdown()
+            server.server_close()
+
+    def requests(self):
+        """Return the total number of requests served so far."""
+        return sum(sum(s.counts.values()) for s in (self.ows, self.arcgis, self.ckan))
+
+    def reset_ckan(self):
+        """Drop all packages and groups (from any process)."""
+        hh.requests.post(self.ckan_url + "/api/action/bench_reset", json={})
+
+
+#-------------------------------------------------------------------------------------#
+# Benchmarks
+#-------------------------------------------------------------------------------------#
+
+def _ckan(env):
+    return ckanapi.RemoteCKAN(env.ckan_url, apikey="benchmark")
+
+
+def _wms_url(env, n):
+    return "{0}/wms/{1}".format(env.ows_url, n)
+
+
+def _layer_dicts(env, n, layers=None):
+    ckan = _ckan(env)
+    layers = layers or hh.iter_capabilities_layers(_wms_url(env, n))
+    return hh.get_layer_dict(layers, _wms_url(env, n), ckan, dict(), dict(), dict(),
+                             res_format="WMS")
+
+
+def bench_get_layer_dict_owslib(env, n):
+    """get_layer_dict over an owslib WebMapService fetched from the endpoint."""
+    wms = hh.WebMapService(_wms_url(env, n), version="1.1.1")
+    return len(_layer_dicts(env, n, layers=wms))
+
+
+def bench_get_layer_dict_records(env, n):
+    """get_layer_dict over layer records, dropping the owslib WebMapService first."""
+    layers = hh.layer_records(hh.WebMapService(_wms_url(env, n), version="1.1.1"))
+    # owslib layers reference their parents and children
+    gc.collect()
+    return len(_layer_dicts(env, n, layers=layers))
+
+
+def bench_get_layer_dict_stream(env, n):
+    """get_layer_dict over records streamed by iter_capabilities_layers."""
+    return len(_layer_dicts(env, n))
+
+
+def bench_get_layer_dict_cached(env, n):
+    """get_layer_dict over an owslib object read through a warm capabilities cache."""
+    cache_dir = tempfile.mkdtemp()
+    try:
+        hh.fetch_capabilities(_wms_url(env, n), cache_dir=cache_dir)
+        wms = hh.get_capabilities(_wms_url(env, n), cache_dir=cache_dir)
+        return len(_layer_dicts(env, n, layers=wms))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def bench_parse_name_legacy(env, n):
+    """The uncached token by token parse_name of n titles, for a WMS and a WFS source."""
+    titles = slip_titles(n)
+    for source in ("WMS", "WFS"):
+        [hh._parse_name_legacy(t)[2] or hh._now_iso() for t in titles]
+    return 2 * n
+
+
+def bench_parse_names(env, n):
+    """parse_names of n titles, for a WMS and a WFS source sharing titles."""
+    titles = slip_titles(n)
+    for source in ("WMS", "WFS"):
+        hh.parse_names(titles)
+    return 2 * n
+
+
+def _setup_upsert(env, n):
+    env.reset_ckan()
+    return _layer_dicts(env, n)
+
+
+def bench_upsert_sequential(env, n, dicts):
+    """upsert_datasets creating n datasets, then refreshing them, one at a time."""
+    ckan = _ckan(env)
+    hh.upsert_datasets(dicts, ckan)
+    return len(hh.upsert_datasets(copy.deepcopy(dicts), ckan))
+
+
+def bench_upsert_prefetch(env, n, dicts):
+    """upsert_datasets as above, looking up existing datasets with package_search."""
+    ckan = _ckan(env)
+    hh.upsert_datasets(dicts, ckan, prefetch=True)
+    return len(hh.upsert_datasets(copy.deepcopy(dicts), ckan, prefetch=True))
+
+
+def bench_upsert_concurrent(env, n, dicts):
+    """upsert_datasets as above, with prefetch and --workers threads."""
+    ckan = _ckan(env)
+    hh.upsert_datasets(dicts, ckan, prefetch=True, workers=env.workers)
+    return len(hh.upsert_datasets(copy.deepcopy(dicts), ckan, prefetch=True,
+                                  workers=env.workers))
+
+
+def _harvest_arcgis(env, n, batch):
+    env.reset_ckan()
+    service_url = "{0}/BENCH/S{1}/MapServer".format(env.arcgis_url, n)
+    ckan = _ckan(env)
+    failed = hh.harvest_arcgis_service(service_url, ckan, "lgate-0", "Benchmark",
+                                       "bench@example.com", batch=batch)
+    return n - len(failed)
+
+
+def bench_arcgis_per_layer(env, n):
+    """harvest_arcgis_service reading one layer JSON per request."""
+    return _harvest_arcgis(env, n, batch=False)
+
+
+def bench_arcgis_batched(env, n):
+    """harvest_arcgis_service reading all layer JSON from the layers endpoint."""
+    return _harvest_arcgis(env, n, batch=True)
+
+
+def _setup_catalogue(env, n):
+    env.reset_ckan()
+    hh.upsert_datasets(_layer_dicts(env, n), _ckan(env), prefetch=True, workers=env.workers)
+    return os.path.join(tempfile.mkdtemp(), "mirror.sqlite")
+
+
+def bench_catalogue_package_show(env, n, path):
+    """Reading a catalogue of n datasets with package_list and one package_show each."""
+    ckan = _ckan(env)
+    return len([ckan.action.package_show(id=x) for x in ckan.action.package_list()])
+
+
+def bench_catalogue_mirror(env, n, path):
+    """Reading a catalogue of n datasets into an empty CatalogueMirror."""
+    mirror = hh.CatalogueMirror(_ckan(env), path)
+    mirror.refresh()
+    count = len(list(mirror.packages()))
+    mirror.close()
+    shutil.rmtree(os.path.dirname(path))
+    return count
+
+
+def _setup_catalogue_refresh(env, n):
+    path = _setup_catalogue(env, n)
+    mirror = hh.CatalogueMirror(_ckan(env), path)
+    mirror.refresh()
+    mirror.close()
+    return path
+
+
+def bench_catalogue_mirror_refresh(env, n, path):
+    """Refreshing a CatalogueMirror of n unchanged datasets, then reading them locally."""
+    mirror = hh.CatalogueMirror(_ckan(env), path)
+    mirror.refresh()
+    count = len(list(mirror.packages()))
+    mirror.close()
+    shutil.rmtree(os.path.dirname(path))
+    return count
+
+
+def _setup_extents(env, n):
+    """Return 100 named extents over WA and n datasets with a bbox spatial extent."""
+    def box(x, y, size):
+        return json.dumps({"type": "MultiPolygon", "coordinates": [[[
+            [x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]]]})
+    extents = dict(("Extent {0}".format(i), box(112 + (i % 10) * 1.6, -34 + (i // 10) * 1.9, 2.5))
+                   for i in range(100))
+    extents["WA"] = box(110, -36, 20)
+    packages = [{"name": layer_code(i), "spatial": box(113 + (i % 97) * 0.16, -33 + (i % 89) * 0.2,
+                                                       0.05 + (i % 7) * 0.1)}
+                for i in range(n)]
+    return (extents, packages)
+
+
+def bench_assign_extents(env, n, extents_packages):
+    """assign_extents of n datasets to the smallest of 101 enclosing named extents."""
+    (extents, packages) = extents_packages
+    return hh.assign_extents(extents, packages=packages)["packages"]
+
+
+# (name, benchmark function, untimed setup function or None)
+BENCHMARKS = [
+    ("parse_name_legacy", bench_parse_name_legacy, None),
+    ("parse_names", bench_parse_names, None),
+    ("get_layer_dict_owslib", bench_get_layer_dict_owslib, None),
+    ("get_layer_dict_records", bench_get_layer_dict_records, None),
+    ("get_layer_dict_stream", bench_get_layer_dict_stream, None),
+    ("get_layer_dict_cached", bench_get_layer_dict_cached, None),
+    ("upsert_sequential", bench_upsert_sequential, _setup_upsert),
+    ("upsert_prefetch", bench_upsert_prefetch, _setup_upsert),
+    ("upsert_concurrent", bench_upsert_concurrent, _setup_upsert),
+    ("arcgis_per_layer", bench_arcgis_per_layer, None),
+    ("arcgis_batched", bench_arcgis_batched, None),
+    ("catalogue_package_show", bench_catalogue_package_show, _setup_catalogue),
+    ("catalogue_mirror", bench_catalogue_mirror, _setup_catalogue),
+    ("catalogue_mirror_refresh", bench_catalogue_mirror_refresh, _setup_catalogue_refresh),
+    ("assign_extents", bench_assign_extents, _setup_extents),
+]
+
+
+#-------------------------------------------------------------------------------------#
+# Runner
+#-------------------------------------------------------------------------------------#
+
+def _peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    return peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+
+def _run_child(env, bench, setup, n, queue, go, verbose):
+    """Run one benchmark in a child process and put the result on queue.
+
+    Signals on queue once setup is done and waits for go, so that the parent
+    counts only the requests issued by the timed part.
+    """
+    if not verbose:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+    try:
+        args = (setup(env, n),) if setup else ()
+        queue.put("ready")
+        go.wait()
+        start = time.time()
+        count = bench(env, n, *args)
+        seconds = time.time() - start
+        queue.put({"seconds": seconds, "layers": count, "peak_rss_mb": _peak_rss_mb()})
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def _child_result(child, queue, deadline):
+    """Wait for the next message from a benchmark child.
+
+    Polls the queue so that a child which dies without reporting (segfault,
+    OOM kill, os._exit) or runs past the deadline fails the benchmark
+    instead of blocking the runner forever.
+
+    Arguments:
+        child (multiprocessing.Process) The benchmark process
+        queue (multiprocessing.Queue) The queue the child reports on
+        deadline (float) time.time() after which the child is terminated
+
+    Returns:
+        The message put on the queue, or a dict with an "error" key
+    """
+    while True:
+        try:
+            return queue.get(timeout=max(0.01, min(1.0, deadline - time.time())))
+        except Empty:
+            pass
+        if not child.is_alive():
+            # The child may have reported just before exiting
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                return {"error": "child exited with code {0}".format(child.exitcode)}
+        if time.time() >= deadline:
+            child.terminate()
+            return {"error": "timed out"}
+
+
+def run_benchmark(env, name, bench, setup, n, verbose=False, timeout=600):
+    """Run one benchmark in a fresh process and return its result dict.
+
+    Arguments:
+        timeout (float) Seconds allowed for setup and for the timed run each
+    """
+    queue = multiprocessing.Queue()
+    go = multiprocessing.Event()
+    child = multiprocessing.Process(target=_run_child,
+                                    args=(env, bench, setup, n, queue, go, verbose))
+    child.start()
+    result = _child_result(child, queue, time.time() + timeout)
+    before = env.requests()
+    if result == "ready":
+        go.set()
+        result = _child_result(child, queue, time.time() + timeout)
+    child.join()
+    if "error" not in result and child.exitcode:
+        result = {"error": "child exited with code {0}".format(child.exitcode)}
+    result.update({"benchmark": name, "size": n, "requests": env.requests() - before})
+    if "error" not in result:
+        result["layers_per_second"] = result["layers"] / max(result["seconds"], 1e-9)
+    return result
+
+
+def print_results(results):
+    print("{0:<26} {1:>7} {2:>9} {3:>10} {4:>9} {5:>10}".format(
+            "benchmark", "layers", "seconds", "layers/s", "requests", "peak MB"))
+    for r in results:
+        if "error" in r:
+            print("{0:<26} {1:>7} failed: {2}".format(r["benchmark"], r["size"], r["error"]))
+            continue
+        print("{0:<26} {1:>7} {2:>9.3f} {3:>10.1f} {4:>9} {5:>10.1f}".format(
+                r["benchmark"], r["layers"], r["seconds"], r["layers_per_second"],
+                r["requests"], r["peak_rss_mb"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000],
+                        help="Layer counts to benchmark, default: 10 100 1000")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="Seconds of latency per fake CKAN/ArcGIS request, default: 0.005")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Worker threads for concurrent benchmarks, default: 8")
+    parser.add_argument("--only", nargs="+", metavar="BENCHMARK",
+                        choices=[b[0] for b in BENCHMARKS],
+                        help="Run only these benchmarks")
+    parser.add_argument("--json", metavar="FILE", help="Also write results to a JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show harvest output")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="Seconds before a benchmark run is abandoned, default: 600")
+    args = parser.parse_args(argv)
+
+    env = Environment(args.sizes, args.latency, args.workers)
+    results = []
+    for (name, bench, setup) in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        for n in args.sizes:
+            results.append(run_benchmark(env, name, bench, setup, n,
+                                         verbose=args.verbose, timeout=args.timeout))
+            print_results(results[-1:])
+    env.close()
+
+    print("")
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if any("error" in r for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
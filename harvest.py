@@ -0,0 +1,294 @@
+"""Run a harvest job headless, e.g. from cron.
+
+Reads a JSON job config (see `harvest_job_template.json`), fetches and converts
+all sources in parallel worker processes, then writes organisations, groups and
+datasets to the target CKAN from `secret.CKAN`, one source after the other in
+config order. Prints a summary and exits with status 1 if any source or dataset
+failed.
+
+Usage:
+    python harvest.py harvest_job.json
+    python harvest.py harvest_job.json --ckan ca --workers 6
+    python harvest.py harvest_job.json --resume 20151005T134148-4242
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import ckanapi
+
+import harvest_helpers as hh
+
+
+# Defaults of optional job config keys
+JOB_DEFAULTS = {
+    "workers": multiprocessing.cpu_count(),
+    "upsert_workers": 8,
+    "prefetch": True,
+    "prefetch_tag": "Harvested",
+    "skip_unchanged": True,
+    "capabilities_cache": "capabilities_cache",
+    "fallback_org_name": "lgate",
+    "organisations": None,
+    "pdfs": None,
+    "groups_from": None,
+    "state": None,
+    "mirror": None,
+    "ckan_limits": None,
+    "journal_dir": None,
+    "reap": None,
+    "report": None,
+    "prometheus": None,
+}
+
+# Defaults of the optional "reap" job config, see `harvest_helpers.reap_datasets`
+REAP_DEFAULTS = {
+    "dry_run": True,
+    "purge": False,
+    "max_fraction": 0.1,
+}
+
+# Defaults of optional source keys
+SOURCE_DEFAULTS = {
+    "format": "WMS",
+    "overwrite_metadata": False,
+    "drop_existing_resources": False,
+}
+
+
+def load_job(filename, ckan=None, workers=None, run_id=None):
+    """Return a job config from a JSON file with defaults filled in."""
+    with open(filename) as f:
+        job = json.load(f)
+    for (k, v) in JOB_DEFAULTS.items():
+        job.setdefault(k, v)
+    job["sources"] = [dict(SOURCE_DEFAULTS, **source) for source in job["sources"]]
+    if ckan:
+        job["ckan"] = ckan
+    if workers:
+        job["workers"] = workers
+    job["run_id"] = run_id or "{0}-{1}".format(time.strftime("%Y%m%dT%H%M%S"), os.getpid())
+    return job
+
+
+def source_name(source):
+    return source.get("source") or source.get("arcgis")
+
+
+def convert_source(args):
+    """Fetch and convert one source into package dicts, in a worker process.
+
+    Returns:
+        A result dict with the source "name", the layer "items"
+        (see `harvest_helpers.get_layer_items`), the elapsed "seconds",
+        an "error" message if the source failed, the URLs of "skipped" ArcGIS 
+        folders, services and layers which failed to read, and the worker's 
+        "metrics" (see `harvest_helpers.Metrics.snapshot`)
+    """
+    (source, job, ckan_config, orgs, groups, pdfs) = args
+    import secret
+    name = source_name(source)
+    # Pool workers convert several sources, report each one's metrics once
+    hh.metrics.reset()
+    start = time.time()
+    result = {"name": name, "items": [], "error": None, "skipped": []}
+    try:
+        ckan = ckanapi.RemoteCKAN(ckan_config["url"], apikey=ckan_config["key"])
+        if source.get("arcgis"):
+            arcgis = secret.ARCGIS[source["arcgis"]]
+            (dicts, skipped) = hh.get_arcgis_layer_dicts(
+                arcgis["url"], ckan, folders=arcgis.get("folders"),
+                fallback_org_name=job["fallback_org_name"])
+            result["items"] = [(None, None, d) for d in dicts]
+            result["skipped"] = skipped
+        else:
+            src = secret.SOURCES[source["source"]]
+            layers = hh.iter_capabilities_layers(src["proxy"], service=source["format"],
+                                                 cache_dir=job["capabilities_cache"])
+            result["items"] = hh.get_layer_items(layers, src["url"], ckan, orgs, groups, pdfs,
+                                                 res_format=source["format"],
+                                                 fallback_org_name=job["fallback_org_name"])
+    except Exception as e:
+        traceback.print_exc()
+        result["error"] = "{0}: {1}".format(type(e).__name__, e)
+    result["seconds"] = time.time() - start
+    result["metrics"] = hh.metrics.snapshot()
+    return result
+
+
+def source_urls(source):
+    """Return the URL prefixes of a source's datasets' resources.
+
+    ArcGIS sources harvest only their configured folders, if any.
+    """
+    import secret
+    if source.get("source"):
+        return [secret.SOURCES[source["source"]]["url"]]
+    arcgis = secret.ARCGIS[source["arcgis"]]
+    if arcgis.get("folders"):
+        return [os.path.join(arcgis["url"], folder) for folder in arcgis["folders"]]
+    return [arcgis["url"]]
+
+
+def reap(job, ckan, converted, catalogue=None):
+    """Reap the stale datasets of all job sources, unless a source failed to convert.
+
+    A source which skipped some folders, services or layers failed partially:
+    the datasets of the skipped layers would look stale.
+
+    Returns:
+        The summary of `harvest_helpers.reap_datasets`, or None if skipped
+    """
+    failed = [r["name"] for r in converted if r["error"] or r["skipped"]]
+    if failed:
+        print("[harvest] Not reaping stale datasets, sources failed: {0}".format(
+                ", ".join(failed)))
+        return None
+    names = hh.dataset_names(*[[d for (layer, updated, d) in r["items"]] for r in converted])
+    urls = [url for source in job["sources"] for url in source_urls(source)]
+    options = dict(REAP_DEFAULTS, **job["reap"])
+    return hh.reap_datasets(names, urls, ckan, catalogue=catalogue,
+                            tag=job["prefetch_tag"], **options)
+
+
+def run(job):
+    """Run a harvest job and return a summary dict."""
+    import secret
+    ckan_config = secret.CKAN[job["ckan"]]
+    ckan = ckanapi.RemoteCKAN(ckan_config["url"], apikey=ckan_config["key"])
+    print("[harvest] Using CKAN {0}".format(ckan.address))
+    hh.metrics.reset()
+    if job["ckan_limits"] is not None:
+        hh.configure_ckan_limits(**job["ckan_limits"])
+
+    orgs = dict()
+    if job["organisations"]:
+        orgs = hh.sync_orgs(hh.get_org_dict(job["organisations"]), ckan)
+    groups = dict()
+    if job["groups_from"]:
+        layers = hh.iter_capabilities_layers(secret.SOURCES[job["groups_from"]]["proxy"],
+                                             cache_dir=job["capabilities_cache"])
+        groups = hh.sync_groups(hh.get_group_dict(layers), ckan)
+    pdfs = hh.get_pdf_dict(job["pdfs"]) if job["pdfs"] else dict()
+
+    tasks = [(source, job, ckan_config, orgs, groups, pdfs) for source in job["sources"]]
+    print("[harvest] Converting {0} sources with {1} workers...".format(
+            len(tasks), job["workers"]))
+    pool = multiprocessing.Pool(max(1, min(job["workers"], len(tasks))))
+    try:
+        converted = pool.map(convert_source, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    for result in converted:
+        hh.metrics.merge(result.pop("metrics"))
+
+    state = hh.HarvestState(job["state"]) if job["state"] else None
+    journal = None
+    if job["journal_dir"]:
+        journal = hh.RunJournal(job["run_id"], job["journal_dir"])
+    package_index = None
+    mirror = hh.CatalogueMirror(ckan, job["mirror"]) if job["mirror"] else None
+    if mirror is not None:
+        mirror.refresh()
+        package_index = mirror.index(tag=job["prefetch_tag"])
+    elif job["prefetch"]:
+        package_index = hh.get_package_index(ckan, tag=job["prefetch_tag"])
+
+    summary = {"ckan": ckan.address, "run_id": job["run_id"], "sources": []}
+    for (source, result) in zip(job["sources"], converted):
+        s = {"name": result["name"], "error": result["error"], "skipped": result["skipped"],
+             "convert_seconds": result["seconds"], "layers": len(result["items"]),
+             "created": 0, "updated": 0, "unchanged": 0, "resumed": 0, "failed": []}
+        summary["sources"].append(s)
+        if result["error"]:
+            continue
+        if state is not None and source.get("source"):
+            url = secret.SOURCES[source["source"]]["url"]
+            dicts = state.select(url, result["items"])
+        else:
+            dicts = [d for (layer, updated, d) in result["items"]]
+        start = time.time()
+        upserted = hh.upsert_datasets_concurrently(
+            dicts, ckan, workers=job["upsert_workers"],
+            overwrite_metadata=source["overwrite_metadata"],
+            drop_existing_resources=source["drop_existing_resources"],
+            package_index=package_index, skip_unchanged=job["skip_unchanged"],
+            state=state, journal=journal)
+        s["upsert_seconds"] = time.time() - start
+        for action in ("created", "updated", "unchanged", "resumed"):
+            s[action] = len(upserted[action])
+        s["failed"] = upserted["failed"]
+    if state is not None:
+        state.close()
+    if mirror is not None:
+        mirror.refresh()
+        mirror.close()
+
+    if job["reap"] is not None:
+        summary["reap"] = reap(job, ckan, converted, catalogue=package_index)
+
+    summary["ok"] = not any(s["error"] or s["skipped"] or s["failed"] 
+                            for s in summary["sources"])
+    if summary.get("reap"):
+        summary["ok"] = summary["ok"] and not (summary["reap"]["refused"] or
+                                               summary["reap"]["failed"])
+    if journal is not None:
+        if summary["ok"]:
+            journal.complete()
+        else:
+            journal.compact()
+        journal.close()
+    if job["report"]:
+        hh.write_run_report(job["report"], summary=summary, ckan_limits=hh.ckan_limit_stats())
+    if job["prometheus"]:
+        hh.write_prometheus_textfile(job["prometheus"])
+    return summary
+
+
+def print_summary(summary):
+    print("\n[harvest] Summary for {0}, run {1}".format(summary["ckan"], summary["run_id"]))
+    print("{0:<24} {1:>7} {2:>8} {3:>8} {4:>10} {5:>8} {6:>7}".format(
+            "source", "layers", "created", "updated", "unchanged", "resumed", "failed"))
+    for s in summary["sources"]:
+        if s["error"]:
+            print("{0:<24} failed: {1}".format(s["name"], s["error"]))
+            continue
+        print("{0:<24} {1:>7} {2:>8} {3:>8} {4:>10} {5:>8} {6:>7}".format(
+                s["name"], s["layers"], s["created"], s["updated"], s["unchanged"],
+                s["resumed"], len(s["failed"])))
+        for url in s["skipped"]:
+            print("  skipped {0}".format(url))
+        for failure in s["failed"]:
+            print("  {0}: {1}".format(failure["name"], failure["error"]))
+    reaped = summary.get("reap")
+    if reaped:
+        print("[harvest] {0} of {1} harvested datasets stale, {2} deleted{3}".format(
+                len(reaped["stale"]), reaped["datasets"], len(reaped["deleted"]),
+                ", refused" if reaped["refused"] else ""))
+    print("[harvest] {0}".format("Done." if summary["ok"] else "Finished with errors."))
+    if not summary["ok"]:
+        print("[harvest] Resume with --resume {0}".format(summary["run_id"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("job", help="The JSON job config")
+    parser.add_argument("--ckan", help="The target CKAN key in secret.CKAN, overrides the job's")
+    parser.add_argument("--workers", type=int,
+                        help="The number of worker processes, overrides the job's")
+    parser.add_argument("--resume", metavar="RUN_ID",
+                        help="Resume a run, skipping datasets done before (needs journal_dir)")
+    args = parser.parse_args(argv)
+
+    summary = run(load_job(args.job, ckan=args.ckan, workers=args.workers, run_id=args.resume))
+    print_summary(summary)
+    return 0 if summary["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,485 @@
+import bisect
 import ckanapi
+from ckanapi import NotFound, ValidationError
 import csv
+from email.utils import parsedate_tz, mktime_tz
+from collections import namedtuple, OrderedDict
 from datetime import datetime
+import functools
+import hashlib
 import json
+import math
+from multiprocessing.pool import ThreadPool
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import os
 from owslib.wms import WebMapService
 from owslib.wfs import WebFeatureService
 from pyproj import Proj, transform
+try:
+    from pyproj import Transformer
+except ImportError:
+    # pyproj < 2.1
+    Transformer = None
 import re
 from slugify import slugify
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+try:
+    from urlparse import urlsplit, urlunsplit, parse_qsl
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+#-------------------------------------------------------------------------------------#
+# Instrumentation
+#-------------------------------------------------------------------------------------#
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics(object):
+    """A thread-safe registry of timing spans and counters of a harvest run
+    
+    Spans and counters are keyed by name and endpoint (e.g. a host name).
+    Each span keeps its count, total, min and max seconds and a latency histogram.
+    
+    Example:
+    metrics.reset()
+    l_wmsP = get_layer_dict(wmsP, wmsP_url, ckan, orgs, groups, pdfs)
+    p_wmsP = upsert_datasets(l_wmsP, ckan)
+    write_run_report("harvest_report.json")
+    write_prometheus_textfile("/var/lib/node_exporter/textfile/harvest.prom")
+    """
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """Drop all spans and counters and restart the run clock"""
+        with self.lock:
+            self.started = time.time()
+            self.spans = dict()
+            self.counters = dict()
+    
+    def observe(self, name, seconds, endpoint=None):
+        """Record one span of a duration in seconds"""
+        key = (name, endpoint or "")
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            s = self.spans.get(key)
+            if s is None:
+                s = self.spans[key] = {"count": 0, "total": 0.0, "min": seconds, 
+                                       "max": seconds, "buckets": [0] * (len(self.buckets) + 1)}
+            s["count"] += 1
+            s["total"] += seconds
+            s["min"] = min(s["min"], seconds)
+            s["max"] = max(s["max"], seconds)
+            s["buckets"][bucket] += 1
+    
+    def count(self, name, endpoint=None, n=1):
+        """Increment a counter"""
+        key = (name, endpoint or "")
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+    
+    def snapshot(self):
+        """Return a picklable copy of all spans and counters, see `merge`"""
+        with self.lock:
+            return {"spans": dict((k, dict(s, buckets=list(s["buckets"]))) 
+                                  for (k, s) in self.spans.items()),
+                    "counters": dict(self.counters)}
+    
+    def merge(self, snapshot):
+        """Add the spans and counters of a `snapshot`, e.g. from a worker process"""
+        with self.lock:
+            for (key, other) in snapshot["spans"].items():
+                s = self.spans.get(key)
+                if s is None:
+                    self.spans[key] = dict(other, buckets=list(other["buckets"]))
+                    continue
+                s["count"] += other["count"]
+                s["total"] += other["total"]
+                s["min"] = min(s["min"], other["min"])
+                s["max"] = max(s["max"], other["max"])
+                s["buckets"] = [x + y for (x, y) in zip(s["buckets"], other["buckets"])]
+            for (key, n) in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + n
+    
+    def report(self):
+        """Return all spans and counters as a JSON-serialisable dict"""
+        with self.lock:
+            spans = [dict(s, span=k[0], endpoint=k[1], mean=s["total"] / s["count"],
+                          buckets=dict(zip([str(b) for b in self.buckets] + ["+Inf"], 
+                                           s["buckets"])))
+                     for (k, s) in sorted(self.spans.items())]
+            counters = [{"counter": k[0], "endpoint": k[1], "count": v} 
+                        for (k, v) in sorted(self.counters.items())]
+            started = self.started
+        return {"started": datetime.fromtimestamp(started).strftime("%Y-%m-%dT%H:%M:%S"),
+                "duration": time.time() - started, "spans": spans, "counters": counters}
+    
+    def prometheus(self, prefix="harvest"):
+        """Return all spans and counters in the Prometheus text exposition format"""
+        def labels(**kwargs):
+            return ",".join('{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace(
+                    '"', '\\"').replace("\n", "\\n")) for (k, v) in sorted(kwargs.items()))
+        
+        lines = ["# HELP {0}_span_seconds Time spent in harvest stages and requests".format(prefix),
+                 "# TYPE {0}_span_seconds histogram".format(prefix)]
+        with self.lock:
+            for ((name, endpoint), s) in sorted(self.spans.items()):
+                cumulative = 0
+                for (le, n) in zip([repr(float(b)) for b in self.buckets] + ["+Inf"], s["buckets"]):
+                    cumulative += n
+                    lines.append("{0}_span_seconds_bucket{{{1}}} {2}".format(
+                            prefix, labels(span=name, endpoint=endpoint, le=le), cumulative))
+                lines.append("{0}_span_seconds_sum{{{1}}} {2!r}".format(
+                        prefix, labels(span=name, endpoint=endpoint), s["total"]))
+                lines.append("{0}_span_seconds_count{{{1}}} {2}".format(
+                        prefix, labels(span=name, endpoint=endpoint), s["count"]))
+            lines += ["# HELP {0}_events_total Harvest events".format(prefix),
+                      "# TYPE {0}_events_total counter".format(prefix)]
+            for ((name, endpoint), n) in sorted(self.counters.items()):
+                lines.append("{0}_events_total{{{1}}} {2}".format(
+                        prefix, labels(event=name, endpoint=endpoint), n))
+            lines += ["# HELP {0}_run_start_seconds Start of the harvest run".format(prefix),
+                      "# TYPE {0}_run_start_seconds gauge".format(prefix),
+                      "{0}_run_start_seconds {1!r}".format(prefix, self.started)]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Span(object):
+    """Time a block into `metrics` and count its errors as "<name>_errors"
+    
+    Example:
+    with Span("capabilities_fetch", "www2.landgate.wa.gov.au"):
+        wms = WebMapService(url)
+    """
+    
+    def __init__(self, name, endpoint=None):
+        self.name = name
+        self.endpoint = endpoint
+    
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        metrics.observe(self.name, time.time() - self.start, self.endpoint)
+        if exc_type is not None:
+            metrics.count(self.name + "_errors", self.endpoint)
+        return False
+
+
+def timed(name):
+    """Return a decorator timing each call of a function as `Span` name"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with Span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def url_host(url):
+    """Return the host of a URL, the endpoint label of spans"""
+    return urlsplit(url or "").netloc.lower()
+
+
+def ckan_action(ckan, action, **kwargs):
+    """Call a ckanapi action, timed as `Span` "ckan_<action>" of the CKAN's host
+    
+    Calls wait for the host's adaptive limit, and overloaded calls are retried,
+    see `configure_ckan_limits`.
+    
+    Example:
+    ckan_action(ckan, "package_show", id="ramsar-sites")
+    
+    Arguments:
+        ckan (ckanapi.RemoteCKAN) An instance of ckanapi.RemoteCKAN
+        action (String) The action name
+        kwargs The action's data dict
+    
+    Returns:
+        The action's result
+    """
+    host = url_host(getattr(ckan, "address", None))
+    limit = get_ckan_limit(host)
+    _hook_ckan_session(ckan)
+    retry = 0
+    while True:
+        started = limit.acquire()
+        _ckan_response.status = None
+        _ckan_response.retry_after = None
+        overloaded = False
+        retry_after = None
+        try:
+            with Span("ckan_" + action, host):
+                return getattr(ckan.action, action)(**kwargs)
+        except Exception as e:
+            status = _ckan_response.status
+            overloaded = (status in OVERLOAD_STATUS or isinstance(
+                    e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)))
+            if overloaded:
+                metrics.count("ckan_overloaded", host)
+                retry_after = parse_retry_after(_ckan_response.retry_after)
+                if retry_after is not None:
+                    retry_after = min(retry_after, _ckan_max_retry_after)
+            if (not overloaded or retry >= _ckan_retries or 
+                    (action.endswith("_create") and status not in UNPROCESSED_STATUS)):
+                raise
+        finally:
+            limit.release(action, started, overloaded, retry_after)
+        retry += 1
+        metrics.count("ckan_retries", host)
+        if retry_after is None:
+            time.sleep(_ckan_backoff_factor * 2 ** (retry - 1))
+
+
+def write_run_report(path, **extra):
+    """Write `metrics.report()`, updated with any extra keys, as JSON run report"""
+    report = metrics.report()
+    report.update(extra)
+    _write_atomic(path, json.dumps(report, indent=2, sort_keys=True), mode="w")
+
+
+def write_prometheus_textfile(path, prefix="harvest"):
+    """Write `metrics` as Prometheus textfile for the node exporter's textfile collector
+    
+    The file is written atomically, so the collector never reads a partial file.
+    """
+    _write_atomic(path, metrics.prometheus(prefix), mode="w")
+
+
+#-------------------------------------------------------------------------------------#
+# CKAN Rate Limiting
+#-------------------------------------------------------------------------------------#
+# HTTP status codes of an overloaded CKAN, retried after a backoff
+OVERLOAD_STATUS = (429, 502, 503, 504)
+
+# HTTP status codes of requests CKAN has not processed, the only ones retried for creates
+UNPROCESSED_STATUS = (429, 503)
+
+
+class AdaptiveLimit(object):
+    """An adaptive concurrency limit of the calls to one target, e.g. one CKAN host
+    
+    Calls beyond the limit wait for a free slot. Limits adapt AIMD-style: 
+    each successful call raises the limit by 1/limit, i.e. by one per round of 
+    `limit` calls, up to `max_limit`. An overloaded response (see `OVERLOAD_STATUS`), 
+    a connection error, or a call taking longer than `slow_factor` times the 
+    typical latency of its action multiplies the limit by `decrease`, down to 
+    `min_limit`, at most once per round trip: only calls started after the last 
+    decrease can decrease it again. A `Retry-After` delay holds all new calls.
+    
+    Arguments:
+        initial (float) The initial limit, default: 4
+        min_limit (int) The lowest limit, default: 1
+        max_limit (int) The highest limit, default: 32
+        decrease (float) The multiplicative decrease, default: 0.5
+        slow_factor (float) The latency over typical latency which counts as 
+            overloaded, default: 3
+        min_slow (float) The latency in seconds below which no call counts as slow,
+            default: 0.5
+        max_rate (float) The maximum number of calls per second, default: None (no cap)
+    """
+    
+    def __init__(self, initial=4, min_limit=1, max_limit=32, decrease=0.5, 
+                 slow_factor=3.0, min_slow=0.5, max_rate=None):
+        self.cond = threading.Condition()
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.slow_factor = slow_factor
+        self.min_slow = min_slow
+        self.max_rate = max_rate
+        self.inflight = 0
+        self.hold_until = 0.0
+        self.next_start = 0.0
+        self.last_decrease = 0.0
+        self.latency = dict()
+        self.stats = {"calls": 0, "overloaded": 0, "slow": 0, "decreases": 0, 
+                      "held_seconds": 0.0, "peak_limit": self.limit, "low_limit": self.limit}
+    
+    def acquire(self):
+        """Wait for a free slot, and return the time the call starts"""
+        with self.cond:
+            while True:
+                now = time.time()
+                wait = max(self.hold_until, self.next_start) - now
+                if wait <= 0 and self.inflight < int(self.limit):
+                    break
+                self.cond.wait(wait if wait > 0 else None)
+            self.inflight += 1
+            if self.max_rate:
+                self.next_start = now + 1.0 / self.max_rate
+            return now
+    
+    def release(self, action, started, overloaded=False, retry_after=None):
+        """Free a slot and adapt the limit to the outcome of a call
+        
+        Arguments:
+            action (String) The action name, which keeps its own typical latency
+            started (float) The start time returned by `acquire`
+            overloaded (Boolean) Whether the target responded as overloaded
+            retry_after (float) The seconds to hold all new calls, optional
+        """
+        with self.cond:
+            now = time.time()
+            seconds = now - started
+            self.inflight -= 1
+            self.stats["calls"] += 1
+            if retry_after:
+                hold_until = now + retry_after
+                self.stats["held_seconds"] += max(0.0, hold_until - max(self.hold_until, now))
+                self.hold_until = max(self.hold_until, hold_until)
+            
+            (typical, samples) = self.latency.get(action, (None, 0))
+            slow = (not overloaded and samples >= 5 and 
+                    seconds > max(self.min_slow, self.slow_factor * typical))
+            if not overloaded:
+                typical = seconds if typical is None else 0.9 * typical + 0.1 * seconds
+                self.latency[action] = (typical, samples + 1)
+            
+            if overloaded or slow:
+                self.stats["overloaded" if overloaded else "slow"] += 1
+                if started >= self.last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.last_decrease = now
+                    self.stats["decreases"] += 1
+                    self.stats["low_limit"] = min(self.stats["low_limit"], self.limit)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self.stats["peak_limit"] = max(self.stats["peak_limit"], self.limit)
+            self.cond.notify_all()
+    
+    def report(self):
+        """Return the current limit and counters as a JSON-serialisable dict"""
+        with self.cond:
+            return dict(self.stats, limit=self.limit, inflight=self.inflight)
+
+
+_ckan_limits = dict()
+_ckan_limits_lock = threading.Lock()
+_ckan_limit_args = dict()
+_ckan_retries = 3
+_ckan_backoff_factor = 0.5
+_ckan_max_retry_after = 300
+_ckan_response = threading.local()
+
+
+def configure_ckan_limits(retries=3, backoff_factor=0.5, max_retry_after=300, **kwargs):
+    """Configure the adaptive limits and retries of all CKAN calls made through `ckan_action`
+    
+    Each CKAN host gets its own `AdaptiveLimit`. Calls answered as overloaded 
+    (see `OVERLOAD_STATUS`) or failing to connect are retried after the response's 
+    `Retry-After`, or else after an exponential backoff of 
+    `backoff_factor * 2^(retry - 1)` seconds. Create actions are only retried if 
+    CKAN has not processed them (see `UNPROCESSED_STATUS`).
+    
+    With adaptive limits, pass more workers to e.g. `upsert_datasets_concurrently`
+    than the catalogue can take, and the limit finds the concurrency it absorbs.
+    
+    Arguments:
+        retries (int) Maximum number of retries per call, default: 3
+        backoff_factor (float) Backoff factor in seconds, default: 0.5
+        max_retry_after (float) The longest `Retry-After` in seconds to honour, default: 300
+        kwargs Arguments to `AdaptiveLimit`, e.g. max_limit=16 or max_rate=20
+    """
+    global _ckan_retries, _ckan_backoff_factor, _ckan_max_retry_after, _ckan_limit_args
+    with _ckan_limits_lock:
+        _ckan_retries = retries
+        _ckan_backoff_factor = backoff_factor
+        _ckan_max_retry_after = max_retry_after
+        _ckan_limit_args = kwargs
+        _ckan_limits.clear()
+
+
+def get_ckan_limit(host):
+    """Return the `AdaptiveLimit` of a CKAN host, creating it if required"""
+    with _ckan_limits_lock:
+        limit = _ckan_limits.get(host)
+        if limit is None:
+            limit = _ckan_limits[host] = AdaptiveLimit(**_ckan_limit_args)
+        return limit
+
+
+def ckan_limit_stats():
+    """Return the `AdaptiveLimit.report` of each CKAN host"""
+    with _ckan_limits_lock:
+        limits = list(_ckan_limits.items())
+    return dict((host, limit.report()) for (host, limit) in limits)
+
+
+def parse_retry_after(value, now=None):
+    """Return the seconds to wait from a `Retry-After` header, or None
+    
+    >>> parse_retry_after("120")
+    120.0
+    >>> parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT", now=1445412470)
+    10.0
+    >>> parse_retry_after("soon") is None
+    True
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        seconds = float(mktime_tz(parsed)) - (time.time() if now is None else now)
+    return max(0.0, seconds)
+
+
+def _record_ckan_response(response, *args, **kwargs):
+    """A requests response hook keeping the last CKAN response's status per thread"""
+    _ckan_response.status = response.status_code
+    _ckan_response.retry_after = response.headers.get("Retry-After")
+
+
+def _hook_ckan_session(ckan):
+    """Make sure a ckanapi.RemoteCKAN's session records its responses"""
+    if not hasattr(ckan, "session"):
+        return
+    session = ckan.session
+    if session is not None and _record_ckan_response in session.hooks["response"]:
+        return
+    with _ckan_limits_lock:
+        if ckan.session is None:
+            ckan.session = requests.Session()
+        hooks = ckan.session.hooks["response"]
+        if _record_ckan_response not in hooks:
+            hooks.append(_record_ckan_response)
 
 
 #-------------------------------------------------------------------------------------#
@@ -46,6 +517,12 @@ def parse_name(text, debug=False):
             Misc Transport (Point) (Lgate-037) (18-10-2012 16:54:00)
     Returns:
         A tuple of (layer title, id, published date)
+        The published date defaults to the current datetime if missing,
+        as an `EstimatedDate`.
+    
+    Results are kept in an LRU cache of PARSE_NAME_CACHE_SIZE titles, as WMS
+    and WFS sources share most titles. With debug=True, parsing bypasses
+    the cache and explains each step.
     
     Examples:
     
@@ -117,6 +594,105 @@ def parse_name(text, debug=False):
       name: None
       date: 2015-10-08T17:14:42
     """
+    if debug:
+        (t, n, dt) = _parse_name_legacy(text, debug=True)
+    else:
+        (t, n, dt) = _parse_name_cached(text)
+    return (t, n, dt or EstimatedDate(_now_iso()))
+
+
+def parse_names(titles):
+    """Return parse_name(title) for each title in titles
+    
+    Titles without a date get the same current datetime as an `EstimatedDate`.
+    
+    Arguments:
+        titles (iterable) Layer titles as accepted by `parse_name`
+    
+    Returns:
+        A list of tuples of (layer title, id, published date)
+    """
+    now = EstimatedDate(_now_iso())
+    return [(t, n, dt or now) for (t, n, dt) in (_parse_name_cached(x) for x in titles)]
+
+
+# "LAYER NAME (OPTIONAL EXTRAS) (LAYER ID) (DD-MM-YYYY HH:MM:SS)", date optional
+_NAME_RE = re.compile(r"^\s*(\S.*?)\s+\(([^\s()]+)\)"
+                      r"(?:\s+\(([0-9]{2})-([0-9]{2})-([0-9]{4})"
+                      r"\s+([0-9]{2}):([0-9]{2}):([0-9]{2})\))?\s*$", re.DOTALL)
+# A lower case letter glued to an opening parenthesis, see `_parse_name_legacy`
+_NAME_PAREN_RE = re.compile(r"[a-z]\(")
+
+PARSE_NAME_CACHE_SIZE = 20000
+_parsed_names = OrderedDict()
+_parsed_names_lock = threading.Lock()
+
+
+def _now_iso():
+    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+
+class EstimatedDate(str):
+    """An ISO datetime String standing in for a missing date, see `parse_name`
+    
+    Package fields holding an EstimatedDate change on every harvest without
+    a change of content, and are not compared by `package_fingerprint`.
+    """
+    __slots__ = ()
+
+
+def _native_str(text):
+    """Return text as UTF-8 encoded str on Python 2, unchanged on Python 3"""
+    return text.encode("utf-8") if str is bytes else text
+
+
+def _parse_name_cached(text):
+    """Return (title, name, date or None) of a layer title from an LRU cache
+    
+    Titles are parsed with one precompiled regex. Titles it does not match,
+    or with an invalid date, are parsed by `_parse_name_legacy`.
+    Missing dates are returned as None, so that no current datetime gets cached.
+    """
+    with _parsed_names_lock:
+        if text in _parsed_names:
+            result = _parsed_names.pop(text)
+            _parsed_names[text] = result
+            return result
+    
+    result = None
+    fixed = _NAME_PAREN_RE.sub(u" (", text)
+    m = _NAME_RE.match(fixed)
+    if m:
+        (title, name, day, month, year, hh, mm, ss) = m.groups()
+        try:
+            dt = None
+            if year:
+                datetime(int(year), int(month), int(day), int(hh), int(mm), int(ss))
+                dt = str("{0}-{1}-{2}T{3}:{4}:{5}".format(year, month, day, hh, mm, ss))
+            result = (" ".join(_native_str(title).split()), _native_str(name).lower(), dt)
+        except ValueError:
+            pass
+    elif "(" not in fixed and ")" not in fixed:
+        # No layer ID, and no date unless the last part has a time
+        p = _native_str(fixed).split()
+        if len(p) > 1 and ":" not in p[-1]:
+            result = (" ".join(p), None, None)
+    if result is None:
+        result = _parse_name_legacy(text)
+    
+    with _parsed_names_lock:
+        _parsed_names[text] = result
+        while len(_parsed_names) > PARSE_NAME_CACHE_SIZE:
+            _parsed_names.popitem(last=False)
+    return result
+
+
+def _parse_name_legacy(text, debug=False):
+    """Split a layer title token by token, see `parse_name`
+    
+    Returns:
+        A tuple of (layer title, id, published date or None if missing)
+    """
     if debug:
         print("INPUT\n  text: {0}".format(text.encode('utf-8')))
 
@@ -127,7 +703,7 @@ def parse_name(text, debug=False):
     
     # Assert that there's whitespace before opening parentheses
     # Looking at you, "Overview Rivers(LGATE-053) (14-05-2008 17:59:05)":
-    text = re.sub(r"[a-z]\(", u" (", text)
+    text = _NAME_PAREN_RE.sub(u" (", text)
     
     p = text.encode('utf-8').split()
     
@@ -158,7 +734,7 @@ def parse_name(text, debug=False):
     if set_dummy_date:
         if debug:
             print("  No valid date found, inserting current datetime as replacement")
-        dt = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        dt = None
     
     if p[-1].endswith(")"):
         n = p[-chop_off].replace("(", "").replace(")","").lower()
@@ -170,7 +746,7 @@ def parse_name(text, debug=False):
             
     t = " ".join(p[0:len(p)-chop_off])
     if debug:
-        print("OUTPUT\n  title: {0}\n  name: {1}\n  date: {2}".format(t, n, dt))
+        print("OUTPUT\n  title: {0}\n  name: {1}\n  date: {2}".format(t, n, dt or _now_iso()))
     return (t, n, dt)
 
 
@@ -192,8 +768,44 @@ def bboxWGS84_to_gjMP(bbox):
         return ""
         
 
+# The constant text of all datasets of a source, shared by their package dicts.
+# "notes" and "description" (of the WxS resource) are formatted with the layer name.
+SLIP_TEMPLATE = {
+    "tags": ("SLIP Classic", "Harvested"),
+    "notes": u"The dataset _{0}_ has been sourced from Landgate's "
+             u"Shared Location Information Platform (SLIP) - the home for Western"
+             u" Australian government geospatial data.\n\nMany of the datasets in"
+             u" SLIP are free and publicly available to users who simply "
+             u"[sign up for a SLIP account](https://www2.landgate.wa.gov.au/web/guest"
+             u"/request-registration-type).\n\nFind out more about SLIP at "
+             u"[http://slip.landgate.wa.gov.au/](http://slip.landgate.wa.gov.au/).",
+    "description": u"when prompted, use your [SLIP](https://www2.landgate.wa.gov.au/"
+                   u"web/guest/how-to-access-slip-services) "
+                   u"username and password to preview the resource below "
+                   u"or open the resource URL in a GIS application (e.g. QGIS or ArcGIS) "
+                   u"as layer _{0}_.",
+    "data_portal": "http://slip.landgate.wa.gov.au/",
+    "license_title": "Other (Open)",
+    "license_id": "other-open",
+    "maintainer": "Landgate",
+    "maintainer_email": "customerservice@landgate.wa.gov.au",
+    "update_frequency": "frequent",
+}
+
+KMI_TEMPLATE = {
+    "tags": ("Knowledge Management Initiative", "KMI", "Harvested"),
+    "data_portal": "http://kmi.dpaw.wa.gov.au/geoserver/web/",
+    "license_id": "cc-by-sa",
+    "maintainer": "Marine Data Manager",
+    "maintainer_email": "marinedatarequests@dpaw.wa.gov.au",
+    "update_frequency": "frequent",
+}
+
+
+@timed("wxs_to_dict")
 def wxs_to_dict(layer, wxs_url, org_dict, group_dict, pdf_dict, 
-                fallback_org_id=None, res_format="WMS", debug=False):
+                fallback_org_id=None, res_format="WMS", debug=False, 
+                template=SLIP_TEMPLATE):
     '''Convert a WMS layer into a dict of a datawagovau-schema CKAN package.
 
     This function is highly customised to harvesting 
@@ -248,7 +860,8 @@ def wxs_to_dict(layer, wxs_url, org_dict, group_dict, pdf_dict,
     
 
     Arguments:
-        layer (owslib.wms.ContentMetadata): A WMS object content layer
+        layer (CapabilitiesLayer): A layer record (see `layer_record`) or an
+            owslib.wms.ContentMetadata
         wms_url (String): The resource URL for WMS layers
         wfs (owslib.wfs.WebFeatureService): An owslib WFS object
         wfs_url (String): The resource URL for WFS layers
@@ -258,6 +871,7 @@ def wxs_to_dict(layer, wxs_url, org_dict, group_dict, pdf_dict,
         fallback_org_id (String): The CKAN ID of the fallback owner organisation
         res_format (String): The resource format (WMS, WFS, WPS, WCS), default: WMS
         debug (Boolean): Debug noise level
+        template (dict): The constant text of the source, default: `SLIP_TEMPLATE`
         
     Returns:
         dict: A dictionary ready for ckanapi's package_update
@@ -290,7 +904,7 @@ def wxs_to_dict(layer, wxs_url, org_dict, group_dict, pdf_dict,
     ds_NAME = ds_name.upper()
     
     # Theme, Keywords and Group (only from WMS parent layer)
-    d["tag_string"] = ["SLIP Classic", "Harvested"]
+    d["tag_string"] = list(template["tags"])
     try:
         p = layer.parent.title
         
@@ -327,39 +941,27 @@ def wxs_to_dict(layer, wxs_url, org_dict, group_dict, pdf_dict,
         owner_org_contact = ""
         owner_org_jurisdiction = "Western Australia (default)"
     
-    slip_description = u"when prompted, use your [SLIP](https://www2.landgate.wa.gov.au/"+\
-    u"web/guest/how-to-access-slip-services) "+\
-    u"username and password to preview the resource below "+\
-    u"or open the resource URL in a GIS application (e.g. QGIS or ArcGIS) as layer _{0}_.".format(ds_NAME)
-
     d["name"] = slugify(ds_title)
     d["title"] = ds_title
     #d["doi"] = ""
     #d["citation"] = ""
-    d["notes"] = u"The dataset _{0}_ has".format(ds_NAME) +\
-    " been sourced from Landgate's " +\
-    u"Shared Location Information Platform (SLIP) - the home for Western" +\
-    u" Australian government geospatial data.\n\nMany of the datasets in" +\
-    u" SLIP are free and publicly available to users who simply " +\
-    u"[sign up for a SLIP account](https://www2.landgate.wa.gov.au/web/guest" +\
-    u"/request-registration-type).\n\nFind out more about SLIP at " +\
-    u"[http://slip.landgate.wa.gov.au/](http://slip.landgate.wa.gov.au/)."
+    d["notes"] = template["notes"].format(ds_NAME)
     
     d["owner_org"] =  owner_org_id
     
-    d["data_portal"] = "http://slip.landgate.wa.gov.au/"
+    d["data_portal"] = template["data_portal"]
     d["data_homepage"] = ""
-    d["license_title"] = "Other (Open)"
-    d["license_id"] = "other-open"
+    d["license_title"] = template["license_title"]
+    d["license_id"] = template["license_id"]
     d["author"] = owner_org_title
     d["author_email"] = owner_org_contact
-    d["maintainer_email"] = "customerservice@landgate.wa.gov.au"
-    d["maintainer"] = "Landgate"
+    d["maintainer_email"] = template["maintainer_email"]
+    d["maintainer"] = template["maintainer"]
     d["private"] = False
     d["spatial"] = bboxWGS84_to_gjMP(layer.boundingBoxWGS84)
     d["published_on"] = date_pub
     d["last_updated_on"] = date_pub
-    d["update_frequency"] = "frequent"
+    d["update_frequency"] = template["update_frequency"]
     #d["data_temporal_extent_begin"] = ""
     #d["data_temporal_extent_end"] = ""
 
@@ -380,7 +982,7 @@ def wxs_to_dict(layer, wxs_url, org_dict, group_dict, pdf_dict,
         
     # Attach WMS/WFS endpoint as resource
     r = dict()
-    r["description"] = slip_description
+    r["description"] = template["description"].format(ds_NAME)
     r["format"] = res_format.lower()
     r["name"] = "{0} ({1}) {2}".format(ds_title, ds_NAME, res_format.upper())
     r["url"] = wxs_url
@@ -396,21 +998,107 @@ def wxs_to_dict(layer, wxs_url, org_dict, group_dict, pdf_dict,
 
 
 
+def list_all(ckanapi, list_action, page_size=25, **kwargs):
+    """Return all results of a paged CKAN `*_list` action such as `organization_list`.
+    
+    CKAN caps `organization_list` and `group_list` with `all_fields=True` at
+    `ckan.group_and_organization_list_all_fields_max` (default: 25) results,
+    so this pages through them with `limit` and `offset`.
+    
+    Arguments:
+        ckanapi (ckanapi) A ckanapi instance with at least read permission
+        list_action (String) The CKAN action name, e.g. "organization_list"
+        page_size (int) The number of results per request, default: 25
+        kwargs Further arguments to the action, e.g. `all_fields=True`
+    
+    Returns:
+        A list of results
+    """
+    results = []
+    seen = set()
+    offset = 0
+    while True:
+        page = ckan_action(ckanapi, list_action, limit=page_size, offset=offset, **kwargs)
+        keys = [x["name"] if isinstance(x, dict) else x for x in page]
+        # Older CKANs ignore limit and offset and return everything at once
+        new = [x for (x, k) in zip(page, keys) if k not in seen]
+        seen.update(keys)
+        results.extend(new)
+        if len(page) < page_size or not new:
+            break
+        offset += page_size
+    return results
+
+
+class OrgResolver(object):
+    """Resolve GeoServer workspace prefixes to CKAN organisation ids from one 
+    `organization_list` request.
+    
+    Unknown prefixes are remembered and resolved to the fallback organisation.
+    
+    Example:
+    resolve = OrgResolver(ckan, fallback_org_name="dpaw")
+    resolve("landscape")
+    u'c5e1a7c2-...'
+    """
+    def __init__(self, ckan, fallback_org_name=None, debug=False):
+        """Fetch all organisations of a CKAN.
+        
+        Arguments:
+            ckan (ckanapi) A ckanapi instance with at least read permission
+            fallback_org_name (String) The CKAN org name for unknown prefixes, optional
+            debug (Boolean) Debug noise level
+        """
+        orgs = list_all(ckan, "organization_list", all_fields=True)
+        self.orgs = dict((o["name"], o) for o in orgs)
+        self.unknown = set()
+        self.debug = debug
+        self.fallback_org_id = None
+        if fallback_org_name:
+            fallback = self.orgs.get(fallback_org_name, None)
+            if fallback is None:
+                fallback = ckan_action(ckan, "organization_show", id=fallback_org_name)
+            self.fallback_org_id = fallback["id"]
+        print("[OrgResolver] Found {0} organisations".format(len(self.orgs)))
+
+    def __call__(self, org_name, fallback_org_id=None):
+        """Return the CKAN organisation id for an organisation name or 
+        workspace prefix, or the fallback organisation id.
+        """
+        org = self.orgs.get(org_name, None) or self.orgs.get(org_name.lower(), None)
+        if org is not None:
+            return org["id"]
+        if org_name not in self.unknown:
+            self.unknown.add(org_name)
+            if self.debug:
+                print("[OrgResolver] Unknown organisation {0}, using fallback".format(org_name))
+        return fallback_org_id or self.fallback_org_id
+
+
+@timed("gs28_to_ckan")
 def gs28_to_ckan(layer, wxs_url, ckan, 
-                 fallback_org_id=None, res_format="WMS", debug=False):
+                 fallback_org_id=None, res_format="WMS", debug=False, 
+                 org_resolver=None, template=KMI_TEMPLATE):
     """Convert a GeoServer 2.8 WMS layer into a dict of a datawagovau-schema CKAN package.
     
     This function is tailored towards kmi.dpaw.wa.gov.au's implementation.
+    The owner organisation is the CKAN organisation named like the layer's 
+    workspace prefix. Pass an `OrgResolver` as `org_resolver` to look it up 
+    without a request per layer. The constant text comes from `template`,
+    default: `KMI_TEMPLATE`.
     """
 
     d = dict()
     
     org_name = layer.name.split(":")[0]
-    try:
-        owner_org = ckan.action.organization_show(id=org_name)
-        owner_org_id = owner_org["id"]
-    except NotFound:
-        owner_org_id = fallback_org_id
+    if org_resolver is not None:
+        owner_org_id = org_resolver(org_name, fallback_org_id)
+    else:
+        try:
+            owner_org = ckan_action(ckan, "organization_show", id=org_name)
+            owner_org_id = owner_org["id"]
+        except NotFound:
+            owner_org_id = fallback_org_id
 
     d["name"] = slugify(layer.name)
     d["title"] = layer.title
@@ -418,19 +1106,19 @@ def gs28_to_ckan(layer, wxs_url, ckan,
     #d["citation"] = ""
     d["notes"] = layer.abstract or ""
     d["owner_org"] = owner_org_id
-    d["tag_string"] = ["Knowledge Management Initiative", "KMI", "Harvested"]
-    d["data_portal"] = "http://kmi.dpaw.wa.gov.au/geoserver/web/"
+    d["tag_string"] = list(template["tags"])
+    d["data_portal"] = template["data_portal"]
     d["data_homepage"] = ""
-    d["license_id"] = "cc-by-sa"
+    d["license_id"] = template["license_id"]
     d["author"] = layer.parent.title
     d["author_email"] = ""
-    d["maintainer_email"] = "marinedatarequests@dpaw.wa.gov.au"
-    d["maintainer"] = "Marine Data Manager"
+    d["maintainer_email"] = template["maintainer_email"]
+    d["maintainer"] = template["maintainer"]
     d["private"] = False
     d["spatial"] = bboxWGS84_to_gjMP(layer.boundingBoxWGS84)
     #d["published_on"] = None
     #d["last_updated_on"] = None
-    d["update_frequency"] = "frequent"
+    d["update_frequency"] = template["update_frequency"]
     #d["data_temporal_extent_begin"] = ""
     #d["data_temporal_extent_end"] = ""
 
@@ -454,30 +1142,138 @@ def gs28_to_ckan(layer, wxs_url, ckan,
 
 def get_layer_dict_gs28(wxs, wxs_url, ckanapi, 
                         fallback_org_name='dpaw', res_format="WMS", 
-                        debug=False):
+                        debug=False, template=KMI_TEMPLATE):
     """Return a list of CKAN API package_show-compatible dicts
     
     Arguments:
     
-        wxs A wxsclient loaded from a WXS enpoint
+        wxs A wxsclient loaded from a WXS enpoint, a WXS endpoint URL 
+            to load through the capabilities cache (see `get_capabilities`),
+            or an iterable of layer records (see `iter_capabilities_layers`)
         wxs_url The WXS endpoint URL to use as dataset resource URL
         ckanapi A ckanapi instance with at least read permission
         org_dict A dict of CKAN org names and ids
         pdf_dict A dict of dataset names and corresponding PDF URLs
         debug Debug noise
-        fallback_org_name The fallback CKAN org name , default:'lgate'    
+        fallback_org_name The fallback CKAN org name for layers whose workspace 
+            has no CKAN org of the same name, default:'dpaw'    
+        template The constant text of the source, default: `KMI_TEMPLATE`
     
     Returns:
         A list of CKAN API package_show-compatible dicts
     """
-    foid = ckanapi.action.organization_show(id=fallback_org_name)["id"]
-    return [gs28_to_ckan(wxs.contents[layername], wxs_url, ckanapi, 
-                        fallback_org_id=foid, res_format=res_format,
-                        debug=debug) for layername in wxs.contents]
+    resolver = OrgResolver(ckanapi, fallback_org_name=fallback_org_name, debug=debug)
+    dicts = [gs28_to_ckan(layer, wxs_url, ckanapi, 
+                          fallback_org_id=resolver.fallback_org_id, 
+                          res_format=res_format, debug=debug, 
+                          org_resolver=resolver, template=template) 
+             for layer in _iter_wxs_layers(wxs, res_format)]
+    if resolver.unknown:
+        print("[get_layer_dict_gs28] Used fallback org {0} for unknown workspaces {1}".format(
+                fallback_org_name, ", ".join(sorted(resolver.unknown))))
+    return dicts
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def canonical_url(url):
+    """Return a URL with lower case scheme and host, without default port, 
+    fragment or trailing slash, and with sorted query parameters
+    
+    Example:
+    >>> canonical_url("HTTP://Example.COM:80/wms/?service=WMS&request=GetCapabilities#top")
+    'http://example.com/wms?request=GetCapabilities&service=WMS'
+    >>> canonical_url("http://example.com/wms?")
+    'http://example.com/wms'
+    
+    Arguments:
+        url (String) A URL
+    
+    Returns:
+        String The canonical URL
+    """
+    parts = urlsplit((url or "").strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if parts.port and parts.port == DEFAULT_PORTS.get(scheme):
+        netloc = netloc.rsplit(":", 1)[0]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path.rstrip("/"), query, ""))
+
+
+def resource_key(resource_dict):
+    """Return the identity of a resource: its canonical URL, WMS layer and WFS layer
+    
+    Resources with the same URL but different layers are different resources.
+    
+    Example:
+    >>> resource_key({"url": "http://example.com/wms/", "wms_layer": "0"})
+    ('http://example.com/wms', '0', '')
+    
+    Arguments:
+        resource_dict (dict): One resource dict
+    
+    Returns:
+        tuple (canonical URL, WMS layer, WFS layer)
+    """
+    layers = [resource_dict.get(k) for k in ("wms_layer", "wfs_layer")]
+    return tuple([canonical_url(resource_dict.get("url"))] + 
+                 [l if isinstance(l, string_types) else "" if l is None else str(l) 
+                  for l in layers])
+
+
+def merge_resources(old, new, debug=False):
+    """Merge new resource dicts into a list of existing resource dicts
+    
+    Resources are matched on `resource_key` through an index, so a merge runs 
+    in O(len(old) + len(new)). A new resource matching an existing one replaces 
+    its fields in place, keeping the existing resource's id, position, and 
+    fields the new resource does not set. Other new resources are appended in order,
+    the first of several new resources with the same key wins.
+    
+    Arguments:
+        old (List of dicts): package_show(id="xxx")["resources"]
+        new (List of dicts): Resource dicts to add
+        debug (Boolean): Debug noise level
+        
+    Returns:
+        A tuple of (list of merged resource dicts, report dict), the report
+        listing the URLs of "added", "kept" and "replaced" resources
+    """
+    result = [dict(r) for r in old]
+    index = dict()
+    for (i, r) in enumerate(result):
+        index.setdefault(resource_key(r), i)
+    
+    report = {"added": [], "kept": [], "replaced": []}
+    replaced = set()
+    for r in new:
+        key = resource_key(r)
+        i = index.get(key)
+        if i is None:
+            index[key] = len(result)
+            result.append(dict(r))
+            report["added"].append(r["url"])
+            if debug:
+                print("[merge_resources] New resource added {0}".format(key))
+        elif i < len(old) and i not in replaced:
+            result[i].update(r)
+            replaced.add(i)
+            report["replaced"].append(r["url"])
+            if debug:
+                print("[merge_resources] Existing resource replaced {0}".format(key))
+        elif debug:
+            print("[merge_resources] New resource skipped as duplicate {0}".format(key))
+    
+    report["kept"] = [r["url"] for (j, r) in enumerate(old) if j not in replaced]
+    return (result, report)
 
 
 def add_resource_to_list(resourcedict_list, resource_dict, debug=False):
-    """Add a single resource_dict to a resourcedict_list if URL is unique
+    """Add a single resource_dict to a resourcedict_list if its `resource_key` is unique
+    
+    To add many resources, use `add_resources_to_list` or `merge_resources`.
     
     Arguments:
         resourcedict_list (List of dicts): package_show(id="xxx")["resources"]
@@ -487,7 +1283,8 @@ def add_resource_to_list(resourcedict_list, resource_dict, debug=False):
     Returns:
         List of resource dicts
     """
-    if not resource_dict["url"] in [r["url"] for r in resourcedict_list]:
+    key = resource_key(resource_dict)
+    if not key in (resource_key(r) for r in resourcedict_list):
         if debug:
             print("[add_resource_to_list] New resource added with unique URL {0}".format(
                     resource_dict["url"]))
@@ -501,7 +1298,7 @@ def add_resource_to_list(resourcedict_list, resource_dict, debug=False):
     
     
 def add_resources_to_list(old, new, debug=False):
-    """Add multiple resource dicts to a resourcedict_list if URLs are unique
+    """Merge multiple resource dicts into a resourcedict_list, see `merge_resources`
     
     Arguments:
         old (List of dicts): package_show(id="xxx")["resources"]
@@ -511,105 +1308,365 @@ def add_resources_to_list(old, new, debug=False):
     Returns
         List of resource dicts
     """
-    result = old
-    for resource in new:
-        result = add_resource_to_list(result, resource, debug=debug)
-    return result
+    return merge_resources(old, new, debug=debug)[0]
 
     
-def upsert_dataset(data_dict, ckanapi, overwrite_metadata=True, 
-                   drop_existing_resources=True, debug=False):
-    '''
-    Create or update a CKAN dataset (data.wa.gov.au schema) from a dict.
+# Fields which CKAN maintains itself
+CKAN_MANAGED_FIELDS = ("id", "metadata_created", "metadata_modified", 
+                       "revision_id", "revision_timestamp", "num_resources", 
+                       "num_tags", "organization", "creator_user_id", 
+                       "package_id", "position", "created", "last_modified",
+                       "cache_last_updated", "cache_url", "webstore_url",
+                       "webstore_last_updated", "hash", "mimetype", 
+                       "mimetype_inner", "size", "url_type", "datastore_active",
+                       "relationships_as_object", "relationships_as_subject",
+                       "tracking_summary")
 
-    WARNING: This will overwrite resources and drop manually added resources in CKAN.
-    No guarantees can be given for manual changes applied to harvested datasets
-    when the dataset is harvested again.
 
-    Arguments:
-        datadict (dict): A dict like ckanapi `package_show`
-        ckanapi (ckanapi): A ckanapi object (created with CKAN url and write-permitted api key)
-        overwrite_metadata (Boolean): Whether to overwrite existing dataset metadata (default)
-        drop_existing_resources (Boolean): Whether to drop existing resources (default) or merge
-        new and existing with identical resource URL
-        debug (Boolean): Debug noise level
-    @return None
-    '''
-    if data_dict is None:
-        print("[upsert_dataset] No input, skipping.")
-        return(None)
-    
-    if not data_dict.has_key("name"):
-        print("[upsert_dataset] Invalid input:\n{0}".format(str(data_dict)))
-        return(None)
-    
-    n = data_dict.get("name", None)
+def _normalise_value(key, value):
+    """Return a comparable form of a CKAN package or resource field value.
     
-    print("[upsert_dataset] Reading WMS layer {0}".format(n))
+    Treats None and empty strings as equal, strips whitespace, 
+    ignores the case of resource formats (CKAN unifies them) and
+    the formatting of GeoJSON strings.
+    """
+    if value is None:
+        return ""
+    if key == "spatial" and value:
+        try:
+            return json.dumps(json.loads(value), sort_keys=True)
+        except (TypeError, ValueError):
+            pass
+    if key == "format" and hasattr(value, "lower"):
+        return value.strip().lower()
+    if hasattr(value, "strip"):
+        return value.strip()
+    return value
 
-    new_package = data_dict
-    new_resources = data_dict["resources"]
-    
+
+def _normalise_package(package, template, ignore):
+    """Return a comparable dict of the fields of `package` named in `template`.
     
-    try:
-        # Package exists with metadata we want to keep or overwrite,
-        # and resources we want to keep or discard
-        package = ckanapi.action.package_show(id=n)
-        if debug:
-            print("[upsert_dataset] Found existing package {0}".format(package["name"]))
-        do_update = True
-    except:
-        print("[upsert_dataset]   Layer not found, creating...")
-        do_update = False
-        #try:
-        package = ckanapi.action.package_create(**data_dict)
-        #    print("[upsert_dataset]   Created dataset {0}".format(n))
-        #except:
-        #    print("[upsert_dataset]   Rejected")
-        #    data_dict["ERROR"] = "CKAN rejected layer {0}".format(n)
-        #    package = data_dict
+    Skips the fields whose template value is an `EstimatedDate`.
+    Resources are compared by position on the keys of the template resources.
+    """
+    norm = dict()
+    for key in template:
+        if (key in ignore or key in CKAN_MANAGED_FIELDS or 
+                isinstance(template[key], EstimatedDate)):
+            continue
+        value = package.get(key, None)
         
-    
-    if do_update:
+        if key == "tag_string":
+            if value is None:
+                value = [t["name"] for t in package.get("tags", [])]
+            elif hasattr(value, "split"):
+                value = value.split(",")
+            norm[key] = sorted(set(t.strip() for t in value))
         
-        old_resources = package["resources"]
-        if debug:
-            print("[upsert_dataset] Old resources: {0}".format(str(old_resources)))
-            print("[upsert_dataset] New resources: {0}".format(str(new_resources)))
+        elif key == "groups":
+            # Compare by id if the template has ids, else by name
+            ref = "id" if all("id" in g for g in (template[key] or [])) else "name"
+            norm[key] = sorted(g.get(ref) for g in (value or []))
             
-
-        # Discard or merge existing resources
-        if drop_existing_resources:
-            resources = new_resources
-            msg_res = "[upsert_dataset]  Existing resources were replaced with new resources."
-        else:
-            resources = add_resources_to_list(old_resources, new_resources, debug=debug)
-            msg_res = "[upsert_dataset]  Existing resources were kept, new resources were added."
+        elif key == "extras":
+            norm[key] = sorted((x["key"], _normalise_value(x["key"], x["value"])) 
+                               for x in (value or []))
         
-        if debug:
-            print("[upsert_dataset]  Merged resources: {0}".format(str(resources)))
+        elif key == "resources":
+            value = value or []
+            templates = template[key] or []
+            if len(value) == len(templates):
+                norm[key] = [_normalise_package(r, t, ignore) 
+                             for (r, t) in zip(value, templates)]
+            else:
+                norm[key] = len(value)
         
-        # Keep or overwrite package metadata
-        if overwrite_metadata:
-            pkg = new_package
-            msg_pkg = "[upsert_dataset]  Existing dataset metadata were updated."
         else:
-            pkg = package
-            msg_pkg = "[upsert_dataset]  Existing dataset metadata were not changed."
-
-        # Attach merged or new resources
-        pkg["resources"] = resources
+            norm[key] = _normalise_value(key, value)
+    return norm
 
-        # Update package
-        if debug:
-            print("[upsert_dataset] Attempting to update package {0} with data\n{1}".format(
-                    package["name"], str(package)))
-        package = ckanapi.action.package_update(**pkg)
-        msg = "[upsert_dataset]  Layer exists.\n  {0}\n  {1}".format(msg_pkg, msg_res)
-        print(msg)
 
+def package_fingerprint(package, template=None, ignore=()):
+    """Return a normalised content fingerprint of a CKAN package dict.
+    
+    Fingerprints compare a harvested dict (the output of `wxs_to_dict`, 
+    `gs28_to_ckan` or `parse_argis_rest_layer`) against an existing package
+    (the output of `package_show`) on the fields of the harvested dict only, 
+    ignoring estimated dates (see `EstimatedDate`) and fields CKAN maintains itself.
+    
+    >>> new = {"name": "x", "tag_string": ["b", "a"], 
+    ...        "published_on": EstimatedDate("2015-10-05T13:41:48")}
+    >>> old = {"name": "x", "tags": [{"name": "a"}, {"name": "b"}], "id": "123",
+    ...        "published_on": "2015-10-01T09:00:00"}
+    >>> package_fingerprint(old, template=new) == package_fingerprint(new)
+    True
+    >>> new["published_on"] = "2015-10-05T13:41:48"
+    >>> package_fingerprint(old, template=new) == package_fingerprint(new)
+    False
+    
+    Arguments:
+        package (dict) A CKAN package dict
+        template (dict) The package dict whose fields to fingerprint, default: `package`
+        ignore (tuple) Further fields to ignore, optional
+        
+    Returns:
+        A hex digest String
+    """
+    norm = _normalise_package(package, template or package, ignore)
+    return hashlib.sha1(json.dumps(norm, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def merge_package(package, data_dict, overwrite_metadata=True, 
+                  drop_existing_resources=True, debug=False):
+    """Return the package dict `upsert_dataset` writes over an existing package
+    
+    Arguments:
+        package (dict) The existing package, output of `package_show`
+        data_dict (dict) The harvested package dict
+        overwrite_metadata, drop_existing_resources, debug: see `upsert_dataset`
+    
+    Returns:
+        A tuple of (package dict, resource report dict). The report lists the URLs of 
+        "added", "kept", "replaced" (see `merge_resources`) and "dropped" resources.
+    """
+    if drop_existing_resources:
+        resources = data_dict["resources"]
+        report = {"added": [r["url"] for r in resources], "kept": [], "replaced": [],
+                  "dropped": [r["url"] for r in package["resources"]]}
+    else:
+        (resources, report) = merge_resources(package["resources"], data_dict["resources"], 
+                                              debug=debug)
+        report["dropped"] = []
+    
+    pkg = dict(data_dict) if overwrite_metadata else dict(package)
+    pkg["resources"] = resources
+    return (pkg, report)
+
+
+def package_changes(package, data_dict, ignore=()):
+    """Return the fields of a package dict that differ from an existing package
+    
+    Compares as per `package_fingerprint`, on the fields of `data_dict` only.
+    
+    >>> old = {"name": "x", "title": "Old", "tags": [{"name": "a"}], "id": "123"}
+    >>> new = {"name": "x", "title": "New", "tag_string": ["a"]}
+    >>> changes = package_changes(old, new)
+    >>> sorted(changes), changes["title"]["old"], changes["title"]["new"]
+    (['title'], 'Old', 'New')
+    
+    Arguments:
+        package (dict) The existing package, output of `package_show`
+        data_dict (dict) The package dict to write
+        ignore (tuple) Further fields to ignore, optional
+    
+    Returns:
+        A dict of field name: {"old": normalised old value, "new": normalised new value}
+    """
+    old = _normalise_package(package, data_dict, ignore)
+    new = _normalise_package(data_dict, data_dict, ignore)
+    return dict((k, {"old": old[k], "new": new[k]}) for k in new if old[k] != new[k])
+
+
+def search_packages(ckanapi, q="*:*", fq="", rows=1000, sort="name asc", debug=False, **kwargs):
+    """Yield all packages matching a `package_search`, paging through all results
+    
+    Arguments:
+        ckanapi (ckanapi) A ckanapi instance with at least read permission
+        q (String) The Solr query, default: all packages
+        fq (String) The Solr filter query, optional
+        rows (int) Page size, default: 1000. CKAN may return fewer rows per page
+            (`ckan.search.rows_max`), paging follows the rows actually returned.
+        sort (String) The sort order, default: "name asc"
+        debug (Boolean) Debug noise level
+        kwargs Further `package_search` parameters
+    
+    Returns:
+        A generator of package_show-like dicts
+    """
+    start = 0
+    while True:
+        res = ckan_action(ckanapi, "package_search", q=q, fq=fq, rows=rows, 
+                          start=start, sort=sort, **kwargs)
+        for p in res["results"]:
+            yield p
+        start += len(res["results"])
+        if debug:
+            print("[search_packages] Read {0} of {1} packages".format(start, res["count"]))
+        if not res["results"] or start >= res["count"]:
+            break
+
+
+def get_package_index(ckanapi, tag="Harvested", organization=None, 
+                      rows=1000, debug=False):
+    """Return a name-indexed dict of existing CKAN packages.
+    
+    Pages through `package_search` with large `rows` values instead of 
+    calling `package_show` once per dataset. The result can be handed to
+    `upsert_dataset` and `upsert_datasets` as `package_index`.
+    
+    Note: CKAN caps `rows` at `ckan.search.rows_max` (default: 1000).
+    
+    Arguments:
+        ckanapi (ckanapi) A ckanapi instance with at least read permission
+        tag (String) Only index packages with this tag, default: "Harvested"
+        organization (String) Only index packages owned by this org name, optional
+        rows (int) Page size, default: 1000
+        debug (Boolean) Debug noise level
+        
+    Returns:
+        A dict of package name: package_show-like dict
+    """
+    fq = []
+    if tag:
+        fq.append('tags:"{0}"'.format(tag))
+    if organization:
+        fq.append('organization:"{0}"'.format(organization))
+    fq = " AND ".join(fq)
+    
+    index = dict()
+    for p in search_packages(ckanapi, fq=fq, rows=rows, debug=debug):
+        index[p["name"]] = p
+    print("[get_package_index] Found {0} existing packages matching {1}".format(
+            len(index), fq))
+    return index
+
+    
+def upsert_dataset(data_dict, ckanapi, overwrite_metadata=True, 
+                   drop_existing_resources=True, package_index=None, 
+                   skip_unchanged=True, debug=False):
+    '''
+    Create or update a CKAN dataset (data.wa.gov.au schema) from a dict.
+
+    WARNING: This will overwrite resources and drop manually added resources in CKAN.
+    No guarantees can be given for manual changes applied to harvested datasets
+    when the dataset is harvested again.
+
+    Arguments:
+        datadict (dict): A dict like ckanapi `package_show`
+        ckanapi (ckanapi): A ckanapi object (created with CKAN url and write-permitted api key)
+        overwrite_metadata (Boolean): Whether to overwrite existing dataset metadata (default)
+        drop_existing_resources (Boolean): Whether to drop existing resources (default) or merge
+        new and existing with identical resource URL
+        package_index (dict): An output of `get_package_index` to look up existing
+        packages instead of calling `package_show`, optional. 
+        Created or updated packages are written back into the index.
+        skip_unchanged (Boolean): Whether to skip the `package_update` if the
+        `package_fingerprint` of the update equals the existing package's (default)
+        debug (Boolean): Debug noise level
+    @return None
+    '''
+    return _upsert_dataset(data_dict, ckanapi, 
+                           overwrite_metadata=overwrite_metadata,
+                           drop_existing_resources=drop_existing_resources, 
+                           package_index=package_index, 
+                           skip_unchanged=skip_unchanged, debug=debug)[0]
 
-    return(package)
+
+def _upsert_dataset(data_dict, ckanapi, overwrite_metadata=True, 
+                    drop_existing_resources=True, package_index=None, 
+                    skip_unchanged=True, debug=False):
+    """Upsert a dataset as per `upsert_dataset`.
+    
+    Returns:
+        A tuple of (`package_show` dict, action), where action is one of
+        "created", "updated", "unchanged", or None if the input was skipped
+    """
+    if data_dict is None:
+        print("[upsert_dataset] No input, skipping.")
+        return(None, None)
+    
+    if not data_dict.has_key("name"):
+        print("[upsert_dataset] Invalid input:\n{0}".format(str(data_dict)))
+        return(None, None)
+    
+    n = data_dict.get("name", None)
+    
+    print("[upsert_dataset] Reading WMS layer {0}".format(n))
+
+    new_package = data_dict
+    new_resources = data_dict["resources"]
+    
+    # Package exists with metadata we want to keep or overwrite,
+    # and resources we want to keep or discard
+    if package_index is not None:
+        package = package_index.get(n, None)
+    else:
+        try:
+            package = ckan_action(ckanapi, "package_show", id=n)
+        except NotFound:
+            package = None
+    
+    if package is not None:
+        if debug:
+            print("[upsert_dataset] Found existing package {0}".format(package["name"]))
+        do_update = True
+        action = "updated"
+    else:
+        print("[upsert_dataset]   Layer not found, creating...")
+        do_update = False
+        action = "created"
+        try:
+            package = ckan_action(ckanapi, "package_create", **data_dict)
+        except ValidationError:
+            if package_index is None:
+                raise
+            # The name is taken by a package outside the prefetched index
+            print("[upsert_dataset]   Layer exists outside package index, updating...")
+            package = ckan_action(ckanapi, "package_show", id=n)
+            do_update = True
+            action = "updated"
+        
+    
+    if do_update:
+        
+        old_resources = package["resources"]
+        if debug:
+            print("[upsert_dataset] Old resources: {0}".format(str(old_resources)))
+            print("[upsert_dataset] New resources: {0}".format(str(new_resources)))
+            
+
+        # Discard or merge existing resources, keep or overwrite package metadata
+        (pkg, report) = merge_package(package, new_package, 
+                                      overwrite_metadata=overwrite_metadata, 
+                                      drop_existing_resources=drop_existing_resources, 
+                                      debug=debug)
+        if drop_existing_resources:
+            msg_res = "[upsert_dataset]  Existing resources were replaced with new resources."
+        else:
+            msg_res = ("[upsert_dataset]  Existing resources were merged: "
+                       "{0} added, {1} kept, {2} replaced.").format(
+                len(report["added"]), len(report["kept"]), len(report["replaced"]))
+        
+        if debug:
+            print("[upsert_dataset]  Merged resources: {0}".format(str(pkg["resources"])))
+        
+        if overwrite_metadata:
+            msg_pkg = "[upsert_dataset]  Existing dataset metadata were updated."
+        else:
+            msg_pkg = "[upsert_dataset]  Existing dataset metadata were not changed."
+
+        # Skip no-op writes
+        if skip_unchanged and package_fingerprint(pkg) == package_fingerprint(
+                package, template=pkg):
+            print("[upsert_dataset]  Layer exists and is unchanged, skipping update.")
+            action = "unchanged"
+        
+        # Update package
+        else:
+            if debug:
+                print("[upsert_dataset] Attempting to update package {0} with data\n{1}".format(
+                        package["name"], str(package)))
+            package = ckan_action(ckanapi, "package_update", **pkg)
+            msg = "[upsert_dataset]  Layer exists.\n  {0}\n  {1}".format(msg_pkg, msg_res)
+            print(msg)
+
+    if package_index is not None and package:
+        package_index[package["name"]] = package
+    if action:
+        metrics.count("datasets_" + action)
+
+    return(package, action)
 
 
 def get_pdf_dict(filename):
@@ -663,183 +1720,2631 @@ def get_org_dict(filename):
     return orgs
 
 
-def get_group_dict(wms):
-    """
-    Return a spreadsheet of organisations as a name-indexed dict of organisation data.
-    The innermost dicts can be used to `upsert_org` a CKAN organisation.
+def get_group_dict(wms):
+    """
+    Return a spreadsheet of organisations as a name-indexed dict of organisation data.
+    The innermost dicts can be used to `upsert_org` a CKAN organisation.
+    
+    The spreadsheet must contain the headers "name","title","url", and "logo_url",
+    corresponding to the CKAN organisation keys.
+    
+    Arguments:
+        wms (owslib.wms.WebMapService): An owslib WMS instance, a WMS endpoint URL
+            to load through the capabilities cache (see `get_capabilities`),
+            or an iterable of layer records (see `iter_capabilities_layers`)
+    """
+    print("[get_group_dict] Reading wms...")
+    groups = dict()
+    for grp_title in set([l.parent.title for l in _iter_wxs_layers(wms, "WMS")]):
+        groups[grp_title] = dict()
+        groups[grp_title]["name"] = slugify(grp_title)
+        groups[grp_title]["title"] = grp_title
+    print("[get_group_dict] Done.")
+    return groups
+
+
+def upsert_org(datadict, ckanapi, debug=False):
+    """Create or update organisations through a ckanapi as per given datadict.
+        
+    Arguments:
+        datadict A dict with information on organizations, such as:
+    {
+        'logo_url': 'http://www.dfes.wa.gov.au/_layouts/images/FESA.Mobile/dfes_print.png',
+        'name': 'dfes',
+        'title': 'Department of Fire & Emergency Services',
+        'url': 'http://www.dfes.wa.gov.au/'
+
+    }
+        ckanapi A ckanapi instance with create_org permissions
+    
+    Returns:
+        A ckanapi organization_show dict
+    """
+    print("[upsert_org] Upserting organisation {0}, id {1}".format(
+            datadict["title"], datadict["name"]))
+    if debug:
+        print("[upsert_org]   Input:\n{0}".format(str(datadict)))
+
+    try:
+        org = ckan_action(ckanapi, "organization_show", id=datadict["name"])
+    except NotFound:
+        org = None
+    if org is not None:
+        print("[upsert_org]   Organisation exists, updating...")
+        org = ckan_action(ckanapi, "organization_update", id=datadict["name"], **datadict)
+        print("[upsert_org]   Updated {0}".format(datadict["title"]))
+    else:
+        print("[upsert_org]   Organisation not found, inserting...")
+        org = ckan_action(ckanapi, "organization_create", **datadict)
+        print("[upsert_org]   Inserted {0}".format(datadict["title"]))
+    if org:
+        return org
+    
+
+def upsert_group(datadict, ckanapi, debug=False):
+    """Create or update groups through a ckanapi as per given datadict.
+        
+    Arguments:
+        
+        datadict A dict with information on groups, such as:
+    {
+        'name': 'cultural_society_and_demography',
+        'title': 'Cultural, Society and Demography'
+
+    }
+        ckanapi A ckanapi instance with at least create_group permissions
+        
+    Returns:
+        A ckanapi group_show dict
+    """
+    print("[upsert_group] Upserting organisation {0}, id {1}".format(
+            datadict["title"], datadict["name"]))
+    if debug:
+        print("[upsert_group]   Input:\n{0}".format(str(datadict)))
+
+    try:
+        org = ckan_action(ckanapi, "group_show", id=datadict["name"])
+    except NotFound:
+        org = None
+    if org is not None:
+        print("[upsert_group]   Group exists, updating...")
+        org = ckan_action(ckanapi, "group_update", id=datadict["name"], **datadict)
+        print("[upsert_group]   Updated {0}".format(datadict["title"]))
+    else:
+        print("[upsert_group]   Group not found, inserting...")
+        org = ckan_action(ckanapi, "group_create", **datadict)
+        print("[upsert_group]   Inserted {0}".format(datadict["title"]))
+    if org:
+        return org
+    
+        
+def upsert_orgs(org_dict, ckanapi, debug=False):
+    """
+    Insert or update CKAN organisations through a ckanapi from an org_dict.
+    
+    Uses `upsert_org` on each element of `org_dict`.
+    Returns a name-indexed dictionary of now existing CKAN organisations.
+    This can be used to set the organisation in a CKAN dataset, replacing an expensive 
+    `organization_show` with a dictionary lookup.
+    """
+    print("[upsert_orgs] Refreshing orgs...")
+    orgs = [upsert_org(org_dict[org], ckanapi, debug) for org in org_dict]
+    print("[upsert_orgs] Done!")
+    return dict([o["name"], o] for o in orgs)
+
+
+def upsert_groups(group_dict, ckanapi, debug=False):
+    """Insert or update CKAN groups through a ckanapi from an org_dict.
+    
+    Uses `upsert_group` on each element of `org_dict`.
+    Returns a title-indexed dictionary of now existing CKAN groups.
+    This can be used to set the group in a CKAN dataset, replacing an expensive 
+    `group_show` with a dictionary lookup.
+    """
+    print("[upsert_groups] Refreshing groups...")
+    groups = [upsert_group(group_dict[grp], ckanapi, debug) for grp in group_dict]
+    print("[upsert_groups] Done!")
+    return dict([g["title"], g] for g in groups)
+
+
+# Fields CKAN stores for organisations and groups, and returns from
+# `organization_list` and `group_list` with all_fields, include_extras and include_groups.
+# Others, such as the "url" of `get_org_dict`, are dropped on write.
+CKAN_GROUP_FIELDS = ("name", "title", "description", "image_url", "type", 
+                     "state", "approval_status", "extras", "groups")
+
+
+def entity_diff(desired, existing):
+    """Return the names of the fields of `desired` whose values differ in `existing`.
+    
+    Values are compared as per `package_fingerprint`, on the fields CKAN 
+    stores only (see `CKAN_GROUP_FIELDS`).
+    
+    >>> entity_diff({"name": "dfes", "title": "DFES "}, {"name": "dfes", "title": "DFES", "id": "1"})
+    []
+    >>> entity_diff({"name": "dfes", "url": "http://www.dfes.wa.gov.au/"}, {"name": "dfes"})
+    []
+    >>> entity_diff({"name": "dfes", "title": "DFES"}, {"name": "dfes", "title": "FESA"})
+    ['title']
+    
+    Arguments:
+        desired (dict) The desired CKAN entity dict, e.g. an element of `get_org_dict`
+        existing (dict) The existing CKAN entity dict, e.g. from `organization_list`
+    
+    Returns:
+        A sorted list of field names
+    """
+    template = dict((k, v) for (k, v) in desired.items() if k in CKAN_GROUP_FIELDS)
+    new = _normalise_package(desired, template, ())
+    old = _normalise_package(existing, template, ())
+    return sorted(k for k in new if new[k] != old.get(k))
+
+
+def _sync_entities(entity_dict, ckanapi, kind, workers=1, debug=False):
+    """Create or update CKAN organisations or groups which differ from entity_dict.
+    
+    Arguments:
+        entity_dict (dict) A name-indexed dict of desired entities
+        ckanapi (ckanapi) A ckanapi instance with permissions to create the entities
+        kind (String) "organization" or "group"
+        workers (int) The number of concurrent writes
+        debug (Boolean) Debug noise level
+    
+    Returns:
+        A list of entity dicts, created, updated and unchanged
+    """
+    action = lambda name: "{0}_{1}".format(kind, name)
+    label = "sync_orgs" if kind == "organization" else "sync_groups"
+    existing = dict((e["name"], e) for e in list_all(ckanapi, action("list"), all_fields=True, 
+                                                     include_extras=True, 
+                                                     include_groups=True))
+    unchanged = []
+    writes = []
+    for key in entity_dict:
+        desired = entity_dict[key]
+        current = existing.get(desired["name"], None)
+        if current is None:
+            writes.append(("create", desired, []))
+            continue
+        changed = entity_diff(desired, current)
+        if changed:
+            writes.append(("update", desired, changed))
+        else:
+            unchanged.append(current)
+    
+    def write(todo):
+        (name, desired, changed) = todo
+        if name == "create":
+            print("[{0}]   Inserting {1}".format(label, desired["title"]))
+            return ckan_action(ckanapi, action("create"), **desired)
+        print("[{0}]   Updating {1}: {2}".format(label, desired["title"], ", ".join(changed)))
+        return ckan_action(ckanapi, action("update"), id=desired["name"], **desired)
+    
+    pool = ThreadPool(max(1, workers))
+    try:
+        written = pool.map(write, writes)
+    finally:
+        pool.close()
+        pool.join()
+    print("[{0}] {1} created, {2} updated, {3} unchanged".format(
+            label, len([w for w in writes if w[0] == "create"]), 
+            len([w for w in writes if w[0] == "update"]), len(unchanged)))
+    return unchanged + written
+
+
+def sync_orgs(org_dict, ckanapi, workers=1, debug=False):
+    """Create or update only those CKAN organisations which differ from an org_dict.
+    
+    Lists all organisations with few requests, compares them field by field with
+    `org_dict` (see `entity_diff`), and writes only new or changed organisations,
+    `workers` at a time.
+    
+    Arguments:
+        org_dict (dict) An output of `get_org_dict`
+        ckanapi (ckanapi) A ckanapi instance with create_org permissions
+        workers (int) The number of concurrent writes, default: 1
+        debug (Boolean) Debug noise level
+        
+    Returns:
+        A name-indexed dictionary of CKAN organisations like `upsert_orgs`
+    """
+    print("[sync_orgs] Syncing orgs...")
+    orgs = _sync_entities(org_dict, ckanapi, "organization", workers=workers, debug=debug)
+    return dict([o["name"], o] for o in orgs)
+
+
+def sync_groups(group_dict, ckanapi, workers=1, debug=False):
+    """Create or update only those CKAN groups which differ from a group_dict.
+    
+    See `sync_orgs`.
+    
+    Arguments:
+        group_dict (dict) An output of `get_group_dict`
+        ckanapi (ckanapi) A ckanapi instance with create_group permissions
+        workers (int) The number of concurrent writes, default: 1
+        debug (Boolean) Debug noise level
+        
+    Returns:
+        A title-indexed dictionary of CKAN groups like `upsert_groups`
+    """
+    print("[sync_groups] Syncing groups...")
+    groups = _sync_entities(group_dict, ckanapi, "group", workers=workers, debug=debug)
+    return dict([g["title"], g] for g in groups)
+
+
+def get_layer_dict(wxs, wxs_url, ckanapi, 
+                   org_dict, group_dict, pdf_dict, res_format="WMS", 
+                   debug=False, fallback_org_name='lgate', state=None, 
+                   template=SLIP_TEMPLATE):
+    """Return a list of CKAN API package_show-compatible dicts
+    
+    Arguments:
+    
+        wxs A wxsclient loaded from a WXS enpoint, a WXS endpoint URL 
+            to load through the capabilities cache (see `get_capabilities`),
+            or an iterable of layer records (see `iter_capabilities_layers`).
+            An endpoint URL's wxsclient is dropped as soon as its layers 
+            are read into records (see `layer_record`).
+        wxs_url The WXS endpoint URL to use as dataset resource URL
+        ckanapi A ckanapi instance with at least read permission
+        org_dict A dict of CKAN org names and ids
+        pdf_dict A dict of dataset names and corresponding PDF URLs
+        debug Debug noise
+        fallback_org_name The fallback CKAN org name , default:'lgate'    
+        state A `HarvestState` for an incremental harvest, optional.
+            Only layers which are new or whose last updated timestamp advanced
+            since the last harvest are converted and staged in the state.
+            Pass the same state to `upsert_datasets` to record the harvest.
+        template The constant text of the source, default: `SLIP_TEMPLATE`
+    
+    Returns:
+        A list of CKAN API package_show-compatible dicts
+    """
+    foid = ckan_action(ckanapi, "organization_show", id=fallback_org_name)["id"]
+    if state is None:
+        return [wxs_to_dict(layer, wxs_url, 
+            org_dict, group_dict, pdf_dict, debug=debug,
+            res_format=res_format, fallback_org_id=foid, template=template) 
+            for layer in _iter_wxs_layers(wxs, res_format)]
+    
+    dicts = []
+    skipped = 0
+    for layer in _iter_wxs_layers(wxs, res_format):
+        (title, name, updated) = _parse_name_cached(layer.title)
+        layer_name = name.upper() if name else None
+        if layer_name and state.is_current(wxs_url, layer_name, updated):
+            skipped += 1
+            continue
+        d = wxs_to_dict(layer, wxs_url, org_dict, group_dict, pdf_dict, debug=debug,
+                        res_format=res_format, fallback_org_id=foid, template=template)
+        if d is not None and layer_name and not state.accept(wxs_url, layer_name, updated, d):
+            skipped += 1
+            continue
+        dicts.append(d)
+    print("[get_layer_dict] {0} layers new or updated, {1} unchanged since last harvest".format(
+            len(dicts), skipped))
+    return dicts
+
+
+def get_layer_items(wxs, wxs_url, ckanapi, 
+                    org_dict, group_dict, pdf_dict, res_format="WMS", 
+                    debug=False, fallback_org_name='lgate', template=SLIP_TEMPLATE):
+    """Return the layer name and last updated timestamp with each package dict of `get_layer_dict`
+    
+    Use this to convert layers where no `HarvestState` is at hand, e.g. in a worker process,
+    and select the new or updated layers later with `HarvestState.select`.
+    
+    Arguments:
+        see `get_layer_dict`
+    
+    Returns:
+        A list of tuples of (layer name or None, ISO timestamp or None, package dict or None)
+    """
+    foid = ckan_action(ckanapi, "organization_show", id=fallback_org_name)["id"]
+    items = []
+    for layer in _iter_wxs_layers(wxs, res_format):
+        (title, name, updated) = _parse_name_cached(layer.title)
+        items.append((name.upper() if name else None, updated, 
+                      wxs_to_dict(layer, wxs_url, org_dict, group_dict, pdf_dict, debug=debug,
+                                  res_format=res_format, fallback_org_id=foid, 
+                                  template=template)))
+    return items
+
+
+def upsert_datasets(data_dict, ckanapi,overwrite_metadata=True, 
+                drop_existing_resources=True, prefetch=False, 
+                prefetch_tag="Harvested", prefetch_org=None, 
+                package_index=None, workers=1, skip_unchanged=True, state=None,
+                journal=None, debug=False):
+    """Upsert datasets into a ckanapi from data in a dictionary.
+    
+    Arguments:
+        data_dict (dict) An output of `get_layer_dict`
+        ckanapi (ckanapi) A ckanapi object (created with CKAN url and write-permitted api key)
+        overwrite_metadata (Boolean) Whether to overwrite existing dataset metadata (default)
+        drop_existing_resources (Boolean) Whether to drop existing resources (default) or merge
+        new and existing with identical resource URL
+        prefetch (Boolean) Whether to look up existing packages with a few paged
+        `package_search` calls (see `get_package_index`) instead of one 
+        `package_show` per dataset, default: False
+        prefetch_tag (String) The tag to prefetch packages by, default: "Harvested"
+        prefetch_org (String) The owner org name to prefetch packages by, optional
+        package_index (dict) An existing output of `get_package_index`, optional.
+        Re-use one index across several calls against the same CKAN.
+        workers (int) The number of concurrent upserts, default: 1 (sequential).
+        With more than one worker, failed datasets are reported and skipped
+        instead of aborting the batch, see `upsert_datasets_concurrently`.
+        skip_unchanged (Boolean) Whether to skip no-op updates (default), 
+        see `upsert_dataset`
+        state (HarvestState) The state passed to `get_layer_dict` for an 
+        incremental harvest, optional. Records each successfully written layer.
+        journal (RunJournal) A journal to resume the run from, optional.
+        Skips datasets done before and journals each dataset's outcome.
+        debug (Boolean) Debug noise level
+        
+    Returns:
+        A list of `package_show` dicts
+    """
+    if workers > 1:
+        summary = upsert_datasets_concurrently(
+            data_dict, ckanapi, workers=workers,
+            overwrite_metadata=overwrite_metadata, 
+            drop_existing_resources=drop_existing_resources, 
+            prefetch=prefetch, prefetch_tag=prefetch_tag, 
+            prefetch_org=prefetch_org, package_index=package_index, 
+            skip_unchanged=skip_unchanged, state=state, journal=journal, debug=debug)
+        return [p for p in summary["packages"] if p is not None]
+    
+    if prefetch and package_index is None:
+        package_index = get_package_index(ckanapi, tag=prefetch_tag, 
+                                          organization=prefetch_org, debug=debug)
+    print("Refreshing harvested WMS layer datasets...")
+    results = []
+    try:
+        for dataset in data_dict:
+            if dataset is None:
+                continue
+            key = journal_key(dataset)
+            if journal is not None:
+                if journal.is_done(key):
+                    if state is not None:
+                        state.commit(dataset)
+                    continue
+                journal.start(key)
+            try:
+                result = _upsert_dataset(dataset, 
+                                         ckanapi,
+                                         overwrite_metadata=overwrite_metadata, 
+                                         drop_existing_resources=drop_existing_resources,
+                                         package_index=package_index,
+                                         skip_unchanged=skip_unchanged,
+                                         debug=debug)
+            except Exception as e:
+                if journal is not None:
+                    journal.fail(key, e)
+                raise
+            results.append(result)
+            if journal is not None:
+                journal.done(key, action=result[1])
+            if state is not None:
+                state.commit(dataset, package=result[0])
+    finally:
+        if state is not None:
+            state.save()
+    packages = [package for (package, action) in results]
+    print("Done! Skipped {0} unchanged datasets.".format(
+            len([a for (p, a) in results if a == "unchanged"])))
+    return(packages)
+
+
+def upsert_datasets_concurrently(data_dict, ckanapi, workers=8, 
+                                 overwrite_metadata=True, 
+                                 drop_existing_resources=True, prefetch=False, 
+                                 prefetch_tag="Harvested", prefetch_org=None, 
+                                 package_index=None, skip_unchanged=True, 
+                                 state=None, journal=None, debug=False):
+    """Upsert datasets into a ckanapi from a bounded pool of worker threads.
+    
+    Exceptions raised while upserting one dataset are collected in the summary
+    and do not abort the batch. None inputs, e.g. layers `wxs_to_dict` skipped,
+    are not upserted. Inputs of the same name, e.g. the WMS and WFS layer of one 
+    dataset, are upserted one after the other in input order by the same worker, 
+    each one onto the package the one before wrote.
+    
+    Arguments:
+        data_dict (dict) An output of `get_layer_dict`
+        ckanapi (ckanapi) A ckanapi object (created with CKAN url and write-permitted api key)
+        workers (int) The number of worker threads, default: 8
+        overwrite_metadata, drop_existing_resources, prefetch, prefetch_tag,
+        prefetch_org, package_index, skip_unchanged, state, journal, debug: 
+        see `upsert_datasets`
+        
+    Returns:
+        A summary dict with keys
+        "packages" (list of `package_show` dicts or None for None inputs, failed 
+            or resumed datasets, one per input in input order), 
+        "created", "updated" and "unchanged" (lists of dataset names), 
+        "resumed" (list of dataset names done in the journal before),
+        "failed" (list of dicts with the dataset "name", its resource "urls" and 
+            the "error" message, as the same name may fail from several sources)
+    """
+    if prefetch and package_index is None:
+        package_index = get_package_index(ckanapi, tag=prefetch_tag, 
+                                          organization=prefetch_org, debug=debug)
+    data_dict = list(data_dict)
+    datasets = [d for d in data_dict if d is not None]
+    groups = OrderedDict()
+    for (i, dataset) in enumerate(datasets):
+        groups.setdefault(dataset.get("name"), []).append(i)
+    
+    def upsert(dataset, package_index):
+        key = journal_key(dataset)
+        if journal is not None:
+            if journal.is_done(key):
+                return (None, "resumed")
+            journal.start(key)
+        try:
+            result = _upsert_dataset(dataset, ckanapi, 
+                                     overwrite_metadata=overwrite_metadata,
+                                     drop_existing_resources=drop_existing_resources, 
+                                     package_index=package_index, 
+                                     skip_unchanged=skip_unchanged, debug=debug)
+        except Exception as e:
+            if journal is not None:
+                journal.fail(key, e)
+            return (None, e)
+        if journal is not None:
+            journal.done(key, action=result[1])
+        return result
+    
+    def upsert_group(indices):
+        index = package_index
+        results = []
+        for i in indices:
+            result = upsert(datasets[i], index)
+            results.append((i, result))
+            # The next dataset of the same name updates what this one wrote,
+            # or reads the package from CKAN if this one wrote nothing
+            index = None if result[0] is None else {datasets[i]["name"]: result[0]}
+        return results
+    
+    print("Refreshing harvested WMS layer datasets with {0} workers...".format(workers))
+    pool = ThreadPool(max(1, workers))
+    try:
+        grouped = pool.map(upsert_group, list(groups.values()), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    results = [None] * len(datasets)
+    for group in grouped:
+        for (i, result) in group:
+            results[i] = result
+    
+    summary = {"packages": [], "created": [], "updated": [], "unchanged": [], 
+               "resumed": [], "failed": []}
+    results = iter(results)
+    for dataset in data_dict:
+        if dataset is None:
+            summary["packages"].append(None)
+            continue
+        (package, action) = next(results)
+        summary["packages"].append(package)
+        if isinstance(action, Exception):
+            summary["failed"].append({"name": dataset.get("name", None), 
+                                      "urls": [r.get("url") for r in dataset.get("resources") or []],
+                                      "error": str(action)})
+            continue
+        if action == "resumed":
+            summary[action].append(dataset["name"])
+        elif action:
+            summary[action].append(package["name"])
+        if state is not None:
+            state.commit(dataset, package=package)
+    if state is not None:
+        state.save()
+    
+    print("Done! Created {0}, updated {1}, skipped {2} unchanged, failed {3} datasets.".format(
+            len(summary["created"]), len(summary["updated"]), 
+            len(summary["unchanged"]), len(summary["failed"])))
+    if summary["resumed"]:
+        print("  Skipped {0} datasets done before this run was resumed.".format(
+                len(summary["resumed"])))
+    for failure in summary["failed"]:
+        print("  Failed {0} ({1}): {2}".format(
+                failure["name"], ", ".join(failure["urls"]), failure["error"]))
+    return summary
+
+
+def plan_upserts(data_dict, catalogue, overwrite_metadata=True, 
+                 drop_existing_resources=True, find_deletions=False, source_urls=None, 
+                 tag="Harvested", max_fraction=0.1, debug=False):
+    """Plan the writes of `upsert_datasets` against a snapshot of a catalogue, offline
+    
+    Planning is pure and in-memory: it makes no CKAN calls and changes neither input, 
+    so plans for several catalogues can be computed in parallel. The plan is
+    JSON-serialisable and can be reviewed, stored and executed with `apply_plan`.
+    
+    Example:
+    catalogue = get_package_index(ckan, tag="Harvested")
+    plan = plan_upserts(l_wmsP, catalogue, find_deletions=True, source_urls=[wmsP_url])
+    catalogue = plan_catalogue(catalogue, plan)
+    plan_wfs = plan_upserts(l_wfsP, catalogue, overwrite_metadata=False, 
+                            drop_existing_resources=False)
+    summary = apply_plan(plan, ckan, workers=8)
+    
+    Arguments:
+        data_dict (list) Package dicts, output of `get_layer_dict`, `get_layer_dict_gs28`
+            or `parse_argis_rest_layer`
+        catalogue (dict) A name-indexed snapshot of the target catalogue's packages,
+            e.g. output of `get_package_index`
+        overwrite_metadata, drop_existing_resources: see `upsert_dataset`
+        find_deletions (Boolean) Whether to list the source's datasets in the catalogue
+            which are missing from data_dict as candidate deletions, default: False.
+            When planning several sources which write into the same datasets, 
+            e.g. a SLIP WMS and its WFS, use `plan_deletions` on the names of all 
+            of them instead.
+        source_urls (list) The source URLs whose datasets may be deleted, see 
+            `source_datasets`, default: the resource URLs of data_dict
+        tag (String) The tag of harvested datasets, default: "Harvested"
+        max_fraction (float) The highest fraction of the source's datasets to delete.
+            Above it, the plan's deletions are "refused" and `apply_plan` deletes 
+            none of them. Default: 0.1
+        debug (Boolean) Debug noise level
+    
+    Returns:
+        A plan dict with keys
+        "creates" (list of package dicts),
+        "updates" (list of dicts with "name", "id", "changes" as per `package_changes`,
+            "resources" as per `merge_package`, and "package", the dict to write),
+        "unchanged" (list of dataset names), 
+        "deletions" (list of candidate dataset names to delete), and
+        "refused" (whether the deletions exceed max_fraction)
+    """
+    plan = {"creates": [], "updates": [], "unchanged": [], "deletions": [], "refused": False}
+    names = set()
+    for dataset in data_dict:
+        if dataset is None:
+            continue
+        names.add(dataset["name"])
+        package = catalogue.get(dataset["name"])
+        if package is None:
+            plan["creates"].append(dataset)
+            continue
+        (pkg, report) = merge_package(package, dataset, 
+                                      overwrite_metadata=overwrite_metadata,
+                                      drop_existing_resources=drop_existing_resources)
+        changes = package_changes(package, pkg)
+        if not changes:
+            plan["unchanged"].append(dataset["name"])
+            continue
+        if debug:
+            print("[plan_upserts] {0} changes {1}".format(dataset["name"], ", ".join(changes)))
+        plan["updates"].append({"name": dataset["name"], "id": package.get("id"), 
+                                "changes": changes, "resources": report, "package": pkg})
+    if find_deletions:
+        if source_urls is None:
+            source_urls = set(r.get("url") for d in data_dict if d is not None 
+                              for r in d.get("resources") or [])
+        (plan["deletions"], plan["refused"]) = plan_deletions(
+                catalogue, names, source_urls, tag=tag, max_fraction=max_fraction)
+    print("[plan_upserts] Planned {0} creates, {1} updates, {2} unchanged, {3} deletions".format(
+            len(plan["creates"]), len(plan["updates"]), len(plan["unchanged"]), 
+            len(plan["deletions"])))
+    return plan
+
+
+def plan_deletions(catalogue, names, source_urls, tag="Harvested", max_fraction=0.1):
+    """Return the sources' datasets in a catalogue which are not in names, and whether
+    they are too many to delete
+    
+    Arguments:
+        catalogue (dict) A name-indexed snapshot of the catalogue's packages
+        names (iterable) The dataset names harvested from the sources, see `dataset_names`
+        source_urls (list) The source URLs, see `source_datasets`
+        tag (String) The tag of harvested datasets, default: "Harvested"
+        max_fraction (float) The highest fraction of the sources' datasets to delete,
+            default: 0.1
+    
+    Returns:
+        A tuple of (sorted list of dataset names, Boolean whether their fraction 
+        of the sources' datasets exceeds max_fraction)
+    """
+    names = set(names)
+    datasets = source_datasets(catalogue, source_urls, tag=tag)
+    stale = [n for n in datasets if n not in names]
+    refused = bool(datasets) and float(len(stale)) / len(datasets) > max_fraction
+    if refused:
+        print("[plan_deletions] Refusing {0} of {1} deletions, more than {2:.0%}".format(
+                len(stale), len(datasets), max_fraction))
+    return (stale, refused)
+
+
+def plan_catalogue(catalogue, plan):
+    """Return a new catalogue snapshot as it will be after applying a plan's creates and updates
+    
+    Use this to plan several sources in sequence against one catalogue.
+    """
+    result = dict(catalogue)
+    for dataset in plan["creates"]:
+        tags = dataset.get("tag_string") or []
+        if hasattr(tags, "split"):
+            tags = tags.split(",")
+        result[dataset["name"]] = dict(dataset, tags=[{"name": t.strip()} for t in tags])
+    for update in plan["updates"]:
+        result[update["name"]] = dict(update["package"], id=update["id"])
+    return result
+
+
+def _write_batches(ops, ckanapi, batch_size=100, workers=1, caller="write_batches", 
+                   debug=False):
+    """Call CKAN actions in batches, each written by a pool of worker threads
+    
+    Arguments:
+        ops (list) Tuples of (action name, dataset name, data dict)
+        ckanapi (ckanapi) A ckanapi object (created with CKAN url and write-permitted api key)
+        batch_size (int) The number of writes per batch, default: 100
+        workers (int) The number of worker threads, default: 1
+        caller (String) The name to log progress as
+        debug (Boolean) Debug noise level
+    
+    Returns:
+        A list of tuples of (op, error message or None), in input order
+    """
+    def write(op):
+        (action, name, data) = op
+        try:
+            ckan_action(ckanapi, action, **data)
+            return None
+        except Exception as e:
+            if debug:
+                print("[{0}] {1} {2} failed: {3}".format(caller, action, name, e))
+            return str(e)
+    
+    results = []
+    pool = ThreadPool(max(1, workers))
+    try:
+        for start in range(0, len(ops), batch_size):
+            batch = ops[start:start + batch_size]
+            results.extend(zip(batch, pool.map(write, batch)))
+            print("[{0}] Applied {1} of {2} writes".format(
+                    caller, min(start + batch_size, len(ops)), len(ops)))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def apply_plan(plan, ckanapi, batch_size=100, workers=1, delete=False, debug=False):
+    """Execute a plan of `plan_upserts` in batches
+    
+    Each batch is written by a pool of worker threads. Exceptions are collected
+    in the summary and do not abort the plan.
+    
+    Arguments:
+        plan (dict) An output of `plan_upserts`
+        ckanapi (ckanapi) A ckanapi object (created with CKAN url and write-permitted api key)
+        batch_size (int) The number of writes per batch, default: 100
+        workers (int) The number of worker threads, default: 1
+        delete (Boolean) Whether to delete the candidate deletions, default: False.
+            Deletions of a plan which "refused" them are skipped.
+        debug (Boolean) Debug noise level
+    
+    Returns:
+        A summary dict with keys "created", "updated", "deleted" (lists of dataset names)
+        and "failed" (dict of dataset name: error message)
+    """
+    ops = ([("package_create", d["name"], d) for d in plan["creates"]] + 
+           [("package_update", u["name"], dict(u["package"], id=u["id"])) 
+            for u in plan["updates"]])
+    if delete and plan.get("refused"):
+        print("[apply_plan] Not deleting {0} datasets, the plan refused them".format(
+                len(plan["deletions"])))
+    elif delete:
+        ops += [("package_delete", n, {"id": n}) for n in plan["deletions"]]
+    
+    labels = {"package_create": "created", "package_update": "updated", 
+              "package_delete": "deleted"}
+    summary = {"created": [], "updated": [], "deleted": [], "failed": dict()}
+    for ((action, name, data), error) in _write_batches(ops, ckanapi, batch_size=batch_size, 
+                                                       workers=workers, caller="apply_plan", 
+                                                       debug=debug):
+        if error is None:
+            summary[labels[action]].append(name)
+        else:
+            summary["failed"][name] = error
+    
+    print("Done! Created {0}, updated {1}, deleted {2}, failed {3} datasets.".format(
+            len(summary["created"]), len(summary["updated"]), 
+            len(summary["deleted"]), len(summary["failed"])))
+    return summary
+
+
+#-------------------------------------------------------------------------------------#
+# Stale Dataset Reaper
+#-------------------------------------------------------------------------------------#
+def _url_under(url, prefix):
+    """Return whether a canonical URL is a prefix URL or underneath it
+    
+    >>> _url_under("http://example.com/arcgis/rest/services/QC/MapServer/WMSServer", 
+    ...            "http://example.com/arcgis/rest/services")
+    True
+    >>> _url_under("http://example.com/arcgis/rest/services2", "http://example.com/arcgis/rest/services")
+    False
+    """
+    return url == prefix or url.startswith(prefix + "/") or url.startswith(prefix + "?")
+
+
+def dataset_names(*data_dicts):
+    """Return the set of dataset names of lists of package dicts or dataset names
+    
+    >>> sorted(dataset_names([{"name": "a"}, None], ["b"]))
+    ['a', 'b']
+    """
+    names = set()
+    for datasets in data_dicts:
+        for d in datasets:
+            if isinstance(d, dict):
+                names.add(d["name"])
+            elif d is not None:
+                names.add(d)
+    return names
+
+
+def source_datasets(catalogue, source_urls, tag="Harvested"):
+    """Return the sorted names of catalogue packages tagged `tag` with a resource from a source
+    
+    A resource is from a source if its URL is the source URL or underneath it, 
+    e.g. an ArcGIS service's WMSServer underneath the ArcGIS REST root URL.
+    
+    Arguments:
+        catalogue (dict) A name-indexed snapshot of the catalogue's packages, 
+            e.g. output of `get_package_index` or `CatalogueMirror.index`
+        source_urls (list) The source URLs, as passed to `get_layer_dict`,
+            `get_layer_dict_gs28` or `harvest_arcgis_service`
+        tag (String) The tag of harvested datasets, default: "Harvested"
+    
+    Returns:
+        A sorted list of dataset names
+    """
+    prefixes = [canonical_url(u) for u in source_urls if u]
+    names = []
+    for (name, package) in catalogue.items():
+        tags = [t["name"] if isinstance(t, dict) else t for t in package.get("tags") or []]
+        if tag is not None and tag not in tags:
+            continue
+        urls = [canonical_url(r.get("url")) for r in package.get("resources") or []]
+        if any(_url_under(url, prefix) for url in urls for prefix in prefixes):
+            names.append(name)
+    return sorted(names)
+
+
+def reap_datasets(names, source_urls, ckanapi, catalogue=None, tag="Harvested", 
+                  purge=False, dry_run=True, max_fraction=0.1, batch_size=100, 
+                  workers=4, debug=False):
+    """Delete harvested datasets of some sources whose source layers have disappeared
+    
+    The stale datasets are the harvested datasets of the sources (see `source_datasets`)
+    minus the datasets harvested from the sources in this run. Pass the names from 
+    all sources which write resources into the same datasets, e.g. a SLIP WMS and 
+    its WFS, and only after all of them were read without errors: a layer which 
+    failed to convert looks like a layer which disappeared.
+    
+    If the stale datasets exceed `max_fraction` of the sources' datasets, nothing 
+    is deleted, so that a broken or empty source does not empty the catalogue.
+    
+    Example:
+    l_wmsP = get_layer_dict(wmsP, wmsP_url, ckan, orgs, groups, pdfs)
+    l_wfsP = get_layer_dict(wfsP, wfsP_url, ckan, orgs, groups, pdfs, res_format="WFS")
+    reaped = reap_datasets(dataset_names(l_wmsP, l_wfsP), [wmsP_url, wfsP_url], ckan)
+    reaped = reap_datasets(dataset_names(l_wmsP, l_wfsP), [wmsP_url, wfsP_url], ckan, 
+                           dry_run=False)
+    
+    Arguments:
+        names (set) The names of all datasets harvested from the sources, 
+            e.g. output of `dataset_names`
+        source_urls (list) The source URLs, see `source_datasets`
+        ckanapi (ckanapi) A ckanapi object (created with CKAN url and write-permitted api key)
+        catalogue (dict) A name-indexed snapshot of the catalogue, default: 
+            `get_package_index` of the tag
+        tag (String) The tag of harvested datasets, default: "Harvested"
+        purge (Boolean) Whether to purge (`dataset_purge`) instead of delete, default: False
+        dry_run (Boolean) Whether to only report the stale datasets (default)
+        max_fraction (float) The highest fraction of the sources' datasets to delete, 
+            default: 0.1
+        batch_size (int) The number of deletions per batch, default: 100
+        workers (int) The number of worker threads, default: 4
+        debug (Boolean) Debug noise level
+    
+    Returns:
+        A summary dict with keys "stale" and "deleted" (lists of dataset names), 
+        "failed" (dict of dataset name: error message), "datasets" (the number of 
+        the sources' datasets), "fraction" (of stale datasets), and "refused" 
+        (whether the fraction exceeded max_fraction)
+    """
+    if catalogue is None:
+        catalogue = get_package_index(ckanapi, tag=tag, debug=debug)
+    datasets = source_datasets(catalogue, source_urls, tag=tag)
+    names = set(names)
+    stale = [n for n in datasets if n not in names]
+    fraction = float(len(stale)) / len(datasets) if datasets else 0.0
+    summary = {"stale": stale, "deleted": [], "failed": dict(), "datasets": len(datasets),
+               "fraction": fraction, "refused": fraction > max_fraction}
+    print("[reap_datasets] {0} of {1} harvested datasets of {2} sources are stale ({3:.1%})".format(
+            len(stale), len(datasets), len(source_urls), fraction))
+    if summary["refused"]:
+        print("[reap_datasets] Refusing to delete more than {0:.1%}, check the sources "
+              "or raise max_fraction".format(max_fraction))
+    if dry_run or summary["refused"] or not stale:
+        return summary
+    
+    action = "dataset_purge" if purge else "package_delete"
+    ops = [(action, name, {"id": catalogue[name].get("id") or name}) for name in stale]
+    for ((action, name, data), error) in _write_batches(ops, ckanapi, batch_size=batch_size, 
+                                                       workers=workers, caller="reap_datasets", 
+                                                       debug=debug):
+        if error is None:
+            summary["deleted"].append(name)
+        else:
+            summary["failed"][name] = error
+    print("Done! {0} {1}, failed {2} datasets.".format(
+            "Purged" if purge else "Deleted", len(summary["deleted"]), len(summary["failed"])))
+    return summary
+
+
+#-------------------------------------------------------------------------------------#
+# Harvest State
+#-------------------------------------------------------------------------------------#
+class HarvestState(object):
+    """A persistent record of the layers harvested from each source, in a local SQLite file
+    
+    Each layer is keyed by source URL and layer name (e.g. "DAA-001"), and records
+    the layer's last updated timestamp as parsed from its title (see `parse_name`),
+    the fingerprint of its package dict (see `package_fingerprint`), the dataset name 
+    and the time of harvest.
+    
+    Layers without a timestamp of their own, such as SLIP's WFS layers, inherit the 
+    newest timestamp recorded for the same layer name from any source, and are 
+    harvested again whenever the same layer name is staged from another source, 
+    as writing that source's layer may replace their resources. Without any timestamp, 
+    a layer counts as current if its fingerprint is unchanged.
+    
+    `get_layer_dict` stages layers, `upsert_datasets` commits them once CKAN
+    carries their timestamp and saves the state.
+    
+    Example:
+    state = HarvestState("harvest_state.sqlite")
+    l_wmsP = get_layer_dict(wmsP, wmsP_url, ckan, orgs, groups, pdfs, state=state)
+    l_wfsP = get_layer_dict(wfsP, wfsP_url, ckan, orgs, groups, pdfs, res_format="WFS", state=state)
+    p_wmsP = upsert_datasets(l_wmsP, ckan, state=state)
+    p_wfsP = upsert_datasets(l_wfsP, ckan, overwrite_metadata=False, 
+                             drop_existing_resources=False, state=state)
+    
+    Arguments:
+        path (String) The SQLite file, default: "harvest_state.sqlite"
+    """
+    
+    def __init__(self, path="harvest_state.sqlite"):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS layers ("
+                        "source TEXT, layer TEXT, updated TEXT, fingerprint TEXT, "
+                        "dataset TEXT, harvested TEXT, PRIMARY KEY (source, layer))")
+        self.layers = dict(((row[0], row[1]), row[2:]) for row in self.db.execute(
+                "SELECT source, layer, updated, fingerprint, dataset, harvested FROM layers"))
+        self.staged = dict()
+        self.staged_layers = set()
+        self.dirty = set()
+        self.latest = dict()
+        for ((source, layer), row) in self.layers.items():
+            self._track(layer, row[0])
+    
+    def _track(self, layer, updated):
+        if updated is not None and updated > self.latest.get(layer, ""):
+            self.latest[layer] = updated
+    
+    def updated(self, layer, updated=None):
+        """Return a layer's timestamp, or the newest recorded for its layer name"""
+        return updated or self.latest.get(layer)
+    
+    def is_current(self, source, layer, updated=None, fingerprint=None):
+        """Return whether a layer has been harvested from a source since it was last updated
+        
+        Arguments:
+            source (String) The source URL
+            layer (String) The layer name
+            updated (String) The layer's last updated ISO timestamp, optional
+            fingerprint (String) The `package_fingerprint` of the layer's package dict, optional
+        
+        Returns:
+            Boolean
+        """
+        row = self.layers.get((source, layer))
+        if row is None or (updated is None and layer in self.staged_layers):
+            return False
+        updated = self.updated(layer, updated)
+        if updated is not None and row[0] is not None:
+            return updated <= row[0]
+        return fingerprint is not None and fingerprint == row[1]
+    
+    def accept(self, source, layer, updated, data_dict):
+        """Stage a converted layer and return True, or return False if it is current"""
+        if self.is_current(source, layer, updated):
+            return False
+        fingerprint = package_fingerprint(data_dict)
+        if self.is_current(source, layer, updated, fingerprint):
+            return False
+        self.stage(source, layer, updated, fingerprint, data_dict["name"])
+        return True
+    
+    def select(self, source, items):
+        """Return the package dicts of new or updated layers from `get_layer_items`, staged"""
+        return [d for (layer, updated, d) in items 
+                if d is None or not layer or self.accept(source, layer, updated, d)]
+    
+    def stage(self, source, layer, updated, fingerprint, dataset):
+        """Stage a converted layer to be recorded once `commit`ted"""
+        updated = self.updated(layer, updated)
+        self.staged[(source, layer)] = (updated, fingerprint, dataset)
+        self.staged_layers.add(layer)
+        self._track(layer, updated)
+    
+    def commit(self, data_dict, package=None):
+        """Record the staged layers of a package dict written to CKAN
+        
+        Layers whose timestamp is newer than the `last_updated_on` of the package
+        in CKAN, e.g. as the write was skipped, stay staged and are harvested again.
+        
+        Arguments:
+            data_dict (dict) The package dict passed to the upsert
+            package (dict) The package in CKAN after the upsert, optional
+        """
+        harvested = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        written = (package or dict()).get("last_updated_on")
+        for r in data_dict.get("resources", []):
+            for fmt in ("wms", "wfs"):
+                key = (r.get("url"), r.get("{0}_layer".format(fmt)))
+                if key not in self.staged:
+                    continue
+                updated = self.staged[key][0]
+                if written and updated and written[:19] < updated:
+                    print("[HarvestState] {0} in CKAN is older than layer {1}, "
+                          "keeping it staged".format(package.get("name"), key[1]))
+                    continue
+                self.layers[key] = self.staged.pop(key) + (harvested,)
+                self.dirty.add(key)
+    
+    def save(self):
+        """Write all committed layers to the SQLite file in one transaction"""
+        rows = [key + self.layers[key] for key in self.dirty]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO layers VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.dirty.clear()
+    
+    def forget(self, source=None):
+        """Forget all layers, or all layers of one source, to force a full harvest"""
+        keys = [k for k in self.layers if source is None or k[0] == source]
+        with self.db:
+            self.db.executemany("DELETE FROM layers WHERE source = ? AND layer = ?", keys)
+        for key in keys:
+            self.layers.pop(key)
+            self.dirty.discard(key)
+        self.latest = dict()
+        for ((source, layer), row) in self.layers.items():
+            self._track(layer, row[0])
+    
+    def close(self):
+        self.save()
+        self.db.close()
+
+
+#-------------------------------------------------------------------------------------#
+# Run Journal
+#-------------------------------------------------------------------------------------#
+def journal_key(dataset):
+    """Return the journal key of upserting a package dict, by dataset name and resource URLs
+    
+    The same dataset is written once per source, e.g. from a WMS and a WFS.
+    
+    >>> journal_key({"name": "a", "resources": [{"url": "http://x/wfs"}, {"url": "http://x/wms/"}]})
+    'dataset:a@http://x/wfs,http://x/wms'
+    """
+    urls = sorted(set(canonical_url(r.get("url")) for r in dataset.get("resources") or []))
+    return "dataset:{0}@{1}".format(dataset.get("name"), ",".join(urls))
+
+
+class RunJournal(object):
+    """A durable journal of the items of a harvest run, to resume a run that died
+    
+    Each item, e.g. a dataset or an ArcGIS layer, is journalled as "started" 
+    before and "done" or "failed" after processing, one JSON line per record. 
+    Every record is flushed to disk before processing continues, and a torn last
+    line from a crash is dropped on loading. 
+    
+    Resuming a run with the same run id skips all items done before. Items which
+    failed or were started but not finished are processed again, which is safe as 
+    upserts look up existing datasets first. `complete` compacts the journal to
+    the last record of each item.
+    
+    Example:
+    journal = RunJournal("slip-2015-10-05")
+    p_wmsP = upsert_datasets(l_wmsP, ckan, journal=journal)
+    failed = harvest_arcgis_service(url, ckan, None, "Landgate", "", journal=journal)
+    journal.complete()
+    
+    Arguments:
+        run_id (String) The run id, e.g. a date. Reuse a run id to resume its run.
+        journal_dir (String) The directory of the journal files, default: "harvest_journal"
+        sync (Boolean) Whether to fsync each record, default: True
+    """
+    
+    def __init__(self, run_id, journal_dir="harvest_journal", sync=True):
+        self.run_id = run_id
+        self.sync = sync
+        if not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+        self.path = os.path.join(journal_dir, "{0}.jsonl".format(slugify(run_id)))
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.completed = None
+        self._load()
+        self.file = open(self.path, "a")
+        done = self.report().get("done", 0)
+        if done:
+            print("[RunJournal] Resuming run {0}, skipping {1} done items".format(run_id, done))
+    
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            # Drop a torn last record
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+            if "key" in record:
+                self.items[record["key"]] = record
+            elif record.get("status") == "complete":
+                self.completed = record["time"]
+    
+    def _append(self, record):
+        record["time"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self.lock:
+            if "key" in record:
+                self.items[record["key"]] = record
+            self.file.write(line)
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+    
+    def status(self, key):
+        """Return the last status of an item, or None if not journalled"""
+        record = self.items.get(key)
+        return record["status"] if record else None
+    
+    def is_done(self, key):
+        return self.status(key) == "done"
+    
+    def start(self, key):
+        self._append({"key": key, "status": "started"})
+    
+    def done(self, key, **info):
+        """Record an item as done, with any JSON-serialisable info, e.g. the action taken"""
+        self._append(dict(info, key=key, status="done"))
+    
+    def fail(self, key, error):
+        self._append({"key": key, "status": "failed", "error": str(error)})
+    
+    def report(self):
+        """Return the number of items by last status"""
+        counts = dict()
+        for record in self.items.values():
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+        return counts
+    
+    def compact(self):
+        """Rewrite the journal with the last record of each item, atomically"""
+        with self.lock:
+            records = list(self.items.values())
+            if self.completed:
+                records.append({"status": "complete", "time": self.completed})
+            self.file.close()
+            _write_atomic(self.path, "".join(json.dumps(r, sort_keys=True) + "\n" 
+                                             for r in records), mode="w")
+            self.file = open(self.path, "a")
+    
+    def complete(self):
+        """Mark the run as complete and compact the journal"""
+        self.completed = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        self.compact()
+        print("[RunJournal] Run {0} complete: {1}".format(self.run_id, self.report()))
+    
+    def close(self):
+        self.file.close()
+
+
+#-------------------------------------------------------------------------------------#
+# Catalogue Mirror
+#-------------------------------------------------------------------------------------#
+class CatalogueMirror(object):
+    """A local snapshot of all packages of a CKAN catalogue, in a SQLite file
+    
+    The first `refresh` reads all packages in pages of `package_search`. Further
+    refreshes only read packages modified since the newest `metadata_modified` seen, 
+    and drop deleted packages after one `package_list`. Packages are stored as 
+    compressed JSON, with their name, organisation and tags indexed for local lookups.
+    
+    Example:
+    mirror = CatalogueMirror(ckan, "catalogue_mirror.sqlite")
+    mirror.refresh()
+    kill_list = [n for n in mirror.names() if re.match(r"(.)*-[0-9][0-9][0-9]$", n)]
+    p_wmsP = upsert_datasets_concurrently(l_wmsP, ckan, package_index=mirror.index("Harvested"))
+    restore_extents(m, e, ckan, packages=mirror.packages())
+    
+    Arguments:
+        ckanapi (ckanapi) A ckanapi instance with at least read permission
+        path (String) The SQLite file, default: "catalogue_mirror.sqlite"
+    """
+    
+    def __init__(self, ckanapi, path="catalogue_mirror.sqlite"):
+        self.ckanapi = ckanapi
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS packages ("
+                        "name TEXT PRIMARY KEY, id TEXT, organization TEXT, "
+                        "metadata_modified TEXT, package BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tags ("
+                        "name TEXT, tag TEXT, PRIMARY KEY (name, tag))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS packages_org ON packages (organization)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+    
+    def _meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def modified(self):
+        """Return the newest `metadata_modified` in the mirror, or None if empty"""
+        return self.db.execute("SELECT MAX(metadata_modified) FROM packages").fetchone()[0]
+    
+    def refresh(self, full=False, prune=True, rows=1000, debug=False):
+        """Read new and modified packages from CKAN into the mirror
+        
+        Arguments:
+            full (Boolean) Whether to read all packages again, default: False.
+                A mirror of a different CKAN is always read in full.
+            prune (Boolean) Whether to drop packages no longer in `package_list`, 
+                default: True
+            rows (int) The page size of `package_search`, default: 1000
+            debug (Boolean) Debug noise level
+        
+        Returns:
+            A dict with keys "read" and "deleted", the number of packages read and dropped
+        """
+        address = self.ckanapi.address
+        since = self.modified()
+        if full or since is None or self._meta("address") != address:
+            with self.db:
+                self.db.execute("DELETE FROM packages")
+                self.db.execute("DELETE FROM tags")
+            since = None
+        
+        # Page by keyset rather than by offset: packages modified while paging
+        # move to the end of the sort order instead of shifting later pages.
+        # Solr range queries have second precision, so each page re-reads the
+        # packages of the last second seen; those are de-duplicated by id.
+        # Only a page made up entirely of one second advances by offset.
+        bound = since[:19] if since else None
+        start = 0
+        seen = dict()
+        read = 0
+        while True:
+            fq = "metadata_modified:[{0}Z TO *]".format(bound) if bound else ""
+            res = ckan_action(self.ckanapi, "package_search", q="*:*", fq=fq, rows=rows, 
+                              start=start, sort="metadata_modified asc, id asc")
+            page = res["results"]
+            fresh = [p for p in page 
+                     if seen.get(p.get("id") or p["name"]) != p.get("metadata_modified")]
+            for p in fresh:
+                seen[p.get("id") or p["name"]] = p.get("metadata_modified")
+            read += self.store(fresh)
+            if debug:
+                print("[CatalogueMirror] Read {0} new of {1} packages since {2}".format(
+                        len(fresh), res["count"], bound))
+            if not page or start + len(page) >= res["count"]:
+                break
+            newest = max((p.get("metadata_modified") or "")[:19] for p in page)
+            if bound is None or newest > bound:
+                (bound, start) = (newest, 0)
+            else:
+                start += len(page)
+        
+        deleted = 0
+        if prune and since is not None:
+            live = set(ckan_action(self.ckanapi, "package_list"))
+            gone = [(n,) for n in self.names() if n not in live]
+            with self.db:
+                self.db.executemany("DELETE FROM packages WHERE name = ?", gone)
+                self.db.executemany("DELETE FROM tags WHERE name = ?", gone)
+            deleted = len(gone)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('address', ?)", (address,))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('refreshed', ?)", 
+                            (datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),))
+        print("[CatalogueMirror] {0} packages mirrored, {1} read, {2} dropped".format(
+                len(self), read, deleted))
+        return {"read": read, "deleted": deleted}
+    
+    def store(self, packages):
+        """Write package dicts into the mirror in one transaction, return their number"""
+        rows = []
+        tags = []
+        for p in packages:
+            org = p.get("organization")
+            org = org["name"] if isinstance(org, dict) else p.get("owner_org")
+            blob = zlib.compress(json.dumps(p, separators=(",", ":")).encode("utf-8"))
+            rows.append((p["name"], p.get("id"), org, p.get("metadata_modified"), 
+                         sqlite3.Binary(blob)))
+            tags.extend((p["name"], t["name"] if isinstance(t, dict) else t) 
+                        for t in p.get("tags") or [])
+        with self.db:
+            self.db.executemany("DELETE FROM tags WHERE name = ?", [(r[0],) for r in rows])
+            self.db.executemany("INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.executemany("INSERT OR IGNORE INTO tags VALUES (?, ?)", tags)
+        return len(rows)
+    
+    def _load(self, blob):
+        return json.loads(zlib.decompress(bytes(blob)).decode("utf-8"))
+    
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM packages").fetchone()[0]
+    
+    def __contains__(self, name):
+        return self.db.execute("SELECT 1 FROM packages WHERE name = ?", (name,)).fetchone() is not None
+    
+    def get(self, name):
+        """Return a package dict by name, or None"""
+        row = self.db.execute("SELECT package FROM packages WHERE name = ?", (name,)).fetchone()
+        return self._load(row[0]) if row else None
+    
+    def names(self, tag=None, organization=None):
+        """Return the sorted names of all packages, optionally with a tag and/or of an organisation"""
+        return [row[0] for row in self._select("p.name", tag, organization)]
+    
+    def packages(self, tag=None, organization=None):
+        """Yield all package dicts by name, optionally with a tag and/or of an organisation"""
+        for row in self._select("p.package", tag, organization):
+            yield self._load(row[0])
+    
+    def index(self, tag=None, organization=None):
+        """Return a name-indexed dict of package dicts, like `get_package_index`"""
+        return dict((p["name"], p) for p in self.packages(tag, organization))
+    
+    def _select(self, column, tag=None, organization=None):
+        sql = ["SELECT {0} FROM packages p".format(column)]
+        where = []
+        args = []
+        if tag is not None:
+            sql.append("JOIN tags t ON t.name = p.name")
+            where.append("t.tag = ?")
+            args.append(tag)
+        if organization is not None:
+            where.append("p.organization = ?")
+            args.append(organization)
+        if where:
+            sql.append("WHERE " + " AND ".join(where))
+        sql.append("ORDER BY p.name")
+        return self.db.execute(" ".join(sql), args)
+    
+    def close(self):
+        self.db.close()
+
+
+#-------------------------------------------------------------------------------------#
+# Implicit Georeferencing
+#-------------------------------------------------------------------------------------#
+# Weights of a synonym found in a package field, used to resolve conflicting extents
+GEOREF_FIELD_WEIGHTS = (("title", 3), ("tags", 2), ("notes", 1))
+
+
+def _normalise_term(text):
+    """Return a lower case text with collapsed whitespace
+    
+    >>> _normalise_term(" Shark   Bay ")
+    'shark bay'
+    """
+    return " ".join(text.lower().split())
+
+
+def add_spatial(dsdict, extent_string, force=False, debug=False):
+    """Adds a given spatial extent to a CKAN dataset dict if 
+        "spatial" is None, "" or force==True.
+    
+    Arguments:
+        dsdict (ckanapi.action.package_show()) CKAN dataset dict
+        extent_string (String) GeoJSON geometry as json.dumps String
+        force (Boolean) Whether to force overwriting "spatial"
+        debug (Boolean) Debug noise
+    
+    Returns:
+        (dict) The dataset with spatial extent replaced per above rules.
+    """ 
+    if "spatial" not in dsdict or dsdict["spatial"] is None:
+        overwrite = True
+        msg = "Spatial extent not given"
+    elif dsdict["spatial"] == "":
+        overwrite = True
+        msg = "Spatial extent is empty"
+    elif force:
+        overwrite = True
+        msg = "Spatial extent was overwritten"
+    else:
+        overwrite = False
+        msg = "Spatial extent unchanged"
+
+    if overwrite:
+        dsdict["spatial"] = extent_string
+    
+    if debug:
+        print("[add_spatial] {0}: {1}".format(dsdict.get("name"), msg))
+    return dsdict
+
+
+def merge_extents(extent_strings):
+    """Return the union of GeoJSON Polygon and MultiPolygon strings as one MultiPolygon
+    
+    The polygons are collected, not dissolved.
+    
+    >>> merge_extents(['{"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [0, 1], [0, 0]]]}',
+    ...                '{"type": "MultiPolygon", "coordinates": [[[[5, 5], [6, 5], [5, 6], [5, 5]]]]}'])
+    '{"type": "MultiPolygon", "coordinates": [[[[0, 0], [1, 0], [0, 1], [0, 0]]], [[[5, 5], [6, 5], [5, 6], [5, 5]]]]}'
+    """
+    polygons = []
+    for extent in extent_strings:
+        geom = json.loads(extent)
+        if geom["type"] == "Polygon":
+            polygons.append(geom["coordinates"])
+        elif geom["type"] == "MultiPolygon":
+            polygons.extend(geom["coordinates"])
+        else:
+            raise ValueError("Cannot merge a {0} extent".format(geom["type"]))
+    return json.dumps({"type": "MultiPolygon", "coordinates": polygons})
+
+
+class ExtentMatcher(object):
+    """Find the extent names of all synonyms in a package dict in one pass
+    
+    All free text synonyms are compiled into one regular expression, which finds 
+    whole words and phrases, ignoring case and whitespace differences, in the title, 
+    tags and notes. A synonym "tags:<tag>" matches a tag name exactly, like the 
+    corresponding CKAN search.
+    
+    >>> m = ExtentMatcher([{"s": "Shark bay", "i": "MPA Shark Bay"}, {"s": "SBMP", "i": "MPA Shark Bay"},
+    ...                    {"s": "Ningaloo", "i": "MPA Ningaloo"}, {"s": "tags:nmp", "i": "MPA Ningaloo"}])
+    >>> sorted(m.match({"title": "Seagrass in Shark  Bay", "notes": "Not Ningaloos", 
+    ...                 "tags": [{"name": "nmp"}]}).items())
+    [('MPA Ningaloo', 2), ('MPA Shark Bay', 3)]
+    """
+    
+    def __init__(self, search_mapping, weights=GEOREF_FIELD_WEIGHTS):
+        """Compile a list of dicts with keys "s" (synonym) and "i" (extent name)"""
+        self.weights = weights
+        self.terms = dict()
+        self.tags = dict()
+        self.order = dict()
+        for x in search_mapping:
+            self.order.setdefault(x["i"], len(self.order))
+            term = x["s"].strip()
+            if term.lower().startswith("tags:"):
+                (lookup, term) = (self.tags, term[5:].strip('"'))
+            else:
+                (lookup, term) = (self.terms, _normalise_term(term))
+            names = lookup.setdefault(term, [])
+            if x["i"] not in names:
+                names.append(x["i"])
+        
+        # Longest first, so that the longest of overlapping synonyms wins
+        patterns = [r"\s+".join(re.escape(word) for word in t.split()) 
+                    for t in sorted(self.terms, key=len, reverse=True)]
+        self.regex = None
+        if patterns:
+            self.regex = re.compile(r"(?<!\w)(?:{0})(?!\w)".format("|".join(patterns)), 
+                                    re.I | re.U)
+    
+    def find(self, text):
+        """Return the set of extent names of all free text synonyms in a text"""
+        found = set()
+        if text and self.regex is not None:
+            for hit in self.regex.findall(text):
+                found.update(self.terms[_normalise_term(hit)])
+        return found
+    
+    def match(self, package):
+        """Return a dict of extent name: score of all synonyms in a package dict
+        
+        The score of an extent adds up the weights of the fields it was found in.
+        """
+        tags = [t["name"] if isinstance(t, dict) else t for t in package.get("tags") or []]
+        scores = dict()
+        for (field, weight) in self.weights:
+            if field == "tags":
+                found = self.find(" , ".join(tags))
+                for tag in tags:
+                    found.update(self.tags.get(tag, []))
+            else:
+                found = self.find(package.get(field))
+            for name in found:
+                scores[name] = scores.get(name, 0) + weight
+        return scores
+    
+    def resolve(self, scores, conflict="best"):
+        """Return the list of extent names to apply from the output of `match`
+        
+        Arguments:
+            scores (dict) The output of `match`
+            conflict (String) "best" for the single highest scoring extent, ties broken 
+                by the order of the search mapping, or "merge" for all extents in order
+                of descending score
+        """
+        ranked = sorted(scores, key=lambda name: (-scores[name], self.order[name]))
+        if conflict == "best":
+            return ranked[:1]
+        if conflict == "merge":
+            return ranked
+        raise ValueError("Unknown conflict resolution {0}".format(conflict))
+
+
+def restore_extents(search_mapping, extents, ckanapi, packages=None, force=True, 
+                    conflict="best", workers=1, dry_run=False, debug=False):
+    """Restore spatial extents for datasets from extent names in their title, tags or notes
+    
+    Scans all packages of the catalogue once, in pages of `package_search`, matches all
+    synonyms in one pass (see `ExtentMatcher`), and writes each changed dataset once.
+    Datasets matching synonyms of several extents get the extent chosen by `conflict`,
+    and are reported under "conflicts".
+    
+    Arguments:
+        search_mapping (list) A list of dicts with keys "s" for the synonym, 
+            and key "i" for the name of the extent
+            e.g.:
+            m = [
+                {"s":"Eighty Mile", "i":"MPA Eighty Mile Beach"},
+                {"s":"tags:marinepark_80_mile_beach", "i":"MPA Eighty Mile Beach"},
+                ...
+            ]
+        extents (dict) A dict with key "i" (extent name) and 
+        GeoJSON Multipolygon geometry strings as value, e.g.:
+        {u'MPA Eighty Mile Beach': '{"type": "MultiPolygon", "coordinates": [ .... ]', ...}
+        or an `ExtentCache` to write simplified extents
+        ckanapi (ckanapi) A ckanapi instance, with write permission unless dry_run
+        packages (iterable) The package dicts to georeference, default: all packages
+            from `search_packages`
+        force (Boolean) Whether to overwrite existing extents, default: True
+        conflict (String) "best" or "merge", see `ExtentMatcher.resolve`
+        workers (int) The number of worker threads writing to CKAN, default: 1
+        dry_run (Boolean) Whether to only report the changes, default: False
+        debug (Boolean) Debug noise
+    
+    Returns:
+        A summary dict with keys "matched", "updated" and "unchanged" (lists of 
+        dataset names), "conflicts" (dict of dataset name: list of extent names 
+        by descending score), "failed" (dict of dataset name: error message), 
+        "packages" (the number of packages scanned) and "spatial_bytes" (the size of
+        the extents to write)
+    """
+    matcher = ExtentMatcher(search_mapping)
+    unknown = sorted(set(matcher.order) - set(extents))
+    if unknown:
+        raise ValueError("Unknown extents {0}".format(", ".join(unknown)))
+    if packages is None:
+        packages = search_packages(ckanapi, debug=debug)
+    
+    summary = {"matched": [], "updated": [], "unchanged": [], "conflicts": dict(), 
+               "failed": dict(), "packages": 0, "spatial_bytes": 0}
+    changed = []
+    for package in packages:
+        summary["packages"] += 1
+        scores = matcher.match(package)
+        if not scores:
+            continue
+        summary["matched"].append(package["name"])
+        names = matcher.resolve(scores, conflict=conflict)
+        if len(scores) > 1:
+            summary["conflicts"][package["name"]] = matcher.resolve(scores, conflict="merge")
+            if debug:
+                print("[restore_extents] {0} matches {1}, using {2}".format(
+                        package["name"], scores, names))
+        if len(names) == 1:
+            extent = extents[names[0]]
+        else:
+            extent = merge_extents([extents[name] for name in names])
+        fixed = add_spatial(dict(package), extent, force=force, debug=debug)
+        if fixed.get("spatial") == package.get("spatial"):
+            summary["unchanged"].append(package["name"])
+        else:
+            changed.append(fixed)
+            summary["spatial_bytes"] += len(extent)
+    print("[restore_extents] Matched {0} of {1} packages, {2} to update ({3} bytes of "
+          "extents), {4} conflicts".format(
+            len(summary["matched"]), summary["packages"], len(changed), 
+            summary["spatial_bytes"], len(summary["conflicts"])))
+    if dry_run:
+        summary["updated"] = [p["name"] for p in changed]
+        return summary
+    
+    ops = [("package_update", p["name"], p) for p in changed]
+    for ((action, name, data), error) in _write_batches(ops, ckanapi, workers=workers, 
+                                                       caller="restore_extents", debug=debug):
+        if error is None:
+            summary["updated"].append(name)
+        else:
+            summary["failed"][name] = error
+    print("Done! Updated {0}, unchanged {1}, failed {2} datasets.".format(
+            len(summary["updated"]), len(summary["unchanged"]), len(summary["failed"])))
+    return summary
+
+
+# A generous bounding box of Western Australia and its marine parks, as WGS84 
+# (min lon, min lat, max lon, max lat), outside which extents are implausible
+PLAUSIBLE_BBOX = (108.0, -40.0, 132.0, -9.0)
+
+
+def _polygons(geometry):
+    """Return the polygons (lists of rings) of a GeoJSON Polygon or MultiPolygon dict"""
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    raise ValueError("Not a polygon geometry: {0}".format(geometry["type"]))
+
+
+def geometry_bbox(geometry):
+    """Return the bounding box (min x, min y, max x, max y) of a GeoJSON geometry
+    
+    >>> geometry_bbox('{"type": "MultiPolygon", "coordinates": [[[[115, -32], [116, -32], [116, -31], [115, -32]]]]}')
+    (115, -32, 116, -31)
+    
+    Arguments:
+        geometry (dict or String) A GeoJSON geometry or its JSON string
+    
+    Returns:
+        A tuple of four numbers
+    
+    Raises:
+        ValueError for an invalid or empty geometry
+    """
+    if isinstance(geometry, string_types):
+        geometry = json.loads(geometry)
+    xs = []
+    ys = []
+    stack = [geometry["coordinates"]]
+    while stack:
+        c = stack.pop()
+        if c and isinstance(c[0], (int, float)):
+            xs.append(c[0])
+            ys.append(c[1])
+        else:
+            stack.extend(c)
+    if not xs:
+        raise ValueError("Empty geometry")
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def extent_problem(bbox, plausible_bbox=PLAUSIBLE_BBOX):
+    """Return why a WGS84 bounding box is implausible, or None if it is plausible
+    
+    >>> extent_problem((115.0, -32.0, 116.0, -31.0)) is None
+    True
+    >>> extent_problem((0, 0, 0, 0))
+    'outside plausible area'
+    >>> extent_problem((380000.0, 6400000.0, 390000.0, 6410000.0))
+    'not WGS84'
+    """
+    (minx, miny, maxx, maxy) = bbox
+    if not all(v == v for v in bbox) or minx > maxx or miny > maxy:
+        return "invalid bbox"
+    if minx < -180 or maxx > 180 or miny < -90 or maxy > 90:
+        return "not WGS84"
+    (pminx, pminy, pmaxx, pmaxy) = plausible_bbox
+    if maxx < pminx or minx > pmaxx or maxy < pminy or miny > pmaxy:
+        return "outside plausible area"
+    if minx < pminx and miny < pminy and maxx > pmaxx and maxy > pmaxy:
+        return "larger than plausible area"
+    return None
+
+
+def _ring_area(ring):
+    return abs(sum(x0 * y1 - x1 * y0 for ((x0, y0), (x1, y1)) in 
+                   zip(ring, ring[1:] + ring[:1]))) / 2.0
+
+
+def _in_ring(x, y, ring):
+    """Return whether a point is inside a linear ring, by ray casting"""
+    inside = False
+    (x0, y0) = ring[-1][:2]
+    for point in ring:
+        (x1, y1) = point[:2]
+        if (y1 > y) != (y0 > y) and x < (x0 - x1) * (y - y1) / float(y0 - y1) + x1:
+            inside = not inside
+        (x0, y0) = (x1, y1)
+    return inside
+
+
+def _in_polygons(x, y, polygons):
+    """Return whether a point is inside any polygon's outer ring and outside its holes"""
+    return any(_in_ring(x, y, p[0]) and not any(_in_ring(x, y, h) for h in p[1:]) 
+               for p in polygons)
+
+
+class STRTree(object):
+    """A static R-tree of bounding boxes, bulk loaded by Sort-Tile-Recursive packing
+    
+    >>> tree = STRTree([((0, 0, 10, 10), "a"), ((2, 2, 3, 3), "b"), ((20, 20, 30, 30), "c")])
+    >>> sorted(tree.query((2.5, 2.5, 2.6, 2.6)))
+    ['a', 'b']
+    >>> tree.query((11, 11, 12, 12))
+    []
+    
+    Arguments:
+        entries (list) Tuples of (bbox, item), bbox as (min x, min y, max x, max y)
+        capacity (int) The maximum number of children per node, default: 16
+    """
+    
+    def __init__(self, entries, capacity=16):
+        self.capacity = capacity
+        self.size = len(entries)
+        # A node is (bbox, children, is_leaf), where the children of a leaf are entries
+        nodes = self._pack([(bbox, item) for (bbox, item) in entries], True)
+        while len(nodes) > 1:
+            nodes = self._pack(nodes, False)
+        self.root = nodes[0] if nodes else None
+    
+    def _pack(self, entries, leaf):
+        n = self.capacity
+        entries = sorted(entries, key=lambda e: e[0][0] + e[0][2])
+        leaves = int(math.ceil(len(entries) / float(n)))
+        slab = n * int(math.ceil(math.sqrt(leaves))) if leaves else 1
+        nodes = []
+        for i in range(0, len(entries), slab):
+            column = sorted(entries[i:i + slab], key=lambda e: e[0][1] + e[0][3])
+            for j in range(0, len(column), n):
+                children = column[j:j + n]
+                bbox = (min(c[0][0] for c in children), min(c[0][1] for c in children),
+                        max(c[0][2] for c in children), max(c[0][3] for c in children))
+                nodes.append((bbox, children, leaf))
+        return nodes
+    
+    def query(self, bbox):
+        """Return the items whose bounding boxes intersect a bounding box"""
+        (minx, miny, maxx, maxy) = bbox
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            (node_bbox, children, leaf) = stack.pop()
+            for child in children:
+                b = child[0]
+                if b[0] <= maxx and b[2] >= minx and b[1] <= maxy and b[3] >= miny:
+                    if leaf:
+                        found.append(child[1])
+                    else:
+                        stack.append(child)
+        return found
+    
+    def __len__(self):
+        return self.size
+
+
+class ExtentIndex(object):
+    """A spatial index of named extents to find the smallest named extent enclosing a bbox
+    
+    Each extent is parsed once. A bbox is enclosed by an extent if all its corners 
+    are inside the extent's polygons.
+    
+    >>> index = ExtentIndex({
+    ...     "WA": '{"type": "Polygon", "coordinates": [[[110, -36], [130, -36], [130, -13], [110, -13], [110, -36]]]}',
+    ...     "Perth": '{"type": "Polygon", "coordinates": [[[115, -33], [117, -33], [117, -31], [115, -31], [115, -33]]]}'})
+    >>> index.enclosing((115.5, -32.5, 116.0, -32.0))
+    'Perth'
+    >>> index.enclosing((120, -20, 121, -19))
+    'WA'
+    >>> index.enclosing((100, -20, 121, -19)) is None
+    True
+    
+    Arguments:
+        extents (dict) Extent names and GeoJSON Polygon or MultiPolygon strings or dicts
+    """
+    
+    def __init__(self, extents):
+        self.polygons = dict()
+        self.areas = dict()
+        self.bboxes = dict()
+        entries = []
+        for (name, geometry) in extents.items():
+            if isinstance(geometry, string_types):
+                geometry = json.loads(geometry)
+            polygons = _polygons(geometry)
+            self.polygons[name] = polygons
+            self.areas[name] = sum(_ring_area(p[0]) - sum(_ring_area(h) for h in p[1:]) 
+                                   for p in polygons)
+            self.bboxes[name] = geometry_bbox(geometry)
+            entries.append((self.bboxes[name], name))
+        self.tree = STRTree(entries)
+    
+    def enclosing(self, bbox):
+        """Return the name of the smallest extent enclosing a bbox, or None"""
+        (minx, miny, maxx, maxy) = bbox
+        corners = ((minx, miny), (minx, maxy), (maxx, miny), (maxx, maxy))
+        candidates = [name for name in self.tree.query(bbox) if 
+                      self.bboxes[name][0] <= minx and self.bboxes[name][1] <= miny and 
+                      self.bboxes[name][2] >= maxx and self.bboxes[name][3] >= maxy]
+        for name in sorted(candidates, key=lambda name: (self.areas[name], name)):
+            if all(_in_polygons(x, y, self.polygons[name]) for (x, y) in corners):
+                return name
+        return None
+
+
+def assign_extents(extents, ckanapi=None, packages=None, plausible_bbox=PLAUSIBLE_BBOX,
+                   dry_run=True, batch_size=100, workers=4, debug=False):
+    """Assign each dataset the smallest named extent enclosing its spatial extent
+    
+    Reads the bbox of each dataset's `spatial` GeoJSON, e.g. as written by 
+    `bboxWGS84_to_gjMP` or `arcservice_extent_to_gjMP`, and looks up the 
+    smallest enclosing named extent in an `ExtentIndex`, all in one pass. 
+    Datasets without, with an invalid or with an implausible extent 
+    (see `extent_problem`) are flagged instead.
+    
+    Example:
+    mirror = CatalogueMirror(ckan)
+    mirror.refresh()
+    summary = assign_extents(e, packages=mirror.packages())
+    summary["flagged"]
+    summary = assign_extents(e, ckan, packages=mirror.packages(), dry_run=False)
+    
+    Arguments:
+        extents (dict) Extent names and GeoJSON Polygon or MultiPolygon strings,
+            or an `ExtentCache`, see `restore_extents`
+        ckanapi (ckanapi) A ckanapi instance, with write permission unless dry_run
+        packages (iterable) The package dicts, default: all packages from `search_packages`
+        plausible_bbox (tuple) The WGS84 bbox outside which extents are implausible,
+            default: `PLAUSIBLE_BBOX`
+        dry_run (Boolean) Whether to only report the assignments (default)
+        batch_size (int) The number of updates per batch, default: 100
+        workers (int) The number of worker threads writing to CKAN, default: 4
+        debug (Boolean) Debug noise level
+    
+    Returns:
+        A summary dict with keys 
+        "assigned" (dict of dataset name: extent name for datasets to update),
+        "unchanged" (list of dataset names which carry a named extent already),
+        "unmatched" (list of dataset names with a plausible extent within no named extent),
+        "flagged" (dict of dataset name: problem, e.g. "missing"), 
+        "updated" (list of dataset names), "failed" (dict of dataset name: error message), 
+        "packages" (the number of packages read) and "spatial_bytes" (the size of the 
+        extents to write)
+    """
+    index = ExtentIndex(extents)
+    # A dataset carrying a named extent already keeps it, even if that extent 
+    # does not enclose the corners of its own bbox
+    named = dict((geometry, name) for (name, geometry) in extents.items() 
+                 if isinstance(geometry, string_types))
+    if isinstance(extents, ExtentCache):
+        named.update((geometry, name) for ((name, t), geometry) in extents.strings.items())
+    if packages is None:
+        packages = search_packages(ckanapi, debug=debug)
+    summary = {"assigned": dict(), "unchanged": [], "unmatched": [], "flagged": dict(),
+               "updated": [], "failed": dict(), "packages": 0, "spatial_bytes": 0}
+    changed = []
+    start = time.time()
+    for package in packages:
+        summary["packages"] += 1
+        name = package["name"]
+        spatial = package.get("spatial")
+        if not spatial:
+            summary["flagged"][name] = "missing"
+            continue
+        if isinstance(spatial, string_types) and spatial in named:
+            summary["unchanged"].append(name)
+            continue
+        try:
+            bbox = geometry_bbox(spatial)
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+            summary["flagged"][name] = "invalid geometry"
+            continue
+        problem = extent_problem(bbox, plausible_bbox)
+        if problem:
+            summary["flagged"][name] = problem
+            continue
+        extent = index.enclosing(bbox)
+        if extent is None:
+            summary["unmatched"].append(name)
+        else:
+            summary["assigned"][name] = extent
+            changed.append(dict(package, spatial=extents[extent]))
+            summary["spatial_bytes"] += len(extents[extent])
+    print("[assign_extents] {0} packages in {1:.3f}s: {2} assigned ({3} bytes of extents), "
+          "{4} unchanged, {5} unmatched, {6} flagged".format(
+            summary["packages"], time.time() - start, len(summary["assigned"]), 
+            summary["spatial_bytes"], len(summary["unchanged"]), len(summary["unmatched"]), 
+            len(summary["flagged"])))
+    if dry_run or not changed:
+        return summary
+    
+    ops = [("package_update", p["name"], p) for p in changed]
+    for ((action, name, data), error) in _write_batches(ops, ckanapi, batch_size=batch_size, 
+                                                       workers=workers, caller="assign_extents", 
+                                                       debug=debug):
+        if error is None:
+            summary["updated"].append(name)
+        else:
+            summary["failed"][name] = error
+    print("Done! Updated {0}, failed {1} datasets.".format(
+            len(summary["updated"]), len(summary["failed"])))
+    return summary
+
+
+# Tolerances in degrees at which ExtentCache simplifies extents, 0 keeps them as they are
+EXTENT_TOLERANCES = (0.0, 0.001, 0.005, 0.01, 0.05)
+
+
+def _segment_distance(p, a, b):
+    """Return the planar distance of a point from a line segment"""
+    (dx, dy) = (b[0] - a[0], b[1] - a[1])
+    if dx == 0 and dy == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / float(dx * dx + dy * dy)))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def simplify_line(points, tolerance):
+    """Return the Douglas-Peucker simplification of a line, keeping its end points
+    
+    Every dropped point is within tolerance of the simplified line.
+    
+    >>> simplify_line([(0, 0), (1, 0.05), (2, -0.05), (3, 1), (4, 0)], 0.1)
+    [(0, 0), (2, -0.05), (3, 1), (4, 0)]
+    """
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        (index, distance) = (None, tolerance)
+        for i in range(first + 1, last):
+            d = _segment_distance(points[i], points[first], points[last])
+            if d > distance:
+                (index, distance) = (i, d)
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for (p, k) in zip(points, keep) if k]
+
+
+def simplify_ring(ring, tolerance):
+    """Return the Douglas-Peucker simplification of a closed linear ring
+    
+    The ring is split at its first point and the point farthest from it, 
+    so that both halves are simplified with fixed end points.
+    """
+    points = ring[:-1] if ring[0] == ring[-1] else list(ring)
+    if len(points) < 4:
+        return list(ring)
+    far = max(range(len(points)), key=lambda i: math.hypot(points[i][0] - points[0][0], 
+                                                           points[i][1] - points[0][1]))
+    first = simplify_line(points[:far + 1], tolerance)
+    second = simplify_line(points[far:] + points[:1], tolerance)
+    return first + second[1:]
+
+
+def _orientation(a, b, c):
+    v = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    return (v > 0) - (v < 0)
+
+
+def _segments_intersect(a, b, c, d):
+    """Return whether the closed segments ab and cd have a point in common"""
+    if (max(a[0], b[0]) < min(c[0], d[0]) or max(c[0], d[0]) < min(a[0], b[0]) or
+            max(a[1], b[1]) < min(c[1], d[1]) or max(c[1], d[1]) < min(a[1], b[1])):
+        return False
+    (o1, o2, o3, o4) = (_orientation(a, b, c), _orientation(a, b, d), 
+                        _orientation(c, d, a), _orientation(c, d, b))
+    if o1 != o2 and o3 != o4:
+        return True
+    # Collinear overlaps
+    return ((o1 == 0 and _on_segment(a, c, b)) or (o2 == 0 and _on_segment(a, d, b)) or 
+            (o3 == 0 and _on_segment(c, a, d)) or (o4 == 0 and _on_segment(c, b, d)))
+
+
+def _on_segment(a, p, b):
+    return min(a[0], b[0]) <= p[0] <= max(a[0], b[0]) and min(a[1], b[1]) <= p[1] <= max(a[1], b[1])
+
+
+def polygon_is_valid(rings):
+    """Return whether a polygon's rings are closed, not degenerate and do not cross
+    
+    >>> polygon_is_valid([[(0, 0), (2, 0), (2, 2), (0, 2), (0, 0)]])
+    True
+    >>> polygon_is_valid([[(0, 0), (2, 2), (2, 0), (0, 2), (0, 0)]])
+    False
+    """
+    segments = []
+    for (r, ring) in enumerate(rings):
+        if len(ring) < 4 or ring[0] != ring[-1] or _ring_area(ring[:-1]) == 0:
+            return False
+        n = len(ring) - 1
+        segments.extend((min(ring[i][0], ring[i + 1][0]), max(ring[i][0], ring[i + 1][0]), 
+                         r, i, n, ring[i], ring[i + 1]) for i in range(n))
+    # Sweep the segments by x, comparing only those overlapping in x
+    segments.sort()
+    for (j, (x1, x2, r1, i1, n1, a, b)) in enumerate(segments):
+        for (y1, y2, r2, i2, n2, c, d) in segments[j + 1:]:
+            if y1 > x2:
+                break
+            # Neighbouring segments of a ring share an end point
+            if r1 == r2 and (abs(i2 - i1) == 1 or abs(i2 - i1) == n1 - 1):
+                continue
+            if _segments_intersect(a, b, c, d):
+                return False
+    return True
+
+
+class ExtentCache(object):
+    """Named extents parsed once, simplified at several tolerances and serialised once
+    
+    Each extent's rings are simplified with Douglas-Peucker and rounded to the 
+    decimals the tolerance needs. A polygon whose simplified rings cross or 
+    collapse is simplified again at half the tolerance, down to the original. 
+    Every vertex of the original is within `error_bound(tolerance)` degrees of 
+    the simplified extent.
+    
+    The cache reads like a dict of extent names and GeoJSON strings at the
+    default tolerance, and can be passed as `extents` to `restore_extents` 
+    and `assign_extents`.
+    
+    Example:
+    extents = ExtentCache(e, tolerance=0.005)
+    extents.report()
+    restore_extents(m, extents, ckan)
+    
+    Arguments:
+        extents (dict) Extent names and GeoJSON Polygon or MultiPolygon strings
+        tolerances (tuple) The tolerances in degrees to keep, default: `EXTENT_TOLERANCES`
+        tolerance (float) The default tolerance, default: 0.005 (about 500 m)
+    """
+    
+    def __init__(self, extents, tolerances=EXTENT_TOLERANCES, tolerance=0.005):
+        self.tolerances = tuple(sorted(set(tolerances) | set([tolerance])))
+        self.tolerance = tolerance
+        self.strings = dict()
+        self.points = dict()
+        self.original_bytes = dict()
+        for (name, geometry) in extents.items():
+            self.original_bytes[name] = len(geometry) if isinstance(
+                    geometry, string_types) else len(json.dumps(geometry))
+            if isinstance(geometry, string_types):
+                geometry = json.loads(geometry)
+            polygons = [[[tuple(p[:2]) for p in ring] for ring in polygon] 
+                        for polygon in _polygons(geometry)]
+            self.points[(name, None)] = sum(len(r) for p in polygons for r in p)
+            for t in self.tolerances:
+                simplified = [self._simplify(polygon, t) for polygon in polygons]
+                self.points[(name, t)] = sum(len(r) for p in simplified for r in p)
+                self.strings[(name, t)] = json.dumps(
+                        {"type": "MultiPolygon", "coordinates": simplified}, separators=(",", ":"))
+    
+    @staticmethod
+    def decimals(tolerance):
+        """Return the decimals to round coordinates to at a tolerance, or None"""
+        if not tolerance:
+            return None
+        return max(0, int(math.ceil(-math.log10(tolerance)))) + 1
+    
+    @classmethod
+    def error_bound(cls, tolerance):
+        """Return the largest distance in degrees of an original vertex from the simplified extent"""
+        decimals = cls.decimals(tolerance)
+        if decimals is None:
+            return 0.0
+        return tolerance + 0.5 * 10 ** -decimals * math.sqrt(2)
+    
+    def _simplify(self, polygon, tolerance):
+        t = tolerance
+        while t and t >= tolerance / 64.0:
+            decimals = self.decimals(t)
+            rings = []
+            for ring in polygon:
+                rounded = [(round(x, decimals), round(y, decimals)) 
+                           for (x, y) in simplify_ring(ring, t)]
+                rings.append([p for (i, p) in enumerate(rounded) if i == 0 or p != rounded[i - 1]])
+            if polygon_is_valid(rings):
+                return [[list(p) for p in ring] for ring in rings]
+            t /= 2.0
+        return [[list(p) for p in ring] for ring in polygon]
+    
+    def get(self, name, tolerance=None):
+        """Return an extent's GeoJSON string at a cached tolerance, default: the default tolerance"""
+        return self.strings[(name, self.tolerance if tolerance is None else tolerance)]
+    
+    def __getitem__(self, name):
+        return self.get(name)
+    
+    def __contains__(self, name):
+        return name in self.original_bytes
+    
+    def __iter__(self):
+        return iter(self.original_bytes)
+    
+    def __len__(self):
+        return len(self.original_bytes)
+    
+    def keys(self):
+        return list(self.original_bytes)
+    
+    def items(self):
+        return [(name, self.get(name)) for name in self.original_bytes]
+    
+    def stats(self):
+        """Return the points and bytes of each extent at each tolerance
+        
+        Returns:
+            A list of dicts with keys "extent", "tolerance", "error_bound", "points",
+            "bytes", "original_points" and "original_bytes"
+        """
+        return [{"extent": name, "tolerance": t, "error_bound": self.error_bound(t),
+                 "points": self.points[(name, t)], "bytes": len(self.strings[(name, t)]),
+                 "original_points": self.points[(name, None)], 
+                 "original_bytes": self.original_bytes[name]}
+                for name in sorted(self.original_bytes) for t in self.tolerances]
+    
+    def report(self):
+        """Print and return the total points and bytes of all extents at each tolerance"""
+        totals = []
+        stats = self.stats()
+        for t in self.tolerances:
+            rows = [s for s in stats if s["tolerance"] == t]
+            total = {"tolerance": t, "error_bound": self.error_bound(t), 
+                     "points": sum(s["points"] for s in rows), 
+                     "bytes": sum(s["bytes"] for s in rows),
+                     "original_points": sum(s["original_points"] for s in rows), 
+                     "original_bytes": sum(s["original_bytes"] for s in rows)}
+            totals.append(total)
+            print("[ExtentCache] tolerance {0:g} (within {1:.5f} deg): {2} of {3} points, "
+                  "{4} of {5} bytes ({6:.1%}){7}".format(
+                    t, total["error_bound"], total["points"], total["original_points"], 
+                    total["bytes"], total["original_bytes"], 
+                    total["bytes"] / float(total["original_bytes"] or 1), 
+                    " (default)" if t == self.tolerance else ""))
+        return totals
+
+
+#-------------------------------------------------------------------------------------#
+# HTTP
+#-------------------------------------------------------------------------------------#
+
+_http_session = None
+_http_timeout = 30
+
+
+def configure_http_session(timeout=30, retries=5, backoff_factor=0.5, 
+                           pool_connections=10, pool_maxsize=10, 
+                           status_forcelist=(500, 502, 503, 504)):
+    """Create the shared HTTP session used by the harvest helpers.
+    
+    The session keeps connections alive in one pool per host, asks for 
+    compressed responses, and retries connection errors, read errors 
+    (e.g. connection resets) and responses with a status in `status_forcelist` 
+    with an exponential backoff of `backoff_factor * 2^(retry - 1)` seconds.
+    
+    Arguments:
+        timeout (int) Connect and read timeout in seconds, default: 30
+        retries (int) Maximum number of retries per request, default: 5
+        backoff_factor (float) Backoff factor in seconds, default: 0.5
+        pool_connections (int) Number of per-host pools to keep, default: 10
+        pool_maxsize (int) Maximum number of connections kept per host, default: 10
+        status_forcelist (tuple) HTTP status codes to retry, default: 5xx 
+        
+    Returns:
+        A requests.Session
+    """
+    global _http_session, _http_timeout
+    retry = Retry(total=retries, connect=retries, read=retries, 
+                  backoff_factor=backoff_factor, status_forcelist=status_forcelist)
+    adapter = HTTPAdapter(pool_connections=pool_connections, 
+                          pool_maxsize=pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate"})
+    _http_session = session
+    _http_timeout = timeout
+    return session
+
+
+def get_http_session():
+    """Return the shared HTTP session, creating it with defaults if required.
+    """
+    if _http_session is None:
+        configure_http_session()
+    return _http_session
+
+
+def http_get(url, **kwargs):
+    """GET a URL through the shared HTTP session.
+    
+    Arguments:
+        url (String) The URL
+        kwargs Further keyword arguments to `requests.Session.get`
+        
+    Returns:
+        A requests.Response
+        
+    Raises:
+        requests.HTTPError if the response has an error status after all retries
+    """
+    kwargs.setdefault("timeout", _http_timeout)
+    with Span("http_get", url_host(url)):
+        response = get_http_session().get(url, **kwargs)
+        response.raise_for_status()
+    return response
+
+
+def http_get_json(url, **kwargs):
+    """GET a URL through the shared HTTP session and return the parsed JSON body.
+    """
+    return json.loads(http_get(url, **kwargs).content)
+
+
+def http_stats():
+    """Return connection counters of the shared HTTP session.
+    
+    Counters cover the per-host pools the session currently holds.
+    
+    Returns:
+        A dict with keys "connections_opened", "connections_reused" and
+        "requests", and key "hosts" with the same counters per host
+    """
+    stats = {"connections_opened": 0, "connections_reused": 0, "requests": 0, 
+             "hosts": dict()}
+    if _http_session is None:
+        return stats
+    adapters = set(_http_session.adapters.values())
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened = pool.num_connections
+            requested = pool.num_requests
+            stats["hosts"]["{0}://{1}:{2}".format(pool.scheme, pool.host, pool.port)] = {
+                "connections_opened": opened, 
+                "connections_reused": max(0, requested - opened), 
+                "requests": requested}
+            stats["connections_opened"] += opened
+            stats["connections_reused"] += max(0, requested - opened)
+            stats["requests"] += requested
+    return stats
+
+
+#-------------------------------------------------------------------------------------#
+# OGC Capabilities
+#-------------------------------------------------------------------------------------#
+
+# The versions owslib requests and parses by default
+OWS_DEFAULT_VERSIONS = {"WMS": "1.1.1", "WFS": "1.0.0"}
+
+_capabilities_stats = {"hits": 0, "revalidated": 0, "misses": 0, "evictions": 0}
+
+
+def capabilities_url(url, service="WMS", version=None):
+    """Return a GetCapabilities request URL for an OGC endpoint URL.
+    
+    Parameters already present in `url` (e.g. in a proxy URL) are kept.
+    
+    >>> capabilities_url("http://example.com/ows", "WMS", "1.1.1")
+    'http://example.com/ows?service=WMS&request=GetCapabilities&version=1.1.1'
+    >>> capabilities_url("http://example.com/ows?REQUEST=GetCapabilities&SERVICE=WMS", "WMS", "1.1.1")
+    'http://example.com/ows?REQUEST=GetCapabilities&SERVICE=WMS&version=1.1.1'
+    """
+    params = [("service", service), ("request", "GetCapabilities"), ("version", version)]
+    present = url.lower()
+    extra = "&".join("{0}={1}".format(k, v) for (k, v) in params 
+                     if v and not re.search(r"[?&]{0}=".format(k), present))
+    if not extra:
+        return url
+    return url + ("&" if "?" in url else "?") + extra
+
+
+def _capabilities_paths(cache_dir, url):
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    base = os.path.join(cache_dir, key)
+    return base + ".json", base + ".xml", base + ".pickle"
+
+
+def _write_atomic(path, data, mode="wb"):
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, mode) as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def _evict_capabilities(cache_dir, max_bytes, keep=None):
+    """Delete the least recently used cache entries until the cache fits max_bytes.
+    
+    The entry with the metadata file `keep` is never evicted.
+    """
+    entries = []
+    total = 0
+    for fn in os.listdir(cache_dir):
+        if not fn.endswith(".json"):
+            continue
+        paths = [os.path.join(cache_dir, fn[:-5] + ext) for ext in (".json", ".xml", ".pickle")]
+        try:
+            with open(paths[0]) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        size = sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+        total += size
+        if paths[0] != keep:
+            entries.append((meta.get("used", 0), size, paths))
+    for (used, size, paths) in sorted(entries):
+        if total <= max_bytes:
+            break
+        for p in paths:
+            if os.path.exists(p):
+                os.remove(p)
+        total -= size
+        _capabilities_stats["evictions"] += 1
+
+
+@timed("capabilities_fetch")
+def fetch_capabilities(url, service="WMS", version=None, 
+                       cache_dir="capabilities_cache", ttl=86400, 
+                       max_bytes=512 * 1024 * 1024, auth=None, debug=False):
+    """Return the raw GetCapabilities XML of an OGC endpoint through an on-disk cache.
+    
+    Cached documents younger than `ttl` seconds are returned without a request.
+    Older documents are revalidated with their ETag / Last-Modified headers and
+    only downloaded again if the server reports a change.
+    The least recently used documents are evicted once the cache exceeds `max_bytes`.
+    
+    Arguments:
+        url (String) The OGC endpoint or GetCapabilities URL
+        service (String) The OGC service type, "WMS" or "WFS", default: "WMS"
+        version (String) The service version, default: owslib's default version
+        cache_dir (String) The cache directory, default: "capabilities_cache"
+        ttl (int) Seconds until a cached document is revalidated, default: 1 day
+        max_bytes (int) The cache size limit in bytes, default: 512 MB
+        auth (tuple) A (username, password) tuple for HTTP basic auth, optional
+        debug (Boolean) Debug noise level
+        
+    Returns:
+        A tuple of (XML String, (boolean) whether the cached document was used)
+    """
+    xml_path, cached = _refresh_capabilities(url, service=service, version=version, 
+                                             cache_dir=cache_dir, ttl=ttl, 
+                                             max_bytes=max_bytes, auth=auth, debug=debug)
+    with open(xml_path, "rb") as f:
+        return (f.read(), cached)
+
+
+def _refresh_capabilities(url, service="WMS", version=None, 
+                          cache_dir="capabilities_cache", ttl=86400, 
+                          max_bytes=512 * 1024 * 1024, auth=None, debug=False):
+    """Refresh a cached capabilities document as per `fetch_capabilities`.
+    
+    Returns:
+        A tuple of (path to the cached XML, (boolean) whether the cached document was used)
+    """
+    cap_url = capabilities_url(url, service, version or OWS_DEFAULT_VERSIONS.get(service))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    meta_path, xml_path, pickle_path = _capabilities_paths(cache_dir, cap_url)
+    
+    meta = None
+    if os.path.exists(meta_path) and os.path.exists(xml_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    
+    now = time.time()
+    if meta and now - meta["fetched"] < ttl:
+        _capabilities_stats["hits"] += 1
+        if debug:
+            print("[fetch_capabilities] Cache hit for {0}".format(cap_url))
+        status = "hit"
+    else:
+        headers = dict()
+        if meta and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        response = http_get(cap_url, headers=headers, auth=auth)
+        
+        if meta and response.status_code == 304:
+            _capabilities_stats["revalidated"] += 1
+            if debug:
+                print("[fetch_capabilities] Cache revalidated for {0}".format(cap_url))
+            status = "revalidated"
+        else:
+            _capabilities_stats["misses"] += 1
+            print("[fetch_capabilities] Downloaded {0}".format(cap_url))
+            _write_atomic(xml_path, response.content)
+            if os.path.exists(pickle_path):
+                os.remove(pickle_path)
+            meta = {"url": cap_url, 
+                    "etag": response.headers.get("ETag"), 
+                    "last_modified": response.headers.get("Last-Modified")}
+            status = "miss"
+        meta["fetched"] = now
+    
+    meta["used"] = now
+    _write_atomic(meta_path, json.dumps(meta), mode="w")
+    if status == "miss":
+        _evict_capabilities(cache_dir, max_bytes, keep=meta_path)
+    return (xml_path, status != "miss")
+
+
+@timed("get_capabilities")
+def get_capabilities(url, service="WMS", version=None, 
+                     cache_dir="capabilities_cache", ttl=86400, 
+                     max_bytes=512 * 1024 * 1024, auth=None, 
+                     pickle_parsed=False, debug=False, **kwargs):
+    """Return an owslib WebMapService or WebFeatureService loaded through the capabilities cache.
+    
+    With `pickle_parsed`, the parsed owslib object is stored next to the XML
+    and re-used while the XML is unchanged, so that parsing is skipped as well.
+    owslib objects which hold unpicklable XML trees are parsed every time.
+    
+    Example:
+    wmsP = get_capabilities(SOURCES["wmspublic"]["proxy"], "WMS")
+    wfsP = get_capabilities(SOURCES["wfspublic_4326"]["proxy"], "WFS")
+    
+    Arguments:
+        url, service, version, cache_dir, ttl, max_bytes, auth, debug: 
+            see `fetch_capabilities`
+        pickle_parsed (Boolean) Whether to cache the parsed owslib object, default: False
+        kwargs Further keyword arguments to the owslib constructor
+        
+    Returns:
+        An owslib.wms.WebMapService or owslib.wfs.WebFeatureService
+    """
+    version = version or OWS_DEFAULT_VERSIONS.get(service)
+    xml, cached = fetch_capabilities(url, service=service, version=version, 
+                                     cache_dir=cache_dir, ttl=ttl, 
+                                     max_bytes=max_bytes, auth=auth, debug=debug)
+    pickle_path = _capabilities_paths(
+        cache_dir, capabilities_url(url, service, version))[2]
+    
+    if pickle_parsed and cached and os.path.exists(pickle_path):
+        try:
+            with open(pickle_path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            print("[get_capabilities] Ignoring unreadable {0}: {1}".format(pickle_path, e))
+    
+    client = WebFeatureService if service.upper() == "WFS" else WebMapService
+    if auth:
+        kwargs.setdefault("username", auth[0])
+        kwargs.setdefault("password", auth[1])
+    wxs = client(url, version=version, xml=xml, **kwargs)
+    
+    if pickle_parsed:
+        try:
+            _write_atomic(pickle_path, pickle.dumps(wxs, pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            if debug:
+                print("[get_capabilities] Cannot pickle {0}: {1}".format(url, e))
+    return wxs
+
+
+# A lightweight stand-in for owslib's layer ContentMetadata,
+# accepted by `wxs_to_dict` and `gs28_to_ckan`
+CapabilitiesLayer = namedtuple("CapabilitiesLayer", 
+    ["name", "id", "title", "abstract", "boundingBoxWGS84", "parent", "keywords"])
+ParentLayer = namedtuple("ParentLayer", ["title"])
+
+
+def layer_record(layer, parents=None):
+    """Return a `CapabilitiesLayer` record of an owslib layer's ContentMetadata
     
-    The spreadsheet must contain the headers "name","title","url", and "logo_url",
-    corresponding to the CKAN organisation keys.
+    The record holds only the values the dataset builders read, and no 
+    reference to the owslib object, its parent layers or its XML tree, 
+    so that these can be dropped once all layers are read.
     
     Arguments:
-        wms (owslib.wms.WebMapService): An owslib WMS instance
+        layer (owslib.wms.ContentMetadata) A WMS or WFS content layer
+        parents (dict) Parent layer titles and `ParentLayer` records, 
+            to share one record between the layers of a parent, optional
+    
+    Returns:
+        A CapabilitiesLayer
     """
-    print("[get_group_dict] Reading wms...")
-    groups = dict()
-    for grp_title in set([wms.contents[l].parent.title for l in wms.contents]):
-        groups[grp_title] = dict()
-        groups[grp_title]["name"] = slugify(grp_title)
-        groups[grp_title]["title"] = grp_title
-    print("[get_group_dict] Done.")
-    return groups
+    parent = getattr(layer, "parent", None)
+    if parent is not None:
+        parent = ParentLayer(parent.title) if parents is None else \
+            parents.setdefault(parent.title, ParentLayer(parent.title))
+    bbox = layer.boundingBoxWGS84
+    return CapabilitiesLayer(getattr(layer, "name", None) or layer.id, layer.id, 
+                             layer.title, layer.abstract, 
+                             tuple(bbox) if bbox is not None else None, parent, 
+                             tuple(layer.keywords or ()))
 
 
-def upsert_org(datadict, ckanapi, debug=False):
-    """Create or update organisations through a ckanapi as per given datadict.
-        
+def layer_records(wxs, res_format="WMS"):
+    """Return the layers of an owslib WxS object or endpoint URL as `CapabilitiesLayer` records
+    
+    Keep the records instead of the owslib object to convert them later 
+    with `get_layer_dict`, `get_group_dict` or `get_layer_dict_gs28`.
+    
+    Example:
+    wmsP = layer_records(WebMapService(SOURCES["wmspublic"]["proxy"]))
+    
     Arguments:
-        datadict A dict with information on organizations, such as:
-    {
-        'logo_url': 'http://www.dfes.wa.gov.au/_layouts/images/FESA.Mobile/dfes_print.png',
-        'name': 'dfes',
-        'title': 'Department of Fire & Emergency Services',
-        'url': 'http://www.dfes.wa.gov.au/'
-
-    }
-        ckanapi A ckanapi instance with create_org permissions
+        wxs An owslib WxS object, or an endpoint URL to load through `get_capabilities`
+        res_format (String) The service type of an endpoint URL, default: "WMS"
     
     Returns:
-        A ckanapi organization_show dict
+        A list of CapabilitiesLayer records
     """
-    print("[upsert_org] Upserting organisation {0}, id {1}".format(
-            datadict["title"], datadict["name"]))
-    if debug:
-        print("[upsert_org]   Input:\n{0}".format(str(datadict)))
+    wxs = _load_wxs(wxs, res_format)
+    parents = dict()
+    return [layer_record(wxs.contents[layername], parents) for layername in wxs.contents]
 
-    try:
-        org = ckanapi.action.organization_show(id=datadict["name"])
-        print("[upsert_org]   Organisation exists, updating...")
-        org = ckanapi.action.organization_update(id=datadict["name"], **datadict)
-        print("[upsert_org]   Updated {0}".format(datadict["title"]))
+# Elements of a WMS Layer or WFS FeatureType holding a WGS84 bounding box
+_WGS84_BBOX_TAGS = ("LatLonBoundingBox", "LatLongBoundingBox", 
+                    "EX_GeographicBoundingBox", "WGS84BoundingBox")
 
-    except:
-        print("[upsert_org]   Organisation not found, inserting...")
-        org = ckanapi.action.organization_create(**datadict)
-        print("[upsert_org]   Inserted {0}".format(datadict["title"]))
-    if org:
-        return org
-    
 
-def upsert_group(datadict, ckanapi, debug=False):
-    """Create or update groups through a ckanapi as per given datadict.
-        
-    Arguments:
-        
-        datadict A dict with information on groups, such as:
-    {
-        'name': 'cultural_society_and_demography',
-        'title': 'Cultural, Society and Demography'
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
 
-    }
-        ckanapi A ckanapi instance with at least create_group permissions
-        
-    Returns:
-        A ckanapi group_show dict
-    """
-    print("[upsert_group] Upserting organisation {0}, id {1}".format(
-            datadict["title"], datadict["name"]))
-    if debug:
-        print("[upsert_group]   Input:\n{0}".format(str(datadict)))
 
+def _parse_wgs84_bbox(elem):
+    """Return (minx, miny, maxx, maxy) from a WMS/WFS WGS84 bounding box element.
+    """
+    tag = _local_name(elem.tag)
     try:
-        org = ckanapi.action.group_show(id=datadict["name"])
-        print("[upsert_group]   Group exists, updating...")
-        org = ckanapi.action.group_update(id=datadict["name"], **datadict)
-        print("[upsert_group]   Updated {0}".format(datadict["title"]))
+        if tag in ("LatLonBoundingBox", "LatLongBoundingBox"):
+            return tuple(float(elem.get(k)) for k in ("minx", "miny", "maxx", "maxy"))
+        values = dict((_local_name(c.tag), c.text) for c in elem)
+        if tag == "EX_GeographicBoundingBox":
+            return tuple(float(values[k]) for k in ("westBoundLongitude", 
+                "southBoundLatitude", "eastBoundLongitude", "northBoundLatitude"))
+        return tuple(float(x) for x in 
+                     (values["LowerCorner"].split() + values["UpperCorner"].split()))
+    except (TypeError, ValueError, KeyError):
+        return None
 
-    except:
-        print("[upsert_group]   Group not found, inserting...")
-        org = ckanapi.action.group_create(**datadict)
-        print("[upsert_group]   Inserted {0}".format(datadict["title"]))
-    if org:
-        return org
+
+def iter_capabilities_layers(source, service="WMS", version=None, 
+                             cache_dir=None, **kwargs):
+    """Yield lightweight layer records from a WMS 1.1.1/1.3.0 or WFS 1.x/2.0 
+    capabilities document without building the whole document in memory.
+    
+    Each named WMS Layer or WFS FeatureType is yielded as a `CapabilitiesLayer`
+    as soon as it has been read, and its XML is discarded right after.
+    WMS layers without a bounding box inherit their parent layer's.
+    
+    Example:
+    layers = iter_capabilities_layers(SOURCES["wmspublic"]["proxy"], "WMS")
+    l_wmsP = get_layer_dict(layers, wmsP_url, ckan, orgs, groups, pdfs, res_format="WMS")
     
+    Arguments:
+        source (String or file) A capabilities endpoint URL, a file name, or a file object
+        service (String) The OGC service type for endpoint URLs, default: "WMS"
+        version (String) The service version for endpoint URLs, default: owslib's default
+        cache_dir (String) Read endpoint URLs through the capabilities cache 
+            in this directory (see `fetch_capabilities`), optional
+        kwargs Further keyword arguments to `fetch_capabilities`
         
-def upsert_orgs(org_dict, ckanapi, debug=False):
+    Returns:
+        A generator of CapabilitiesLayer records with the attributes 
+        name, id, title, abstract, boundingBoxWGS84, parent (with attribute title) 
+        and keywords
     """
-    Insert or update CKAN organisations through a ckanapi from an org_dict.
+    if isinstance(source, string_types) and re.match(r"https?://", source):
+        if cache_dir:
+            source = _refresh_capabilities(source, service=service, version=version, 
+                                           cache_dir=cache_dir, **kwargs)[0]
+        else:
+            url = capabilities_url(source, service, 
+                                   version or OWS_DEFAULT_VERSIONS.get(service))
+            source = http_get(url, stream=True).raw
+            source.decode_content = True
     
-    Uses `upsert_org` on each element of `org_dict`.
-    Returns a name-indexed dictionary of now existing CKAN organisations.
-    This can be used to set the organisation in a CKAN dataset, replacing an expensive 
-    `organization_show` with a dictionary lookup.
-    """
-    print("[upsert_orgs] Refreshing orgs...")
-    orgs = [upsert_org(org_dict[org], ckanapi, debug) for org in org_dict]
-    print("[upsert_orgs] Done!")
-    return dict([o["name"], o] for o in orgs)
+    elems = []    # Open elements
+    layers = []   # Open layers as dicts, with the depth of their element
+    parents = dict()
+    for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+        tag = _local_name(elem.tag)
+        if event == "start":
+            elems.append(elem)
+            if tag in ("Layer", "FeatureType"):
+                layers.append({"name": None, "title": None, "abstract": None, 
+                               "bbox": None, "keywords": [], "depth": len(elems)})
+            continue
+        
+        elems.pop()
+        if not layers:
+            continue
+        layer = layers[-1]
+        depth = len(elems) - layer["depth"]   # 0 for children of the layer element
+        
+        if tag in ("Layer", "FeatureType") and depth < 0:
+            layers.pop()
+            if layer["name"]:
+                bbox = layer["bbox"]
+                for ancestor in reversed(layers):
+                    if bbox is not None:
+                        break
+                    bbox = ancestor["bbox"]
+                parent = parents.setdefault(layers[-1]["title"], 
+                                            ParentLayer(layers[-1]["title"])) if layers else None
+                yield CapabilitiesLayer(layer["name"], layer["name"], layer["title"], 
+                                        layer["abstract"], bbox, parent, 
+                                        layer["keywords"])
+            # Discard the parsed layer
+            elem.clear()
+            if elems:
+                elems[-1].remove(elem)
+        
+        elif depth == 0 and tag in ("Name", "Title", "Abstract"):
+            layer[tag.lower()] = (elem.text or "").strip() or None
+        
+        elif depth == 0 and tag in _WGS84_BBOX_TAGS:
+            layer["bbox"] = _parse_wgs84_bbox(elem)
+        
+        elif depth == 0 and tag == "Keywords" and elem.text and elem.text.strip():
+            # WFS 1.0.0
+            layer["keywords"].append(elem.text.strip())
+        
+        elif depth == 1 and tag == "Keyword" and elem.text:
+            layer["keywords"].append(elem.text.strip())
 
 
-def upsert_groups(group_dict, ckanapi, debug=False):
-    """Insert or update CKAN groups through a ckanapi from an org_dict.
+def _iter_wxs_layers(wxs, res_format="WMS"):
+    """Iterate over the layers of an owslib WxS object, an endpoint URL or
+    an iterable of layer records such as `iter_capabilities_layers`.
     
-    Uses `upsert_group` on each element of `org_dict`.
-    Returns a title-indexed dictionary of now existing CKAN groups.
-    This can be used to set the group in a CKAN dataset, replacing an expensive 
-    `group_show` with a dictionary lookup.
+    The layers of owslib objects are read into records (see `layer_record`)
+    up front, so that an object loaded from an endpoint URL is dropped 
+    before the layers are converted.
     """
-    print("[upsert_groups] Refreshing groups...")
-    groups = [upsert_group(group_dict[grp], ckanapi, debug) for grp in group_dict]
-    print("[upsert_groups] Done!")
-    return dict([g["title"], g] for g in groups)
+    wxs = _load_wxs(wxs, res_format)
+    if hasattr(wxs, "contents"):
+        return iter(layer_records(wxs))
+    return iter(wxs)
 
 
-def get_layer_dict(wxs, wxs_url, ckanapi, 
-                   org_dict, group_dict, pdf_dict, res_format="WMS", 
-                   debug=False, fallback_org_name='lgate'):
-    """Return a list of CKAN API package_show-compatible dicts
-    
-    Arguments:
-    
-        wxs A wxsclient loaded from a WXS enpoint
-        wxs_url The WXS endpoint URL to use as dataset resource URL
-        ckanapi A ckanapi instance with at least read permission
-        org_dict A dict of CKAN org names and ids
-        pdf_dict A dict of dataset names and corresponding PDF URLs
-        debug Debug noise
-        fallback_org_name The fallback CKAN org name , default:'lgate'    
-    
-    Returns:
-        A list of CKAN API package_show-compatible dicts
+def capabilities_cache_stats():
+    """Return the hit, revalidation, miss and eviction counts of the capabilities cache.
     """
-    foid = ckanapi.action.organization_show(id=fallback_org_name)["id"]
-    return [wxs_to_dict(wxs.contents[layername], wxs_url, 
-        org_dict, group_dict, pdf_dict, debug=debug,
-        res_format=res_format, fallback_org_id=foid) for layername in wxs.contents]
+    return dict(_capabilities_stats)
 
 
-def upsert_datasets(data_dict, ckanapi,overwrite_metadata=True, 
-                drop_existing_resources=True, debug=False):
-    """Upsert datasets into a ckanapi from data in a dictionary.
-    
-    Arguments:
-        data_dict (dict) An output of `get_layer_dict`
-        ckanapi (ckanapi) A ckanapi object (created with CKAN url and write-permitted api key)
-        overwrite_metadata (Boolean) Whether to overwrite existing dataset metadata (default)
-        drop_existing_resources (Boolean) Whether to drop existing resources (default) or merge
-        new and existing with identical resource URL
-        debug (Boolean) Debug noise level
-        
-    Returns:
-        A list of `package_show` dicts
+def _load_wxs(wxs, res_format="WMS"):
+    """Return an owslib WxS object, loading an endpoint URL through `get_capabilities`.
     """
-    print("Refreshing harvested WMS layer datasets...")
-    packages = [upsert_dataset(dataset, 
-                               ckanapi,
-                               overwrite_metadata=overwrite_metadata, 
-                               drop_existing_resources=drop_existing_resources,
-                               debug=debug) 
-                for dataset 
-                in data_dict
-                if dataset is not None]
-    print("Done!")
-    return(packages)
+    if isinstance(wxs, string_types):
+        return get_capabilities(wxs, service=res_format.upper())
+    return wxs
 
 
 #-------------------------------------------------------------------------------------#
 # ArcGIS REST
 #-------------------------------------------------------------------------------------#
 
+@timed("arcgis_fetch")
 def get_arc_services(url, foldername):
     """Return a list of service names from an ArcGIS REST folder
     
@@ -869,11 +4374,12 @@ def get_arc_services(url, foldername):
     Returns:
         A list of strings of service URLs
     """
-    res = json.loads(requests.get(os.path.join(url, foldername) + "?f=pjson").content)
+    res = http_get_json(os.path.join(url, foldername) + "?f=pjson")
     return [os.path.join(url, x) for x in [
             os.path.join(s["name"], s["type"]) for s in res["services"]]]
 
 
+@timed("arcgis_fetch")
 def get_arc_servicedict(url):
     """Returns a dict of service information for an ArcGIS REST service URL
     
@@ -881,13 +4387,90 @@ def get_arc_servicedict(url):
         url (String): An ArcGIS REST service URL, 
             e.g. 'http://services.slip.wa.gov.au/arcgis/rest/services/QC/MRWA_Public_Services/MapServer'
     """
-    res = json.loads(requests.get(url + "?f=pjson").content)
+    res = http_get_json(url + "?f=pjson")
     d = dict()
     d["layer_ids"] = [str(x['id']) for x in res["layers"]]
     d["supportedExtensions"] = res["supportedExtensions"]
     return d
 
 
+@timed("arcgis_fetch")
+def get_arc_layers(url):
+    """Return the JSON of all layers of an ArcGIS REST service from one request
+    
+    Uses the batched `<service>/layers?f=json` endpoint (ArcGIS Server 10.1+)
+    instead of one `<service>/<layer_id>?f=pjson` request per layer.
+    
+    Arguments
+        url (String): An ArcGIS REST service URL, 
+            e.g. 'http://services.slip.wa.gov.au/arcgis/rest/services/QC/MRWA_Public_Services/MapServer'
+    
+    Returns:
+        A dict of layer id (String): layer JSON (dict), 
+        or None if the server does not support the endpoint
+    """
+    try:
+        res = http_get_json(os.path.join(url, "layers") + "?f=json")
+    except (requests.RequestException, ValueError):
+        return None
+    if "layers" not in res:
+        return None
+    return dict((str(x["id"]), x) for x in res["layers"])
+
+
+def crawl_arc_services(url, folders=None, service_types=("MapServer",), workers=8):
+    """Return the URLs of all services underneath an ArcGIS REST root URL
+    
+    Walks all folders level by level, requesting the folders of each level
+    concurrently. Folders which fail to read are skipped and returned, so that
+    a partial crawl can be told from a complete one.
+    
+    Example:
+    (services, skipped) = crawl_arc_services(ARCGIS["SLIPFUTURE"]["url"])
+    services
+    ['http://services.slip.wa.gov.au/arcgis/rest/services/QC/MRWA_Public_Services/MapServer', ...]
+    
+    Arguments:
+        url (String): The ArcGIS REST base URL, 
+            e.g. 'http://services.slip.wa.gov.au/arcgis/rest/services/'
+        folders (list): The folder names to start from, default: the root folder
+        service_types (tuple): The service types to return, default: ("MapServer",)
+        workers (int): The number of concurrent requests, default: 8
+        
+    Returns:
+        A tuple of (sorted list of strings of service URLs, 
+        sorted list of the URLs of folders which could not be read)
+    """
+    skipped = []
+    
+    def read_folder(folder):
+        try:
+            return http_get_json(os.path.join(url, folder) + "?f=pjson")
+        except (requests.RequestException, ValueError) as e:
+            print("[crawl_arc_services] Skipping folder {0}: {1}".format(folder, e))
+            skipped.append(os.path.join(url, folder))
+            return dict()
+    
+    services = set()
+    seen = set()
+    level = folders or [""]
+    pool = ThreadPool(max(1, workers))
+    try:
+        while level:
+            seen.update(level)
+            results = pool.map(read_folder, level)
+            level = []
+            for res in results:
+                services.update(os.path.join(url, s["name"], s["type"]) 
+                                for s in res.get("services", []) 
+                                if s["type"] in service_types)
+                level.extend(f for f in res.get("folders", []) if f not in seen)
+    finally:
+        pool.close()
+        pool.join()
+    return (sorted(services), sorted(skipped))
+
+
 def force_key(d, k):
     """Return a key from a dict if existing and not None, else an empty string
     """
@@ -926,24 +4509,134 @@ def arcservice_extent_to_gjMP(extent):
     Returns:
         dict A GeoJSON MultiPolygon Geometry string in WGS84
     """
-    inProj = Proj(init='epsg:{0}'.format(str(extent["spatialReference"]["latestWkid"])))
-    outProj = Proj(init='epsg:4326')
+    return arcservice_extents_to_gjMP([extent])[0]
+
+
+# ESRI WKIDs without an EPSG equivalent of the same number
+ESRI_WKIDS = {102100: 3857, 102113: 3857}
+
+TRANSFORMER_CACHE_SIZE = 16
+_transformers = OrderedDict()
+_transformers_lock = threading.Lock()
+_transformer_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def extent_wkid(extent):
+    """Return the EPSG code of an ArcGIS REST extent's spatial reference
+    
+    Uses "latestWkid" where given, else "wkid", translating ESRI WKIDs 
+    such as 102100 (Web Mercator) to their EPSG equivalent.
+    
+    Example:
+    >>> extent_wkid({"spatialReference": {"wkid": 102100, "latestWkid": 3857}})
+    3857
+    >>> extent_wkid({"spatialReference": {"wkid": 102100}})
+    3857
+    >>> extent_wkid({"spatialReference": {"wkid": 28350}})
+    28350
+    
+    Arguments:
+        extent (dict) The "extent" key of the service layer JSON dict
+    
+    Returns:
+        int The EPSG code
+    """
+    sr = extent["spatialReference"]
+    wkid = int(sr.get("latestWkid") or sr["wkid"])
+    return ESRI_WKIDS.get(wkid, wkid)
+
+
+def get_transformer(wkid):
+    """Return a function transforming coordinates from EPSG:wkid into WGS84
+    
+    Building a projection is far more expensive than transforming coordinates,
+    so transformers are kept in a least recently used cache of 
+    TRANSFORMER_CACHE_SIZE entries.
+    
+    Arguments:
+        wkid (int) The EPSG code of the source coordinate reference system
+    
+    Returns:
+        A function taking a sequence of eastings and a sequence of northings 
+        and returning the longitudes and latitudes
+    """
+    with _transformers_lock:
+        if wkid in _transformers:
+            _transformer_stats["hits"] += 1
+            fn = _transformers.pop(wkid)
+            _transformers[wkid] = fn
+            return fn
+    
+    if Transformer is not None:
+        fn = Transformer.from_crs("epsg:{0}".format(wkid), "epsg:4326", 
+                                  always_xy=True).transform
+    else:
+        inProj = Proj(init="epsg:{0}".format(wkid))
+        outProj = Proj(init="epsg:4326")
+        fn = lambda x, y: transform(inProj, outProj, x, y)
 
-    xmin = extent["xmin"]
-    xmax = extent["xmax"]
-    ymin = extent["ymin"]
-    ymax = extent["ymax"]
+    with _transformers_lock:
+        _transformer_stats["misses"] += 1
+        _transformers[wkid] = fn
+        while len(_transformers) > TRANSFORMER_CACHE_SIZE:
+            _transformers.popitem(last=False)
+            _transformer_stats["evictions"] += 1
+    return fn
 
-    NW = transform(inProj, outProj, xmin, ymax)
-    NE = transform(inProj, outProj, xmax, ymax)
-    SW = transform(inProj, outProj, xmin, ymin)
-    SE = transform(inProj, outProj, xmax, ymin)
 
-    w, n, e, s = NW[0], NW[1], SE[0], SE[1]
+def transformer_cache_stats():
+    """Return a dict of hits, misses and evictions of the transformer cache"""
+    return dict(_transformer_stats, size=len(_transformers))
+
+
+def arcservice_extents_to_gjMP(extents):
+    """Transform many ArcGIS REST layer extents into WGS84 GeoJSON MultiPolygon Geometries
+    
+    Groups the extents by spatial reference and reprojects the NW and SE corners
+    of all extents of a group in one call to a cached transformer.
+    
+    Example:
+        layers = get_arc_layers(service_url)
+        spatial = arcservice_extents_to_gjMP([l["extent"] for l in layers.values()])
+    
+    Arguments:
+        extents (list) The "extent" dicts of service layer JSON dicts
+    
+    Returns:
+        list Of GeoJSON MultiPolygon Geometry strings in WGS84, in order of `extents`
+    """
+    groups = dict()
+    for (i, extent) in enumerate(extents):
+        groups.setdefault(extent_wkid(extent), []).append(i)
+    
+    result = [None] * len(extents)
+    for (wkid, idx) in groups.items():
+        xs = [extents[i]["xmin"] for i in idx] + [extents[i]["xmax"] for i in idx]
+        ys = [extents[i]["ymax"] for i in idx] + [extents[i]["ymin"] for i in idx]
+        lons, lats = get_transformer(wkid)(xs, ys)
+        for (j, i) in enumerate(idx):
+            w, n, e, s = lons[j], lats[j], lons[j + len(idx)], lats[j + len(idx)]
+            result[i] = json.dumps({"type": "MultiPolygon", 
+                                    "coordinates": [[[[e,n],[e,s],[w,s],[w,n]]]]})
+    return result
     
-    return json.dumps({"type": "MultiPolygon", "coordinates": [[[[e,n],[e,s],[w,s],[w,n]]]]})
     
+def _arc_layer_spatials(layers):
+    """Return a dict of layer id: GeoJSON MultiPolygon for a dict of layer id: layer JSON
     
+    Reprojects all extents in one batch. Returns an empty dict if the batch fails,
+    leaving each layer to report its own error on conversion.
+    """
+    ids = [k for (k, v) in layers.items() if v and v.get("extent")]
+    try:
+        return dict(zip(ids, arcservice_extents_to_gjMP([layers[k]["extent"] for k in ids])))
+    except (KeyError, TypeError, ValueError, RuntimeError) as e:
+        print("[_arc_layer_spatials] Batch reprojection failed, "
+              "falling back to single layers: {0}".format(e))
+        return dict()
+
+
+@timed("parse_argis_rest_layer")
 def parse_argis_rest_layer(layer_id, services, base_url, ckan, 
                            owner_org_id=None, author=None, author_email=None, 
                            fallback_org_name='lgate', debug=False):
@@ -967,15 +4660,45 @@ def parse_argis_rest_layer(layer_id, services, base_url, ckan,
         A dictionary in format ckanpai.action.package_show(id=xxx)
     """
     layer_url = os.path.join(base_url, layer_id)
-    res = json.loads(requests.get(layer_url + "?f=pjson").content)
+    res = http_get_json(layer_url + "?f=pjson")
     
-    # Assumptions!
-    desc_preamble = """This dataset has been harvested from [Locate WA](http://locate.wa.gov.au/).\n\n"""
-    date_pub = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    if not owner_org_id:
+        owner_org_id = ckan_action(ckan, "organization_show", id=fallback_org_name)["id"]
     
+    return arcgis_layer_to_ckan(res, layer_id, services, base_url, 
+                                owner_org_id=owner_org_id, author=author, 
+                                author_email=author_email, debug=debug)
+
+
+@timed("arcgis_layer_to_ckan")
+def arcgis_layer_to_ckan(res, layer_id, services, base_url, owner_org_id, 
+                         author=None, author_email=None, spatial=None, debug=False):
+    """Convert the JSON of an ArcGIS REST layer into a CKAN package dict of data.wa.gov.au schema
     
-    if not owner_org_id:
-        owner_org_id = ckan.action.organization_show(id=fallback_org_name)["id"]
+    Arguments:
+        res (dict): The ArcGIS REST layer JSON, either from `<service>/<layer_id>?f=pjson`
+            or one element of `<service>/layers?f=json`
+        layer_id (String): The ArcGIS REST layer id
+        services (String): A comma separated list of ArcGIS REST services available 
+            for the given layer as per its parent service definition,
+            e.g. 'WFSServer, WMSServer'
+        base_url (String): The ArcGIS REST service URL
+        owner_org_id (String) The CKAN owner org ID
+        author (String): The dataset author, optional
+        author_email (String): The dataset author email, optional
+        spatial (String): The layer extent as GeoJSON MultiPolygon, optional,
+            default: reprojected from the layer JSON's extent
+        debug (Boolean): Debug noise level
+    
+    Returns:
+        A dictionary in format ckanpai.action.package_show(id=xxx)
+    """
+    layer_url = os.path.join(base_url, layer_id)
+    
+    # Assumptions!
+    desc_preamble = """This dataset has been harvested from [Locate WA](http://locate.wa.gov.au/).\n\n"""
+    # ArcGIS REST layers carry no publication date
+    date_pub = EstimatedDate(_now_iso())
     
     
     # Splitting description into a description dict dd
@@ -1023,7 +4746,7 @@ def parse_argis_rest_layer(layer_id, services, base_url, ckan,
     d["maintainer"] = "Landgate"
     d["private"] = False
     d["state"] = "active"
-    d["spatial"] = arcservice_extent_to_gjMP(res["extent"])
+    d["spatial"] = spatial or arcservice_extent_to_gjMP(res["extent"])
     """
     #hardcode WA extent:
     d["spatial"] =  json.dumps({"type": "MultiPolygon", 
@@ -1065,12 +4788,14 @@ def parse_argis_rest_layer(layer_id, services, base_url, ckan,
     d["resources"] = resource_list
     
     if debug:
-        print("[parse_argis_rest_layer] Returning package dict \n{0}".format(str(d)))
+        print("[arcgis_layer_to_ckan] Returning package dict \n{0}".format(str(d)))
 
     return d
 
 def harvest_arcgis_service(service_url, ckan, owner_org_id, author, author_email, 
-                           overwrite_metadata=True, drop_existing_resources=True,debug=False):
+                           overwrite_metadata=True, drop_existing_resources=True,debug=False,
+                           fallback_org_name='lgate', batch=True, journal=None, 
+                           harvested=None):
     """Harvest all layers underneath an ArcGIS REST Service URL into a CKAN
     
     Arguments:
@@ -1084,26 +4809,164 @@ def harvest_arcgis_service(service_url, ckan, owner_org_id, author, author_email
         overwrite_metadata (Boolean) Whether to overwrite existing dataset metadata (default)
         drop_existing_resources (Boolean) Whether to drop existing resources (default) or merge
         debug (Boolean): Debug noise level
+        batch (Boolean): Whether to read all layers with one request to the service's
+            `layers` endpoint where supported (default)
+        journal (RunJournal) A journal to resume the run from, optional.
+            Skips layers done before and journals each layer's outcome.
+        harvested (set) A set to add the names of all written datasets to, optional,
+            e.g. for `reap_datasets`. Layers done before in the journal add their 
+            journalled dataset names.
+        
+    Returns:
+        A list of layer ids which could not be read from the service
     """
     servicedict = get_arc_servicedict(service_url)
-    for layer in servicedict["layer_ids"]:
+    layer_ids = servicedict["layer_ids"]
+    if journal is not None:
+        keys = dict((layer, "arcgis:{0}/{1}".format(service_url.rstrip("/"), layer)) 
+                    for layer in layer_ids)
+        done = [layer for layer in layer_ids if journal.is_done(keys[layer])]
+        layer_ids = [layer for layer in layer_ids if not journal.is_done(keys[layer])]
+        if harvested is not None:
+            harvested.update(journal.items[keys[layer]].get("dataset") for layer in done)
+        if done:
+            print("Skipping {0} layers done before".format(len(done)))
+    layers = get_arc_layers(service_url) if batch and layer_ids else None
+    if layers is not None and not owner_org_id:
+        owner_org_id = ckan_action(ckan, "organization_show", id=fallback_org_name)["id"]
+    spatials = _arc_layer_spatials(layers) if layers else dict()
+    failed = []
+    for layer in layer_ids:
         print("\n\nParsing layer {0}".format(layer))
-        ds_dict = parse_argis_rest_layer(layer, 
-                                         servicedict["supportedExtensions"], 
-                                         service_url, 
-                                         ckan,
-                                         owner_org_id = owner_org_id,
-                                         author = author,
-                                         author_email = author_email,
-                                         debug=debug)
+        if journal is not None:
+            journal.start(keys[layer])
+        try:
+            if layers is not None and layer in layers:
+                ds_dict = arcgis_layer_to_ckan(layers[layer], 
+                                               layer, 
+                                               servicedict["supportedExtensions"], 
+                                               service_url,
+                                               owner_org_id = owner_org_id,
+                                               author = author,
+                                               author_email = author_email,
+                                               spatial = spatials.get(layer),
+                                               debug=debug)
+            else:
+                ds_dict = parse_argis_rest_layer(layer, 
+                                                 servicedict["supportedExtensions"], 
+                                                 service_url, 
+                                                 ckan,
+                                                 owner_org_id = owner_org_id,
+                                                 author = author,
+                                                 author_email = author_email,
+                                                 fallback_org_name = fallback_org_name,
+                                                 debug=debug)
+        except requests.RequestException as e:
+            print("Skipping layer {0}: {1}".format(layer, e))
+            failed.append(layer)
+            if journal is not None:
+                journal.fail(keys[layer], e)
+            continue
         print("Writing dataset {0}...".format(ds_dict["title"]))
         if debug:
             print(ds_dict)
-        ckan_ds = upsert_dataset(ds_dict, 
-                                 ckan, 
-                                 overwrite_metadata = overwrite_metadata,
-                                 drop_existing_resources = drop_existing_resources, 
-                                 debug=debug)
+        try:
+            ckan_ds = upsert_dataset(ds_dict, 
+                                     ckan, 
+                                     overwrite_metadata = overwrite_metadata,
+                                     drop_existing_resources = drop_existing_resources, 
+                                     debug=debug)
+        except Exception as e:
+            if journal is not None:
+                journal.fail(keys[layer], e)
+            raise
+        if journal is not None:
+            journal.done(keys[layer], dataset=ckan_ds["name"])
+        if harvested is not None:
+            harvested.add(ckan_ds["name"])
         if debug:
             print(ckan_ds)
         print("Upserted dataset {0} to CKAN {1}".format(ckan_ds["title"], ckan.address))
+    if failed:
+        print("Failed to read {0} layers: {1}".format(len(failed), ", ".join(failed)))
+    return failed
+
+
+def get_arcgis_layer_dicts(url, ckan, folders=None, owner_org_id=None, 
+                           author=None, author_email=None, 
+                           fallback_org_name='lgate', workers=8, debug=False):
+    """Return CKAN package dicts for all layers of all services underneath an ArcGIS REST root URL
+    
+    Discovers services with `crawl_arc_services`, then reads each service's 
+    definition and layers concurrently, using the batched `layers` endpoint 
+    where the server supports it, and converts each layer with `arcgis_layer_to_ckan`.
+    Folders, services and layers which fail to read or convert are skipped and 
+    returned next to the dicts: the dicts are complete only if none were skipped.
+    
+    Example:
+    (dicts, skipped) = get_arcgis_layer_dicts(ARCGIS["SLIPFUTURE"]["url"], ckan)
+    packages = upsert_datasets(dicts, ckan, workers=8)
+    
+    Arguments:
+        url (String): The ArcGIS REST base URL, 
+            e.g. 'http://services.slip.wa.gov.au/arcgis/rest/services/'
+        ckan (ckanapi.RemoteCKAN) An instance of ckanapi.RemoteCKAN
+        folders (list): The folder names to start from, default: the root folder
+        owner_org_id (String) The CKAN owner org ID, optional
+        author (String): The dataset author, optional
+        author_email (String): The dataset author email, optional
+        fallback_org_name (String) The CKAN owner org name, default: 'lgate'
+        workers (int): The number of concurrent requests, default: 8
+        debug (Boolean): Debug noise level
+        
+    Returns:
+        A tuple of (list of CKAN API package_show-compatible dicts, sorted list of 
+        the URLs of skipped folders, services and layers)
+    """
+    if not owner_org_id:
+        owner_org_id = ckan_action(ckan, "organization_show", id=fallback_org_name)["id"]
+    (services, skipped) = crawl_arc_services(url, folders=folders, workers=workers)
+    print("[get_arcgis_layer_dicts] Found {0} services".format(len(services)))
+    
+    def read_service(service_url):
+        try:
+            servicedict = get_arc_servicedict(service_url)
+            layers = get_arc_layers(service_url)
+            if layers is None:
+                layers = dict((layer, http_get_json(
+                    os.path.join(service_url, layer) + "?f=pjson"))
+                              for layer in servicedict["layer_ids"])
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print("[get_arcgis_layer_dicts] Skipping service {0}: {1}".format(service_url, e))
+            skipped.append(service_url)
+            return []
+        
+        spatials = _arc_layer_spatials(layers)
+        dicts = []
+        for layer in servicedict["layer_ids"]:
+            try:
+                dicts.append(arcgis_layer_to_ckan(layers[layer], 
+                                                  layer, 
+                                                  servicedict["supportedExtensions"], 
+                                                  service_url,
+                                                  owner_org_id=owner_org_id,
+                                                  author=author,
+                                                  author_email=author_email,
+                                                  spatial=spatials.get(layer),
+                                                  debug=debug))
+            except (ValueError, KeyError) as e:
+                print("[get_arcgis_layer_dicts] Skipping layer {0} of {1}: {2}".format(
+                        layer, service_url, e))
+                skipped.append(os.path.join(service_url, layer))
+        return dicts
+    
+    pool = ThreadPool(max(1, workers))
+    try:
+        results = pool.map(read_service, services)
+    finally:
+        pool.close()
+        pool.join()
+    dicts = [d for service_dicts in results for d in service_dicts]
+    print("[get_arcgis_layer_dicts] Converted {0} layers, skipped {1}".format(
+            len(dicts), len(skipped)))
+    return (dicts, sorted(skipped))
@@ -0,0 +1,54 @@
+"""Test fixtures on the fake CKAN, WMS/WFS and ArcGIS REST servers of `benchmark_harvest`"""
+import shutil
+import tempfile
+import unittest
+
+import benchmark_harvest
+
+
+def package(name, urls=(), tags=("Harvested",), **fields):
+    """Return a harvested package dict with one WMS resource per URL
+    
+    Arguments:
+        name (String) The dataset name
+        urls (list) The resource URLs, the layer of each resource is the dataset name
+        tags (list) The tags, default: Harvested
+        fields Further package fields
+    
+    Returns:
+        A package dict as returned by `wxs_to_dict`
+    """
+    data_dict = {"name": name, "title": name.title(), "owner_org": "lgate",
+                 "tag_string": list(tags),
+                 "resources": [{"url": url, "name": name, "format": "WMS", "wms_layer": name}
+                               for url in urls]}
+    data_dict.update(fields)
+    return data_dict
+
+
+class FakeCKANTestCase(unittest.TestCase):
+    """A test case with a fake CKAN, emptied before each test, and a temporary directory
+    
+    The fake CKAN knows the organisation "lgate" and stores packages as written,
+    turning `tag_string` into `tags` and stamping `metadata_modified`.
+    """
+    
+    @classmethod
+    def setUpClass(cls):
+        cls.env = benchmark_harvest.Environment([10], 0.0, 4)
+        cls.ckan = benchmark_harvest._ckan(cls.env)
+    
+    @classmethod
+    def tearDownClass(cls):
+        cls.env.close()
+    
+    def setUp(self):
+        self.env.reset_ckan()
+        self.tmp = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+    
+    def create(self, data_dict):
+        """Create a package in the fake CKAN and return it as `package_show` would"""
+        return self.ckan.action.package_create(**data_dict)
@@ -0,0 +1,29 @@
+import unittest
+
+import harvest_helpers as hh
+from tests.fakes import FakeCKANTestCase
+
+
+class ArcGISCrawlTest(FakeCKANTestCase):
+    
+    def test_complete_crawl_skips_nothing(self):
+        (dicts, skipped) = hh.get_arcgis_layer_dicts(self.env.arcgis_url, self.ckan, 
+                                                     folders=["BENCH"])
+        self.assertEqual(len(dicts), 10)
+        self.assertEqual(skipped, [])
+    
+    def test_crawl_returns_skipped_folders(self):
+        (services, skipped) = hh.crawl_arc_services(self.env.arcgis_url, 
+                                                    folders=["BENCH", "Missing"])
+        self.assertEqual(services, [self.env.arcgis_url + "/BENCH/S10/MapServer"])
+        self.assertEqual(skipped, [self.env.arcgis_url + "/Missing"])
+    
+    def test_returns_skipped_folders_with_the_layer_dicts(self):
+        (dicts, skipped) = hh.get_arcgis_layer_dicts(self.env.arcgis_url, self.ckan, 
+                                                     folders=["BENCH", "Missing"])
+        self.assertEqual(len(dicts), 10)
+        self.assertEqual(skipped, [self.env.arcgis_url + "/Missing"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import json
+import math
+import random
+import unittest
+
+import benchmark_harvest
+import harvest_helpers as hh
+
+
+def star(rng, cx, cy, radius, points=40):
+    """Return a closed, simple, star-shaped ring of random radii around a centre"""
+    ring = []
+    for i in range(points):
+        angle = 2 * math.pi * i / points
+        r = radius * rng.uniform(0.5, 1.0)
+        ring.append((cx + r * math.cos(angle), cy + r * math.sin(angle)))
+    return ring + ring[:1]
+
+
+def square(cx, cy, half):
+    return [(cx - half, cy - half), (cx + half, cy - half), (cx + half, cy + half), 
+            (cx - half, cy + half), (cx - half, cy - half)]
+
+
+def random_extents(rng, n=60):
+    """Return n named GeoJSON MultiPolygon strings over WA, some with holes or two parts"""
+    extents = dict()
+    for i in range(n):
+        (cx, cy) = (rng.uniform(114, 128), rng.uniform(-34, -15))
+        polygon = [star(rng, cx, cy, rng.uniform(0.5, 4))]
+        if i % 3 == 0:
+            polygon.append(square(cx, cy, 0.2))
+        polygons = [polygon]
+        if i % 5 == 0:
+            polygons.append([star(rng, cx + 5, cy + 5, 1)])
+        extents["Extent {0}".format(i)] = json.dumps({"type": "MultiPolygon", 
+                                                      "coordinates": polygons})
+    return extents
+
+
+def in_ring(x, y, ring):
+    inside = False
+    for ((x1, y1), (x2, y2)) in zip(ring, ring[1:]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / float(y2 - y1):
+            inside = not inside
+    return inside
+
+
+def area(ring):
+    return abs(sum(x1 * y2 - x2 * y1 for ((x1, y1), (x2, y2)) in zip(ring, ring[1:]))) / 2.0
+
+
+def enclosing(extents, bbox):
+    """Return the smallest extent enclosing all corners of a bbox, by testing every extent"""
+    (minx, miny, maxx, maxy) = bbox
+    corners = ((minx, miny), (minx, maxy), (maxx, miny), (maxx, maxy))
+    found = []
+    for (name, geometry) in extents.items():
+        polygons = json.loads(geometry)["coordinates"]
+        if all(any(in_ring(x, y, p[0]) and not any(in_ring(x, y, h) for h in p[1:]) 
+                   for p in polygons) for (x, y) in corners):
+            found.append((sum(area(p[0]) - sum(area(h) for h in p[1:]) for p in polygons), name))
+    return min(found)[1] if found else None
+
+
+class ExtentIndexTest(unittest.TestCase):
+    
+    def test_enclosing_equals_brute_force(self):
+        rng = random.Random(42)
+        extents = random_extents(rng)
+        index = hh.ExtentIndex(extents)
+        matched = 0
+        for i in range(500):
+            (x, y, size) = (rng.uniform(112, 130), rng.uniform(-36, -13), rng.uniform(0, 1))
+            bbox = (x, y, x + size, y + size * rng.uniform(0.2, 1))
+            expected = enclosing(extents, bbox)
+            self.assertEqual(index.enclosing(bbox), expected, bbox)
+            matched += expected is not None
+        # Most queries should hit an extent for the test to mean something
+        self.assertTrue(matched > 50, matched)
+    
+    def test_holes_do_not_enclose(self):
+        ring = square(120, -25, 2)
+        index = hh.ExtentIndex({"Ring": {"type": "Polygon", 
+                                         "coordinates": [ring, square(120, -25, 0.5)]}})
+        self.assertEqual(index.enclosing((120.6, -25.1, 120.8, -24.9)), "Ring")
+        self.assertEqual(index.enclosing((119.9, -25.1, 120.1, -24.9)), None)
+    
+    def test_assign_extents_matches_brute_force(self):
+        (extents, packages) = benchmark_harvest._setup_extents(None, 300)
+        summary = hh.assign_extents(extents, packages=packages)
+        for p in packages:
+            expected = enclosing(extents, hh.geometry_bbox(p["spatial"]))
+            self.assertEqual(summary["assigned"].get(p["name"]), expected, p["name"])
+
+    def test_assign_extents_keeps_non_rectangular_named_extents(self):
+        # The triangle does not enclose the corners of its own bbox, WA does
+        extents = {
+            "WA": json.dumps({"type": "Polygon", "coordinates": [square(120, -25, 10)]}),
+            "Shark Bay": json.dumps({"type": "Polygon", "coordinates": [
+                [(113, -27), (115, -27), (114, -25), (113, -27)]]})}
+        packages = [{"name": "already-georef", "spatial": extents["Shark Bay"]},
+                    {"name": "in-wa", "spatial": json.dumps(
+                        {"type": "Polygon", "coordinates": [square(120, -25, 1)]})}]
+        summary = hh.assign_extents(extents, packages=packages)
+        self.assertEqual(summary["unchanged"], ["already-georef"])
+        self.assertEqual(summary["assigned"], {"in-wa": "WA"})
+
+        cache = hh.ExtentCache(extents)
+        packages[0]["spatial"] = cache.get("Shark Bay", 0.0)
+        summary = hh.assign_extents(cache, packages=packages)
+        self.assertEqual(summary["unchanged"], ["already-georef"])
+        self.assertEqual(summary["assigned"], {"in-wa": "WA"})
+
+
+
+def distance(p, a, b):
+    """Return the distance of a point from a line segment"""
+    (dx, dy) = (b[0] - a[0], b[1] - a[1])
+    length = dx * dx + dy * dy
+    t = 0.0 if not length else ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length
+    t = max(0.0, min(1.0, t))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+class ExtentCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.extents = random_extents(random.Random(7), n=20)
+        self.cache = hh.ExtentCache(self.extents)
+    
+    def test_simplified_extents_are_within_the_error_bound(self):
+        for name in self.extents:
+            original = json.loads(self.extents[name])["coordinates"]
+            for t in self.cache.tolerances:
+                simplified = json.loads(self.cache.get(name, t))["coordinates"]
+                bound = self.cache.error_bound(t) + 1e-9
+                self.assertEqual([len(p) for p in simplified], [len(p) for p in original])
+                for (polygon, simple) in zip(original, simplified):
+                    for (ring, simple_ring) in zip(polygon, simple):
+                        segments = list(zip(simple_ring, simple_ring[1:]))
+                        for p in ring:
+                            self.assertTrue(min(distance(p, a, b) for (a, b) in segments) <= bound,
+                                            (name, t, p))
+    
+    def test_simplified_extents_are_valid(self):
+        for name in self.extents:
+            for t in self.cache.tolerances:
+                for polygon in json.loads(self.cache.get(name, t))["coordinates"]:
+                    self.assertTrue(hh.polygon_is_valid([[tuple(p) for p in ring] 
+                                                         for ring in polygon]), (name, t))
+    
+    def test_invalid_simplifications_fall_back_to_smaller_tolerances(self):
+        # Dropping the shell's bump at 0.05 would cut through the hole
+        shell = [(0, 0), (0.5, -0.04), (1, 0), (1, 1), (0, 1), (0, 0)]
+        hole = [(0.45, -0.02), (0.45, 0.5), (0.55, 0.5), (0.55, -0.02), (0.45, -0.02)]
+        self.assertFalse(hh.polygon_is_valid([hh.simplify_ring(shell, 0.05), 
+                                              hh.simplify_ring(hole, 0.05)]))
+        cache = hh.ExtentCache({"Hole": {"type": "Polygon", "coordinates": [shell, hole]}},
+                               tolerances=(0.05,), tolerance=0.05)
+        polygon = json.loads(cache["Hole"])["coordinates"][0]
+        self.assertTrue(hh.polygon_is_valid([[tuple(p) for p in ring] for ring in polygon]))
+        self.assertTrue([0.5, -0.04] in polygon[0])
+    
+    def test_reads_like_a_dict_at_the_default_tolerance(self):
+        self.assertEqual(sorted(self.cache), sorted(self.extents))
+        self.assertEqual(len(self.cache), len(self.extents))
+        name = sorted(self.extents)[0]
+        self.assertTrue(name in self.cache)
+        self.assertEqual(self.cache[name], self.cache.get(name, 0.005))
+        self.assertEqual(dict(self.cache.items())[name], self.cache[name])
+        original = json.loads(self.extents[name])["coordinates"]
+        self.assertEqual(json.loads(self.cache.get(name, 0.0))["coordinates"], 
+                         [[[list(p) for p in ring] for ring in polygon] for polygon in original])
+    
+    def test_larger_tolerances_keep_fewer_points(self):
+        totals = self.cache.report()
+        points = [t["points"] for t in totals]
+        self.assertEqual(points, sorted(points, reverse=True))
+        self.assertTrue(totals[-1]["bytes"] < totals[0]["original_bytes"])
+
+
+if __name__ == "__main__":
+    unittest.main()
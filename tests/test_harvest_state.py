@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import harvest_helpers as hh
+from tests.fakes import FakeCKANTestCase
+
+
+WMS = "http://x/wms"
+WFS = "http://x/wfs"
+
+
+def layer_dict(layer, source=WMS, fmt="wms", title="Layer"):
+    """Return a package dict with one resource of a layer, as `get_layer_dict` does"""
+    return {"name": layer.lower(), "title": title, 
+            "resources": [{"url": source, "{0}_layer".format(fmt): layer}]}
+
+
+class HarvestStateTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "state.sqlite")
+        self.state = hh.HarvestState(self.path)
+    
+    def tearDown(self):
+        self.state.db.close()
+        shutil.rmtree(self.tmp)
+    
+    def harvest(self, layer, updated, source=WMS, fmt="wms", **kwargs):
+        """Stage a layer if it is not current, commit and save it, return whether it was staged"""
+        d = layer_dict(layer, source, fmt, **kwargs)
+        if not self.state.accept(source, layer, updated, d):
+            return False
+        self.state.commit(d)
+        self.state.save()
+        return True
+    
+    def reopen(self):
+        self.state.close()
+        self.state = hh.HarvestState(self.path)
+    
+    def test_current_layers_are_not_staged_again(self):
+        self.assertTrue(self.harvest("A-001", "2015-10-05T13:41:48"))
+        self.reopen()
+        self.assertFalse(self.harvest("A-001", "2015-10-05T13:41:48"))
+        self.assertTrue(self.harvest("A-001", "2015-10-06T09:00:00"))
+    
+    def test_uncommitted_layers_are_not_recorded(self):
+        d = layer_dict("A-001")
+        self.assertTrue(self.state.accept(WMS, "A-001", "2015-10-05T13:41:48", d))
+        self.state.save()
+        self.reopen()
+        self.assertFalse(self.state.is_current(WMS, "A-001", "2015-10-05T13:41:48"))
+    
+    def test_commit_keeps_layers_staged_until_ckan_has_them(self):
+        d = layer_dict("A-001")
+        self.state.accept(WMS, "A-001", "2015-10-06T09:00:00", d)
+        # The write was skipped, CKAN still has the layer of the day before
+        self.state.commit(d, package=dict(d, last_updated_on="2015-10-05T13:41:48"))
+        self.assertFalse(self.state.is_current(WMS, "A-001", "2015-10-06T09:00:00"))
+        self.assertTrue((WMS, "A-001") in self.state.staged)
+        self.state.commit(d, package=dict(d, last_updated_on="2015-10-06T09:00:00.123456"))
+        self.assertTrue(self.state.is_current(WMS, "A-001", "2015-10-06T09:00:00"))
+        self.assertFalse((WMS, "A-001") in self.state.staged)
+    
+    def test_layers_without_timestamp_follow_their_layer_name(self):
+        self.assertTrue(self.harvest("A-001", "2015-10-05T13:41:48"))
+        self.assertTrue(self.harvest("A-001", None, WFS, "wfs"))
+        self.reopen()
+        self.assertFalse(self.harvest("A-001", None, WFS, "wfs"))
+        # A newer WMS layer makes the WFS layer of the same name stale
+        self.assertTrue(self.harvest("A-001", "2015-10-06T09:00:00"))
+        self.assertTrue(self.harvest("A-001", None, WFS, "wfs"))
+        self.reopen()
+        self.assertFalse(self.harvest("A-001", None, WFS, "wfs"))
+    
+    def test_layers_without_any_timestamp_compare_fingerprints(self):
+        self.assertTrue(self.harvest("B-001", None))
+        self.reopen()
+        self.assertFalse(self.harvest("B-001", None))
+        self.assertTrue(self.harvest("B-001", None, title="Renamed"))
+    
+    def test_forget_forces_a_full_harvest(self):
+        self.harvest("A-001", "2015-10-05T13:41:48")
+        self.harvest("A-001", "2015-10-05T13:41:48", WFS, "wfs")
+        self.state.forget(WMS)
+        self.assertFalse(self.state.is_current(WMS, "A-001", "2015-10-05T13:41:48"))
+        self.assertTrue(self.state.is_current(WFS, "A-001", "2015-10-05T13:41:48"))
+        self.reopen()
+        self.assertEqual(list(self.state.layers), [(WFS, "A-001")])
+
+
+
+class UpsertStateTest(FakeCKANTestCase):
+    
+    def test_upserts_commit_layers_ckan_carries(self):
+        state = hh.HarvestState(os.path.join(self.tmp, "state.sqlite"))
+        d = dict(layer_dict("A-001"), owner_org="lgate", last_updated_on="2015-10-05T13:41:48")
+        state.accept(WMS, "A-001", "2015-10-05T13:41:48", d)
+        hh.upsert_datasets([d], self.ckan, state=state)
+        self.assertTrue(state.is_current(WMS, "A-001", "2015-10-05T13:41:48"))
+        
+        # Without overwrite_metadata, CKAN keeps the older last_updated_on
+        newer = dict(d, last_updated_on="2015-10-06T09:00:00")
+        state.accept(WMS, "A-001", "2015-10-06T09:00:00", newer)
+        hh.upsert_datasets([newer], self.ckan, overwrite_metadata=False, state=state)
+        self.assertFalse(state.is_current(WMS, "A-001", "2015-10-06T09:00:00"))
+        hh.upsert_datasets([newer], self.ckan, state=state)
+        self.assertTrue(state.is_current(WMS, "A-001", "2015-10-06T09:00:00"))
+        state.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import copy
+import unittest
+
+import harvest_helpers as hh
+
+
+def resource(url, layer=None, **fields):
+    r = {"url": url, "format": "WMS"}
+    if layer is not None:
+        r["wms_layer"] = layer
+    r.update(fields)
+    return r
+
+
+class MergeResourcesTest(unittest.TestCase):
+    
+    def test_replaces_matching_resources_in_place(self):
+        old = [resource("http://x/wms", "a", id="1", description="kept"),
+               resource("http://x/wfs", id="2")]
+        (merged, report) = hh.merge_resources(old, [resource("http://x/wms", "a", name="New")])
+        self.assertEqual(merged[0], resource("http://x/wms", "a", id="1", description="kept", 
+                                             name="New"))
+        self.assertEqual(merged[1], old[1])
+        self.assertEqual(report, {"added": [], "kept": ["http://x/wfs"], 
+                                  "replaced": ["http://x/wms"]})
+    
+    def test_appends_new_resources_in_order(self):
+        old = [resource("http://x/wms", "a", id="1")]
+        new = [resource("http://z/wms", "c"), resource("http://y/wms", "b")]
+        (merged, report) = hh.merge_resources(old, new)
+        self.assertEqual([r["url"] for r in merged], 
+                         ["http://x/wms", "http://z/wms", "http://y/wms"])
+        self.assertEqual(report["added"], ["http://z/wms", "http://y/wms"])
+        self.assertEqual(report["kept"], ["http://x/wms"])
+    
+    def test_matches_on_canonical_url_and_layer(self):
+        old = [resource("http://x/wms?service=WMS&request=GetCapabilities", "a", id="1"),
+               resource("http://x/wms", "b", id="2")]
+        new = [resource("HTTP://X:80/wms/?request=GetCapabilities&service=WMS", "a"),
+               resource("http://x/wms", "c")]
+        (merged, report) = hh.merge_resources(old, new)
+        self.assertEqual([r.get("id") for r in merged], ["1", "2", None])
+        self.assertEqual(merged[0]["url"], new[0]["url"])
+        self.assertEqual(len(report["replaced"]), 1)
+        self.assertEqual(report["added"], ["http://x/wms"])
+    
+    def test_first_of_duplicate_new_resources_wins(self):
+        old = [resource("http://x/wms", "a", id="1")]
+        new = [resource("http://x/wms", "a", name="first"), 
+               resource("http://x/wms", "a", name="second"),
+               resource("http://y/wms", name="first"), 
+               resource("http://y/wms", name="second")]
+        (merged, report) = hh.merge_resources(old, new)
+        self.assertEqual([r["name"] for r in merged], ["first", "first"])
+        self.assertEqual(report["replaced"], ["http://x/wms"])
+        self.assertEqual(report["added"], ["http://y/wms"])
+    
+    def test_does_not_change_its_input(self):
+        old = [resource("http://x/wms", "a", id="1")]
+        new = [resource("http://x/wms", "a", name="New"), resource("http://y/wms")]
+        (old_copy, new_copy) = (copy.deepcopy(old), copy.deepcopy(new))
+        (merged, report) = hh.merge_resources(old, new)
+        self.assertEqual((old, new), (old_copy, new_copy))
+        merged[1]["name"] = "changed"
+        self.assertEqual(new, new_copy)
+    
+    def test_add_resources_to_list_matches_one_by_one(self):
+        old = [resource("http://x/wms", "a", id="1")]
+        new = [resource("http://x/wms", "a"), resource("http://y/wms"), resource("http://y/wms/")]
+        one_by_one = copy.deepcopy(old)
+        for r in new:
+            one_by_one = hh.add_resource_to_list(one_by_one, dict(r))
+        self.assertEqual([hh.resource_key(r) for r in hh.add_resources_to_list(old, new)],
+                         [hh.resource_key(r) for r in one_by_one])
+
+
+if __name__ == "__main__":
+    unittest.main()
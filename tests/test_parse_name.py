@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import benchmark_harvest
+import harvest_helpers as hh
+
+
+TITLES = [
+    u"Ramsar Sites (Dpaw-037) (28-10-2014 11:11:15)",
+    u"Hydrographic Catchments - Basins (Dow-013) (03-11-2008 15:07:44)",
+    u"Hydrographic Catchments - Basins (Dow-013)",
+    u"Misc Transport (Point) (Lgate-037) (18-10-2012 16:54:00)",
+    u"Overview Rivers(LGATE-053) (14-05-2008 17:59:05)",
+    u"Graticule (REF-001)",
+    u"Virtual Mosaic",
+    u"  Padded   Title  (Pad-001)   (01-02-2013 04:05:06) ",
+    u"Invalid Date (Bad-001) (31-02-2013 10:00:00)",
+    u"Invalid Time (Bad-002) (01-02-2013 25:00:00)",
+    u"Māori Place Names – Tāmaki (Geo-042) (09-09-2009 09:09:09)",
+    u"Nested (Extra (Bits)) (Nest-001) (01-01-2001 01:01:01)",
+    u"Roads 12:00",
+]
+
+
+class ParseNameTest(unittest.TestCase):
+    
+    def setUp(self):
+        hh._parsed_names.clear()
+    
+    def tearDown(self):
+        hh.PARSE_NAME_CACHE_SIZE = 20000
+        hh._parsed_names.clear()
+    
+    def assertSameAsLegacy(self, titles):
+        for title in titles:
+            self.assertEqual(hh._parse_name_cached(title), hh._parse_name_legacy(title), title)
+    
+    def test_cached_equals_legacy(self):
+        self.assertSameAsLegacy(TITLES)
+    
+    def test_cached_equals_legacy_on_slip_titles(self):
+        self.assertSameAsLegacy([u"{0}".format(t) for t in benchmark_harvest.slip_titles(200)])
+    
+    def test_cache_hits_equal_misses(self):
+        first = [hh._parse_name_cached(t) for t in TITLES]
+        self.assertEqual([hh._parse_name_cached(t) for t in TITLES], first)
+    
+    def test_cache_is_bounded(self):
+        hh.PARSE_NAME_CACHE_SIZE = 3
+        for title in TITLES:
+            hh._parse_name_cached(title)
+        self.assertEqual(list(hh._parsed_names), TITLES[-3:])
+        self.assertSameAsLegacy(TITLES)
+    
+    def test_missing_dates_are_estimated(self):
+        (title, name, date) = hh.parse_name(u"Graticule (REF-001)")
+        self.assertEqual((title, name), ("Graticule", "ref-001"))
+        self.assertTrue(isinstance(date, hh.EstimatedDate))
+        (title, name, date) = hh.parse_name(TITLES[0])
+        self.assertEqual(date, "2014-10-28T11:11:15")
+        self.assertFalse(isinstance(date, hh.EstimatedDate))
+    
+    def test_parse_names_shares_one_estimated_date(self):
+        parsed = hh.parse_names([u"Graticule (REF-001)", u"Virtual Mosaic", TITLES[0]])
+        self.assertTrue(parsed[0][2] is parsed[1][2])
+        self.assertEqual(parsed[2], hh.parse_name(TITLES[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
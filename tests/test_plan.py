@@ -0,0 +1,61 @@
+import copy
+import json
+import unittest
+
+import harvest_helpers as hh
+from tests.fakes import FakeCKANTestCase, package
+
+
+class PlanUpsertsTest(FakeCKANTestCase):
+    
+    def setUp(self):
+        super(PlanUpsertsTest, self).setUp()
+        for name in ("a", "b"):
+            self.create(package(name, ["http://x/wms"]))
+        self.create(package("other", ["http://y/wms"]))
+        self.create(package("manual", ["http://x/wms"], tags=("Manual",)))
+        self.catalogue = hh.get_package_index(self.ckan, tag=None)
+    
+    def test_plans_creates_updates_and_unchanged(self):
+        datasets = [package("a", ["http://x/wms"]), package("b", ["http://x/wms"], title="New"),
+                    package("c", ["http://x/wms"]), None]
+        catalogue = copy.deepcopy(self.catalogue)
+        plan = hh.plan_upserts(datasets, catalogue)
+        self.assertEqual(catalogue, self.catalogue)
+        self.assertEqual([d["name"] for d in plan["creates"]], ["c"])
+        self.assertEqual([(u["name"], sorted(u["changes"])) for u in plan["updates"]], 
+                         [("b", ["title"])])
+        self.assertEqual(plan["unchanged"], ["a"])
+        self.assertEqual(plan["deletions"], [])
+        json.dumps(plan)
+        
+        summary = hh.apply_plan(plan, self.ckan, workers=2)
+        self.assertEqual((summary["created"], summary["updated"]), (["c"], ["b"]))
+        plan = hh.plan_upserts(datasets, hh.get_package_index(self.ckan, tag=None))
+        self.assertEqual(sorted(plan["unchanged"]), ["a", "b", "c"])
+    
+    def test_deletions_are_limited_to_the_sources_harvested_datasets(self):
+        plan = hh.plan_upserts([package("a", ["http://x/wms"])], self.catalogue, 
+                               find_deletions=True, max_fraction=0.5)
+        # "other" is from another source, "manual" is not harvested
+        self.assertEqual((plan["deletions"], plan["refused"]), (["b"], False))
+        summary = hh.apply_plan(plan, self.ckan, delete=True)
+        self.assertEqual(summary["deleted"], ["b"])
+        self.assertEqual(sorted(hh.get_package_index(self.ckan, tag=None)), 
+                         ["a", "manual", "other"])
+    
+    def test_too_many_deletions_are_refused(self):
+        plan = hh.plan_upserts([package("a", ["http://x/wms"])], self.catalogue, 
+                               find_deletions=True)
+        self.assertEqual((plan["deletions"], plan["refused"]), (["b"], True))
+        summary = hh.apply_plan(plan, self.ckan, delete=True)
+        self.assertEqual(summary["deleted"], [])
+        self.assertTrue("b" in hh.get_package_index(self.ckan, tag=None))
+    
+    def test_deletions_are_off_by_default(self):
+        plan = hh.plan_upserts([package("a", ["http://x/wms"])], self.catalogue)
+        self.assertEqual((plan["deletions"], plan["refused"]), ([], False))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+import harvest
+import harvest_helpers as hh
+from tests.fakes import FakeCKANTestCase, package
+
+
+class ReapDatasetsTest(FakeCKANTestCase):
+    
+    def setUp(self):
+        super(ReapDatasetsTest, self).setUp()
+        for i in range(10):
+            self.create(package("a{0}".format(i), ["http://x/wms"]))
+        self.create(package("arcgis", 
+                            ["http://x/arcgis/rest/services/Folder/S/MapServer/WMSServer"]))
+        self.create(package("other", ["http://y/wms"]))
+        self.create(package("manual", ["http://x/wms"], tags=("Manual",)))
+    
+    def names(self):
+        return sorted(hh.get_package_index(self.ckan, tag=None))
+    
+    def test_dry_run_only_reports(self):
+        summary = hh.reap_datasets(["a{0}".format(i) for i in range(9)], ["http://x/wms"], 
+                                   self.ckan)
+        self.assertEqual((summary["stale"], summary["datasets"], summary["refused"]), 
+                         (["a9"], 10, False))
+        self.assertEqual(summary["deleted"], [])
+        self.assertTrue("a9" in self.names())
+    
+    def test_deletes_only_stale_harvested_datasets_of_the_sources(self):
+        summary = hh.reap_datasets(["a{0}".format(i) for i in range(9)], ["http://x/wms/"], 
+                                   self.ckan, dry_run=False)
+        self.assertEqual(summary["deleted"], ["a9"])
+        self.assertFalse("a9" in self.names())
+        self.assertTrue(set(["arcgis", "other", "manual"]) <= set(self.names()))
+    
+    def test_refuses_more_than_max_fraction(self):
+        summary = hh.reap_datasets(["a{0}".format(i) for i in range(8)], ["http://x/wms"], 
+                                   self.ckan, dry_run=False)
+        self.assertAlmostEqual(summary["fraction"], 0.2)
+        self.assertTrue(summary["refused"])
+        self.assertEqual(summary["deleted"], [])
+        self.assertEqual(len(self.names()), 13)
+        summary = hh.reap_datasets(["a{0}".format(i) for i in range(8)], ["http://x/wms"], 
+                                   self.ckan, dry_run=False, max_fraction=0.2)
+        self.assertEqual(summary["deleted"], ["a8", "a9"])
+    
+    def test_empty_source_deletes_nothing(self):
+        summary = hh.reap_datasets([], ["http://x/wms"], self.ckan, dry_run=False)
+        self.assertTrue(summary["refused"])
+        self.assertEqual(len(self.names()), 13)
+    
+    def test_sources_match_resources_underneath_them(self):
+        root = "http://x/arcgis/rest/services"
+        summary = hh.reap_datasets([], [root + "/Folder"], self.ckan, max_fraction=1.0)
+        self.assertEqual(summary["stale"], ["arcgis"])
+        summary = hh.reap_datasets([], [root + "/Fold"], self.ckan, max_fraction=1.0)
+        self.assertEqual(summary["stale"], [])
+
+    def test_partially_failed_source_blocks_reaping(self):
+        job = {"sources": [{"arcgis": "SLIP"}], "reap": {"dry_run": False, "max_fraction": 1.0},
+               "prefetch_tag": "Harvested"}
+        converted = [{"name": "SLIP", "error": None, "items": [],
+                      "skipped": ["http://x/arcgis/rest/services/Folder/S/MapServer"]}]
+        self.assertEqual(harvest.reap(job, self.ckan, converted), None)
+        self.assertEqual(len(self.names()), 13)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+
+import harvest_helpers as hh
+from tests.fakes import FakeCKANTestCase, package
+
+
+class RunJournalTest(FakeCKANTestCase):
+    
+    def journal(self, run_id="run"):
+        return hh.RunJournal(run_id, journal_dir=self.tmp, sync=False)
+    
+    def test_resume_skips_done_items(self):
+        journal = self.journal()
+        journal.start("a")
+        journal.done("a", action="created")
+        journal.start("b")
+        journal.fail("b", ValueError("boom"))
+        journal.start("c")
+        journal.close()
+        
+        journal = self.journal()
+        self.assertEqual([journal.status(k) for k in "abcd"], ["done", "failed", "started", None])
+        self.assertEqual(journal.report(), {"done": 1, "failed": 1, "started": 1})
+        journal.close()
+    
+    def test_torn_last_record_is_dropped(self):
+        journal = self.journal()
+        journal.done("a")
+        journal.close()
+        with open(journal.path, "a") as f:
+            f.write('{"key": "b", "status": "do')
+        
+        journal = self.journal()
+        self.assertEqual((journal.status("a"), journal.status("b")), ("done", None))
+        journal.done("b")
+        journal.close()
+        self.assertTrue(self.journal().is_done("b"))
+    
+    def test_complete_compacts_to_the_last_records(self):
+        journal = self.journal()
+        for key in "ab":
+            journal.start(key)
+            journal.done(key)
+        journal.complete()
+        journal.close()
+        with open(journal.path) as f:
+            self.assertEqual(len(f.readlines()), 3)
+        journal = self.journal()
+        self.assertTrue(journal.completed)
+        self.assertEqual(journal.report(), {"done": 2})
+        journal.close()
+    
+    def upsert(self, datasets, fail=(), **kwargs):
+        """upsert_datasets with a journal, with all CKAN calls about datasets in fail raising
+        
+        Returns:
+            A tuple of (the upserted packages or the exception raised, 
+            the names of datasets read from CKAN)
+        """
+        ckan_action = hh.ckan_action
+        shown = []
+        def failing(ckanapi, action, **data):
+            name = data.get("id", data.get("name"))
+            if name in fail:
+                raise ValueError("{0} failed".format(action))
+            if action == "package_show":
+                shown.append(name)
+            return ckan_action(ckanapi, action, **data)
+        hh.ckan_action = failing
+        journal = self.journal()
+        try:
+            return (hh.upsert_datasets(datasets, self.ckan, journal=journal, **kwargs), shown)
+        except ValueError as e:
+            return (e, shown)
+        finally:
+            hh.ckan_action = ckan_action
+            journal.close()
+    
+    def test_resumed_upserts_skip_datasets_done_before(self):
+        datasets = [package(n, ["http://x/wms"]) for n in "abc"]
+        (result, shown) = self.upsert(datasets, fail=["b"])
+        self.assertTrue(isinstance(result, ValueError))
+        self.assertEqual(shown, ["a"])
+        
+        (result, shown) = self.upsert(datasets)
+        self.assertEqual([p["name"] for p in result], ["b", "c"])
+        self.assertEqual(shown, ["b", "c"])
+        self.assertEqual(self.journal().report(), {"done": 3})
+    
+    def test_resumed_concurrent_upserts_skip_datasets_done_before(self):
+        datasets = [package(n, ["http://x/wms"]) for n in "abc"]
+        self.upsert(datasets, fail=["b"], workers=2)
+        (result, shown) = self.upsert(datasets, workers=2)
+        self.assertEqual(shown, ["b"])
+        self.assertEqual(self.journal().report(), {"done": 3})
+    
+    def test_journal_keys_tell_sources_apart(self):
+        self.upsert([package("a", ["http://x/wms"])])
+        (result, shown) = self.upsert([package("a", ["http://x/wfs"]), 
+                                       package("a", ["http://x/wms/"])])
+        self.assertEqual(shown, ["a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+
+import harvest_helpers as hh
+from tests.fakes import FakeCKANTestCase, package
+
+
+class UpsertConcurrentlyTest(FakeCKANTestCase):
+    
+    def upsert(self, datasets, fail=()):
+        """upsert_datasets_concurrently, with all CKAN calls about datasets in fail raising"""
+        ckan_action = hh.ckan_action
+        def failing(ckanapi, action, **kwargs):
+            if kwargs.get("id", kwargs.get("name")) in fail:
+                raise ValueError("{0} failed".format(action))
+            return ckan_action(ckanapi, action, **kwargs)
+        hh.ckan_action = failing
+        try:
+            return hh.upsert_datasets_concurrently(datasets, self.ckan, workers=4)
+        finally:
+            hh.ckan_action = ckan_action
+    
+    def test_packages_align_with_input(self):
+        datasets = [package("a", ["http://x/wms"]), None, package("b", ["http://x/wms"])]
+        summary = self.upsert(iter(datasets))
+        self.assertEqual([p and p["name"] for p in summary["packages"]], ["a", None, "b"])
+        self.assertEqual(summary["created"], ["a", "b"])
+        self.assertEqual(summary["failed"], [])
+    
+    def test_keeps_failures_of_the_same_name(self):
+        datasets = [package("a", ["http://x/wms"]), package("a", ["http://x/wfs"]),
+                    package("b", ["http://x/wms"])]
+        summary = self.upsert(datasets, fail=["a"])
+        self.assertEqual([(f["name"], f["urls"]) for f in summary["failed"]], 
+                         [("a", ["http://x/wms"]), ("a", ["http://x/wfs"])])
+        self.assertEqual([p and p["name"] for p in summary["packages"]], [None, None, "b"])
+    
+    def test_datasets_of_the_same_name_merge_in_order(self):
+        self.create(package("a", ["http://x/old"]))
+        datasets = [package("a", ["http://x/wms"]), package("b", ["http://x/wms"]),
+                    package("a", ["http://x/wfs"]), package("c", ["http://x/wfs"])]
+        summary = hh.upsert_datasets_concurrently(
+            datasets, self.ckan, workers=4, drop_existing_resources=False, 
+            package_index=hh.get_package_index(self.ckan), skip_unchanged=False)
+        self.assertEqual(summary["failed"], [])
+        self.assertEqual(sorted(summary["created"]), ["b", "c"])
+        self.assertEqual(summary["updated"], ["a", "a"])
+        self.assertEqual([r["url"] for r in summary["packages"][2]["resources"]],
+                         ["http://x/old", "http://x/wms", "http://x/wfs"])
+        self.assertEqual([r["url"] for r in self.ckan.action.package_show(id="a")["resources"]],
+                         ["http://x/old", "http://x/wms", "http://x/wfs"])
+
+
+
+class SkipUnchangedTest(FakeCKANTestCase):
+    
+    def upsert(self, data_dict, **kwargs):
+        """Upsert a dataset and return its action and the number of package_update calls"""
+        before = self.env.ckan.counts.get("package_update", 0)
+        (package, action) = hh._upsert_dataset(data_dict, self.ckan, **kwargs)
+        return (action, self.env.ckan.counts.get("package_update", 0) - before)
+    
+    def test_unchanged_dataset_is_not_written(self):
+        data_dict = package("a", ["http://x/wms"], published_on="2015-10-05T13:41:48")
+        self.assertEqual(self.upsert(data_dict), ("created", 0))
+        self.assertEqual(self.upsert(dict(data_dict, tag_string=["Harvested"])), 
+                         ("unchanged", 0))
+    
+    def test_real_date_change_is_written(self):
+        data_dict = package("a", ["http://x/wms"], published_on="2015-10-05T13:41:48")
+        self.upsert(data_dict)
+        self.assertEqual(self.upsert(dict(data_dict, published_on="2015-10-06T09:00:00")), 
+                         ("updated", 1))
+    
+    def test_estimated_date_is_ignored(self):
+        data_dict = package("a", ["http://x/wms"], published_on="2015-10-05T13:41:48")
+        self.upsert(data_dict)
+        estimated = hh.EstimatedDate("2015-10-06T09:00:00")
+        self.assertEqual(self.upsert(dict(data_dict, published_on=estimated)), ("unchanged", 0))
+    
+    def test_resource_change_is_written(self):
+        self.upsert(package("a", ["http://x/wms"]))
+        self.assertEqual(self.upsert(package("a", ["http://y/wms"])), ("updated", 1))
+    
+    def test_skip_unchanged_off_always_writes(self):
+        data_dict = package("a", ["http://x/wms"])
+        self.upsert(data_dict)
+        self.assertEqual(self.upsert(data_dict, skip_unchanged=False), ("updated", 1))
+    
+    def test_fingerprint_ignores_tag_order_and_ckan_fields(self):
+        data_dict = package("a", ["http://x/wms"], tags=("b", "a"))
+        stored = self.create(data_dict)
+        self.assertEqual(hh.package_fingerprint(stored, template=data_dict), 
+                         hh.package_fingerprint(data_dict))
+        self.assertEqual(hh.package_changes(stored, dict(data_dict, title="New")), 
+                         {"title": {"old": "A", "new": "New"}})
+
+
+if __name__ == "__main__":
+    unittest.main()